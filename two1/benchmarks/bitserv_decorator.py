@@ -0,0 +1,210 @@
+""" Benchmarks the per-request overhead of the Flask bitserv decorator.
+
+    Serves a free route, a paid route and a paid route with a price
+    computed from the request through Flask's test client, and reports
+    the time per request and the overhead over the free route:
+
+        * unpaid: the 402 response, with the headers of all payment
+          methods,
+        * paid: a valid on-chain payment, recorded in an in-memory
+          database. Broadcasting is replaced by a no-op.
+
+    The time to build the 402 headers of a request, by merging the
+    headers of each payment method and from the route's HeaderCache,
+    is also reported.
+
+    Usage:
+        python3 -m two1.benchmarks.bitserv_decorator [--requests 2000]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import timeit
+
+from flask import Flask
+
+from two1.lib.bitcoin.crypto import PrivateKey
+from two1.lib.bitcoin.hash import Hash
+from two1.lib.bitcoin.script import Script
+from two1.lib.bitcoin.txn import Transaction
+from two1.lib.bitcoin.txn import TransactionInput
+from two1.lib.bitcoin.txn import TransactionOutput
+from two1.lib.bitserv.flask.decorator import Payment
+from two1.lib.bitserv.flask.decorator import flask_channel_adapter
+from two1.lib.bitserv.models import DatabaseSQLite3
+from two1.lib.bitserv.models import OnChainSQLite3
+from two1.lib.bitserv.payment_methods import BitTransfer
+from two1.lib.bitserv.payment_methods import HeaderCache
+from two1.lib.bitserv.payment_methods import OnChain
+from two1.lib.bitserv.payment_methods import PaymentChannel
+from two1.lib.bitserv.payment_methods import PayoutAddress
+from two1.lib.bitserv.payment_server import PaymentServer
+
+PRICE = 1000
+
+
+class MerchantWallet:
+    """ The parts of a wallet that bitserv needs to build 402 headers.
+    """
+
+    def __init__(self):
+        self.key = PrivateKey.from_random()
+
+    def get_payout_address(self, account_name_or_index=None):
+        return self.key.public_key.address()
+
+    def get_payout_public_key(self, account_name_or_index=None):
+        return self.key.public_key
+
+
+class NoBroadcast:
+    """ Stands in for the blockchain provider OnChain broadcasts with.
+    """
+
+    def broadcast_transaction(self, raw_tx):
+        pass
+
+
+def build_app(wallet, tmpdir, rotate_address=None):
+    """ Builds a Flask app with a free and two paid routes.
+
+    Returns:
+        tuple(flask.Flask, Payment, OnChain): The app, its bitserv
+            settings and its on-chain payment method.
+    """
+    app = Flask(__name__)
+    account_file = os.path.join(tmpdir, "account.json")
+    with open(account_file, "w") as f:
+        json.dump({"username": "merchant"}, f)
+
+    server = PaymentServer(wallet, DatabaseSQLite3(os.path.join(tmpdir, "channels.db")))
+    payout = PayoutAddress(wallet, rotate_address)
+    on_chain = OnChain(wallet, OnChainSQLite3(":memory:"), payout=payout)
+    on_chain.provider = NoBroadcast()
+    payment = Payment(app, wallet, allowed_methods=[
+        PaymentChannel(*flask_channel_adapter(app, server)),
+        on_chain,
+        BitTransfer(wallet, seller_account=account_file, payout=payout)])
+
+    @app.route("/free")
+    def free():
+        return "ok"
+
+    @app.route("/paid")
+    @payment.required(PRICE)
+    def paid():
+        return "ok"
+
+    @app.route("/dynamic")
+    @payment.required(lambda request: PRICE)
+    def dynamic():
+        return "ok"
+
+    return app, payment, on_chain
+
+
+def build_payments(hash160, n):
+    """ Builds n distinct transactions paying PRICE to hash160.
+
+    Returns:
+        list(str): The hex-encoded transactions.
+    """
+    payments = []
+    for i in range(n):
+        txn = Transaction(Transaction.DEFAULT_TRANSACTION_VERSION,
+                          [TransactionInput(Hash(os.urandom(32)), 0, Script(), 0xffffffff)],
+                          [TransactionOutput(PRICE, Script.build_p2pkh(hash160))],
+                          0)
+        payments.append(txn.to_hex())
+
+    return payments
+
+
+def time_requests(client, path, n, headers=None, status=200, repeat=3):
+    """ Returns the seconds per request for n requests to path.
+
+    Args:
+        headers (list(dict)): Headers for each request, n for each
+            timing run.
+        repeat (int): Number of timing runs; the best one is returned.
+    """
+    times = []
+    for r in range(repeat):
+        start = time.perf_counter()
+        for i in range(n):
+            response = client.get(path, headers=headers[r * n + i] if headers else None)
+            assert response.status_code == status, response.status_code
+        times.append(time.perf_counter() - start)
+
+    return min(times) / n
+
+
+def run(num_requests, rotate_address=None, repeat=3):
+    """ Times each route and prints a table.
+
+    Args:
+        num_requests (int): Number of requests per route.
+        rotate_address (float): Seconds between payout address rotations.
+        repeat (int): Number of timing runs; the best one is reported.
+    """
+    wallet = MerchantWallet()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        app, payment, on_chain = build_app(wallet, tmpdir, rotate_address)
+        client = app.test_client()
+        payments = [{"Bitcoin-Transaction": tx}
+                    for tx in build_payments(wallet.key.public_key.hash160(),
+                                             num_requests * repeat)]
+
+        # Warm up
+        time_requests(client, "/free", 100)
+        time_requests(client, "/paid", 100, status=402)
+
+        free = time_requests(client, "/free", num_requests, repeat=repeat)
+        runs = [("free", free),
+                ("unpaid", time_requests(client, "/paid", num_requests,
+                                         status=402, repeat=repeat)),
+                ("unpaid, price(request)",
+                 time_requests(client, "/dynamic", num_requests,
+                               status=402, repeat=repeat)),
+                ("paid on-chain",
+                 time_requests(client, "/paid", num_requests, payments,
+                               repeat=repeat))]
+
+        print("%-24s %14s %14s" % ("route", "us/request", "overhead us"))
+        for name, t in runs:
+            print("%-24s %14.1f %14.1f" % (name, t * 1e6, (t - free) * 1e6))
+
+        def merge():
+            headers = {}
+            for method in payment.allowed_methods:
+                headers.update(method.get_402_headers(PRICE, server_url="http://localhost"))
+            return headers
+
+        cache = HeaderCache(payment.allowed_methods)
+        assert cache.get(PRICE, server_url="http://localhost") == merge()
+        print()
+        print("%-24s %14s" % ("402 headers", "us/request"))
+        for name, func in [("merged", merge),
+                           ("HeaderCache",
+                            lambda: cache.get(PRICE, server_url="http://localhost"))]:
+            t = min(timeit.repeat(func, number=num_requests, repeat=repeat))
+            print("%-24s %14.2f" % (name, t * 1e6 / num_requests))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000,
+                        help="Number of requests per route.")
+    parser.add_argument("--rotate-address", type=float, default=None,
+                        help="Seconds between payout address rotations.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of timing runs per route.")
+    args = parser.parse_args()
+
+    run(args.requests, args.rotate_address, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+""" Benchmarks BitTransfer verification throughput.
+
+    Starts a local stand-in for the BitTransfer verification server,
+    which answers after a configurable delay to simulate the round
+    trip to the real one, and reports how many transfers per second
+    are verified:
+
+        * with one requests.post() per transfer, opening a new
+          connection every time,
+        * by BitTransferVerifier.verify(), reusing pooled keep-alive
+          connections, from one and from several threads,
+        * by BitTransferVerifier.verify_batch(), in batches.
+
+    Usage:
+        python3 -m two1.benchmarks.bittransfer_verify [--transfers 200]
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import requests
+
+from two1.lib.bitserv.payment_methods import BitTransferVerifier
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """ Answers verification requests like the verification server.
+
+        Transfers signed "bad" are rejected; all others are valid.
+    """
+    protocol_version = "HTTP/1.1"
+    # Like production servers; otherwise every keep-alive response
+    # stalls on a delayed ACK.
+    disable_nagle_algorithm = True
+    latency = 0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        time.sleep(self.latency)
+
+        if self.path.endswith("/batch/"):
+            status = 200
+            data = {"results": [{"ok": True} if t["signature"] != "bad" else
+                                {"ok": False, "message": "Invalid signature."}
+                                for t in body["transfers"]]}
+        elif body["signature"] != "bad":
+            status, data = 200, {"ok": True}
+        else:
+            status, data = 400, {"message": "Invalid signature."}
+
+        raw = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(latency):
+    """ Starts the stand-in server in a background thread.
+
+    Args:
+        latency (float): Seconds to wait before answering each request.
+
+    Returns:
+        ThreadingHTTPServer: The running server.
+    """
+    StandInHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def make_transfers(n):
+    """ Builds n distinct (bittransfer, signature) tuples.
+    """
+    transfers = []
+    for i in range(n):
+        bittransfer = json.dumps({"payer": "buyer",
+                                  "payee_address": "1BoatSLRHtKNngkdXEeobR76b53LETtpyT",
+                                  "payee_username": "seller",
+                                  "amount": 1000,
+                                  "timestamp": time.time(),
+                                  "description": "benchmark"})
+        transfers.append((bittransfer, uuid.uuid4().hex))
+
+    return transfers
+
+
+def run(num_transfers, latency, threads, batch_size):
+    """ Verifies transfers each way and prints a table.
+
+    Args:
+        num_transfers (int): Number of transfers verified each way.
+        latency (float): Stand-in server delay per request, in seconds.
+        threads (int): Number of threads for the threaded run.
+        batch_size (int): Number of transfers per batch.
+    """
+    server = start_server(latency)
+    url = "http://127.0.0.1:%d/pool/account/{}/bittransfer/" % server.server_address[1]
+    verifier = BitTransferVerifier(url, "seller")
+
+    def post_each(transfers):
+        for bittransfer, signature in transfers:
+            requests.post(verifier.url,
+                          data=json.dumps({"bittransfer": bittransfer,
+                                           "signature": signature}),
+                          headers={"content-type": "application/json"})
+
+    def verify_each(transfers):
+        for t in transfers:
+            verifier.verify(*t)
+
+    def verify_threaded(transfers):
+        with ThreadPoolExecutor(threads) as executor:
+            list(executor.map(lambda t: verifier.verify(*t), transfers))
+
+    def verify_batches(transfers):
+        for i in range(0, len(transfers), batch_size):
+            results = verifier.verify_batch(transfers[i:i + batch_size])
+            assert all(r is True for r in results)
+
+    runs = [("requests.post", post_each),
+            ("verify", verify_each),
+            ("verify, %d threads" % threads, verify_threaded),
+            ("verify_batch(%d)" % batch_size, verify_batches)]
+
+    print("%-24s %12s %14s" % ("method", "seconds", "transfers/s"))
+    for name, func in runs:
+        transfers = make_transfers(num_transfers)
+        start = time.perf_counter()
+        func(transfers)
+        t = time.perf_counter() - start
+        print("%-24s %12.3f %14.1f" % (name, t, num_transfers / t))
+
+    server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--transfers", type=int, default=200,
+                        help="Number of transfers verified each way.")
+    parser.add_argument("--latency", type=float, default=5,
+                        help="Stand-in server delay per request, in ms.")
+    parser.add_argument("--threads", type=int, default=8,
+                        help="Number of threads for the threaded run.")
+    parser.add_argument("--batch-size", type=int, default=50,
+                        help="Number of transfers per batch.")
+    args = parser.parse_args()
+
+    run(args.transfers, args.latency / 1e3, args.threads, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
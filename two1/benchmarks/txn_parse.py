@@ -0,0 +1,123 @@
+""" Benchmarks Transaction deserialization against transaction size.
+
+    Builds synthetic transactions with an increasing number of P2PKH
+    inputs and reports the time spent per input by
+    Transaction.from_bytes. With the offset-based parser the per-input
+    cost should stay flat as the input count grows. For comparison the
+    same transactions are also parsed by slicing off each consumed
+    field, which is quadratic in the size of the transaction.
+
+    Usage:
+        python3 -m two1.benchmarks.txn_parse [--inputs 250,500,1000,2000]
+"""
+import argparse
+import os
+import struct
+import timeit
+
+from two1.lib.bitcoin.hash import Hash
+from two1.lib.bitcoin.script import Script
+from two1.lib.bitcoin.txn import Transaction
+from two1.lib.bitcoin.txn import TransactionInput
+from two1.lib.bitcoin.txn import TransactionOutput
+from two1.lib.bitcoin.utils import unpack_compact_int
+from two1.lib.bitcoin.utils import unpack_var_str
+
+
+def build_txn(num_inputs, num_outputs=2):
+    """ Builds a serialized transaction with random P2PKH-sized
+        signature scripts.
+
+    Args:
+        num_inputs (int): Number of inputs in the transaction.
+        num_outputs (int): Number of outputs in the transaction.
+
+    Returns:
+        bytes: The serialized transaction.
+    """
+    inputs = []
+    for i in range(num_inputs):
+        # 72-byte signature push + 33-byte compressed public key push
+        script_sig = bytes([72]) + os.urandom(72) + bytes([33]) + os.urandom(33)
+        inputs.append(TransactionInput(Hash(os.urandom(32)),
+                                       i % 4,
+                                       Script(script_sig),
+                                       0xffffffff))
+
+    outputs = [TransactionOutput(100000 + i, Script.build_p2pkh(os.urandom(20)))
+               for i in range(num_outputs)]
+
+    return bytes(Transaction(Transaction.DEFAULT_TRANSACTION_VERSION,
+                             inputs,
+                             outputs,
+                             0))
+
+
+def parse_by_slicing(b):
+    """ Reference parser that copies the remaining stream for every
+        field, as the library did before parsing with an offset cursor.
+    """
+    version = struct.unpack('<I', b[:4])[0]
+    b = b[4:]
+    num_inputs, b = unpack_compact_int(b)
+    inputs = []
+    for i in range(num_inputs):
+        outpoint, b = b[:32], b[32:]
+        outpoint_index, b = struct.unpack('<I', b[:4])[0], b[4:]
+        raw_script, b = unpack_var_str(b)
+        sequence_num, b = struct.unpack('<I', b[:4])[0], b[4:]
+        inputs.append(TransactionInput(Hash(outpoint),
+                                       outpoint_index,
+                                       Script(raw_script),
+                                       sequence_num))
+
+    num_outputs, b = unpack_compact_int(b)
+    outputs = []
+    for o in range(num_outputs):
+        value, b = struct.unpack('<Q', b[:8])[0], b[8:]
+        raw_script, b = unpack_var_str(b)
+        outputs.append(TransactionOutput(value, Script(raw_script)))
+
+    lock_time = struct.unpack('<I', b[:4])[0]
+
+    return Transaction(version, inputs, outputs, lock_time), b[4:]
+
+
+def run(input_counts, repeat=5):
+    """ Times both parsers for each input count and prints a table.
+
+    Args:
+        input_counts (list(int)): Transaction sizes (in inputs) to time.
+        repeat (int): Number of timing runs; the best one is reported.
+    """
+    print("%8s %10s %14s %14s %14s" % ("inputs", "bytes", "from_bytes",
+                                      "us/input", "slicing us/in"))
+    for n in input_counts:
+        raw = build_txn(n)
+        assert bytes(Transaction.from_bytes(raw)[0]) == raw
+
+        t = min(timeit.repeat(lambda: Transaction.from_bytes(raw),
+                              number=1, repeat=repeat))
+        t_slice = min(timeit.repeat(lambda: parse_by_slicing(raw),
+                                    number=1, repeat=repeat))
+
+        print("%8d %10d %12.2fms %14.2f %14.2f" % (n,
+                                                  len(raw),
+                                                  t * 1e3,
+                                                  t * 1e6 / n,
+                                                  t_slice * 1e6 / n))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--inputs", default="250,500,1000,2000,4000",
+                        help="Comma-separated list of input counts.")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of timing runs per size.")
+    args = parser.parse_args()
+
+    run([int(n) for n in args.inputs.split(",")], args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,7 @@ from sha256 import sha256 as sha256_midstate
 
 from two1.lib.bitcoin.hash import Hash
 from two1.lib.bitcoin.txn import CoinbaseInput, Transaction
-from two1.lib.bitcoin.utils import bytes_to_str, pack_u32, unpack_u32, bits_to_target, pack_compact_int, unpack_compact_int
+from two1.lib.bitcoin.utils import bytes_to_str, pack_u32, unpack_u32, bits_to_target, pack_compact_int, unpack_compact_int_from
 
 
 """ merkle_hash: SHA-256 byte string (internal byte order)
@@ -155,13 +155,14 @@ class Block(object):
                               and the second is the remainder of the byte stream.
         """
         bh, b = BlockHeader.from_bytes(b)
-        num_txns, b = unpack_compact_int(b)
+        buf = memoryview(b)
+        num_txns, offset = unpack_compact_int_from(buf)
         txns = []
         for i in range(num_txns):
-            t, b = Transaction.from_bytes(b)
+            t, offset = Transaction.from_buffer(buf, offset)
             txns.append(t)
 
-        return Block.from_blockheader(bh, txns), b
+        return Block.from_blockheader(bh, txns), b[offset:]
 
     @classmethod
     def from_blockheader(cls, bh, txns):
@@ -2,10 +2,12 @@ import math
 
 import base58
 import base64
+from collections import OrderedDict
 import hashlib
 import hmac
 from mnemonic.mnemonic import Mnemonic
 import random
+import threading
 from two1.lib.bitcoin.utils import bytes_to_str
 from two1.lib.bitcoin.utils import address_to_key_hash
 from two1.lib.bitcoin.utils import rand_bytes
@@ -647,6 +649,30 @@ class PublicKey(PublicKeyBase):
 
         return derived_public_key.verify(msg_hash, sig)
 
+    @staticmethod
+    def verify_batch(items, do_hash=True):
+        """ Verifies a number of signatures at once, amortizing the
+            work common to all of them.
+
+        Args:
+            items (list(tuple)): A list of (message, signature,
+                public_key) tuples, where signature is a Signature
+                object and public_key a PublicKey or HDPublicKey
+                object.
+            do_hash (bool): True if the messages should be hashed prior
+                to verifying, False if not.
+
+        Returns:
+            list(bool): Whether each signature is verified, in the
+                same order as items.
+        """
+        return bitcoin_curve.verify_batch(
+            [(get_bytes(message),
+              signature,
+              public_key._key.point if isinstance(public_key, HDPublicKey) else public_key.point)
+             for message, signature, public_key in items],
+            do_hash)
+
     def __init__(self, x, y):
         p = ECPointAffine(bitcoin_curve, x, y)
         if not bitcoin_curve.is_on_curve(p):
@@ -916,6 +942,87 @@ class Signature(object):
         return self.r.to_bytes(nbytes, 'big') + self.s.to_bytes(nbytes, 'big')
 
 
+class DerivedKeyCache(object):
+    """ A bounded, thread-safe LRU cache of derived HD child keys.
+
+        HDPrivateKey.from_parent(), HDPublicKey.from_parent() and
+        HDKey.derive_range() look up children here, keyed by the
+        parent key (its key and chain code) and the child index,
+        before doing the HMAC and elliptic curve work to derive them.
+
+    Args:
+        max_size (int): The maximum number of keys to keep.
+    """
+    DEFAULT_MAX_SIZE = 4096
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns a cached child key.
+
+        Args:
+            key (tuple): (parent id, index) as created by HDKey.
+
+        Returns:
+            HDKey: The child key or None if it is not cached.
+        """
+        with self._lock:
+            child = self._keys.get(key, None)
+            if child is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._keys.move_to_end(key)
+
+            return child
+
+    def put(self, key, child):
+        """ Adds a child key to the cache, evicting the least recently
+            used one if the cache is full.
+
+        Args:
+            key (tuple): (parent id, index) as created by HDKey.
+            child (HDKey): The child key.
+        """
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._keys[key] = child
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+    def clear(self):
+        """ Removes all keys from the cache and resets the stats.
+        """
+        with self._lock:
+            self._keys.clear()
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def stats(self):
+        """ Cache statistics.
+
+        Returns:
+            dict: 'hits', 'misses', 'size' and 'max_size' keys.
+        """
+        with self._lock:
+            return dict(hits=self.hits,
+                        misses=self.misses,
+                        size=len(self._keys),
+                        max_size=self.max_size)
+
+
+derived_key_cache = DerivedKeyCache()
+
+
 class HDKey(object):
     """ Base class for HDPrivateKey and HDPublicKey.
 
@@ -1051,6 +1158,97 @@ class HDKey(object):
 
         return "/".join(p)
 
+    @staticmethod
+    def derive_range(parent_key, start, count):
+        """ Derives a contiguous range of child keys.
+
+            This is equivalent to calling from_parent() for each index
+            but the work that only depends on the parent (its
+            serialized key, fingerprint and the HMAC key setup) is
+            only done once for the whole range. Derived keys are
+            added to derived_key_cache.
+
+        Args:
+            parent_key (HDPrivateKey or HDPublicKey): The parent key.
+                Private parents derive private children and public
+                parents derive public children.
+            start (int): The index of the first child.
+            count (int): The number of children to derive.
+
+        Returns:
+            list(HDKey): The child keys, in order. An entry is None for
+                the (astronomically unlikely) indices that do not
+                result in a valid key.
+        """
+        if not isinstance(parent_key, (HDPrivateKey, HDPublicKey)):
+            raise TypeError("parent_key must be either a HDPrivateKey or HDPublicKey object")
+
+        private = isinstance(parent_key, HDPrivateKey)
+        if not private and (start + count - 1) & 0x80000000:
+            raise ValueError("Can't generate a hardened child key from a parent public key.")
+
+        parent_id = parent_key._derivation_id
+        children = [derived_key_cache.get((parent_id, i))
+                    for i in range(start, start + count)]
+        if all(c is not None for c in children):
+            return children
+
+        base_hmac = hmac.new(parent_key.chain_code, digestmod=hashlib.sha512)
+        fingerprint = parent_key.fingerprint
+        child_depth = parent_key.depth + 1
+        if private:
+            parent_pub_bytes = parent_key.public_key.compressed_bytes
+            parent_priv_bytes = b'\x00' + bytes(parent_key._key)
+        else:
+            parent_pub_bytes = parent_key.compressed_bytes
+
+        for n, child in enumerate(children):
+            if child is not None:
+                continue
+
+            i = start + n
+            h = base_hmac.copy()
+            if i & 0x80000000:
+                h.update(parent_priv_bytes)
+            else:
+                h.update(parent_pub_bytes)
+            h.update(i.to_bytes(length=4, byteorder='big'))
+            I = h.digest()
+            Il, Ir = I[:32], I[32:]
+
+            parse_Il = int.from_bytes(Il, 'big')
+            if parse_Il >= bitcoin_curve.n:
+                continue
+
+            if private:
+                child_key = (parse_Il + parent_key._key.key) % bitcoin_curve.n
+                if child_key == 0:
+                    # Incredibly unlucky choice
+                    continue
+
+                child = HDPrivateKey(key=child_key,
+                                     chain_code=Ir,
+                                     index=i,
+                                     depth=child_depth,
+                                     parent_fingerprint=fingerprint)
+            else:
+                temp_priv_key = PrivateKey(parse_Il)
+                Ki = temp_priv_key.public_key.point + parent_key._key.point
+                if Ki.infinity:
+                    continue
+
+                child = HDPublicKey(x=Ki.x,
+                                    y=Ki.y,
+                                    chain_code=Ir,
+                                    index=i,
+                                    depth=child_depth,
+                                    parent_fingerprint=fingerprint)
+
+            derived_key_cache.put((parent_id, i), child)
+            children[n] = child
+
+        return children
+
     def __init__(self, key, chain_code, index, depth, parent_fingerprint):
         if index < 0 or index > 0xffffffff:
             raise ValueError("index is out of range: 0 <= index <= 2**32 - 1")
@@ -1064,6 +1262,25 @@ class HDKey(object):
         self.index = index
 
         self.parent_fingerprint = get_bytes(parent_fingerprint)
+        self._derivation_id_bytes = None
+
+    @property
+    def _derivation_id(self):
+        """ Uniquely identifies this key as a parent in
+            derived_key_cache: the chain code followed by either the
+            0x00-prefixed private key or the compressed public key.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        if self._derivation_id_bytes is None:
+            if isinstance(self, HDPrivateKey):
+                key_bytes = b'\x00' + bytes(self._key)
+            else:
+                key_bytes = self._key.compressed_bytes
+            self._derivation_id_bytes = self.chain_code + key_bytes
+
+        return self._derivation_id_bytes
 
     @property
     def master(self):
@@ -1247,31 +1464,7 @@ class HDPrivateKey(HDKey, PrivateKeyBase):
         if not isinstance(parent_key, HDPrivateKey):
             raise TypeError("parent_key must be an HDPrivateKey object.")
 
-        hmac_key = parent_key.chain_code
-        if i & 0x80000000:
-            hmac_data = b'\x00' + bytes(parent_key._key) + i.to_bytes(length=4, byteorder='big')
-        else:
-            hmac_data = parent_key.public_key.compressed_bytes + i.to_bytes(length=4, byteorder='big')
-
-        I = hmac.new(hmac_key, hmac_data, hashlib.sha512).digest()
-        Il, Ir = I[:32], I[32:]
-
-        parse_Il = int.from_bytes(Il, 'big')
-        if parse_Il >= bitcoin_curve.n:
-            return None
-
-        child_key = (parse_Il + parent_key._key.key) % bitcoin_curve.n
-
-        if child_key == 0:
-            # Incredibly unlucky choice
-            return None
-
-        child_depth = parent_key.depth + 1
-        return HDPrivateKey(key=child_key,
-                            chain_code=Ir,
-                            index=i,
-                            depth=child_depth,
-                            parent_fingerprint=parent_key.fingerprint)
+        return HDKey.derive_range(parent_key, i, 1)[0]
 
     def __init__(self, key, chain_code, index, depth,
                  parent_fingerprint=b'\x00\x00\x00\x00'):
@@ -1385,7 +1578,7 @@ class HDPrivateKey(HDKey, PrivateKeyBase):
         return self.public_key.hash160()
 
     def __int__(self):
-        return int(self.key)
+        return int(self._key)
 
 
 class HDPublicKey(HDKey, PublicKeyBase):
@@ -1423,29 +1616,7 @@ class HDPublicKey(HDKey, PublicKeyBase):
             # Get child private key
             return HDPrivateKey.from_parent(parent_key, i).public_key
         elif isinstance(parent_key, HDPublicKey):
-            if i & 0x80000000:
-                raise ValueError("Can't generate a hardened child key from a parent public key.")
-            else:
-                I = hmac.new(parent_key.chain_code,
-                             parent_key.compressed_bytes + i.to_bytes(length=4, byteorder='big'),
-                             hashlib.sha512).digest()
-                Il, Ir = I[:32], I[32:]
-                parse_Il = int.from_bytes(Il, 'big')
-                if parse_Il >= bitcoin_curve.n:
-                    return None
-
-                temp_priv_key = PrivateKey(parse_Il)
-                Ki = temp_priv_key.public_key.point + parent_key._key.point
-                if Ki.infinity:
-                    return None
-
-                child_depth = parent_key.depth + 1
-                return HDPublicKey(x=Ki.x,
-                                   y=Ki.y,
-                                   chain_code=Ir,
-                                   index=i,
-                                   depth=child_depth,
-                                   parent_fingerprint=parent_key.fingerprint)
+            return HDKey.derive_range(parent_key, i, 1)[0]
         else:
             raise TypeError("parent_key must be either a HDPrivateKey or HDPublicKey object")
 
@@ -1,6 +1,6 @@
-import copy
 import hashlib
 import struct
+import weakref
 
 from two1.lib.bitcoin import crypto
 from two1.lib.bitcoin.hash import Hash
@@ -11,9 +11,30 @@ from two1.lib.bitcoin.utils import pack_compact_int
 from two1.lib.bitcoin.utils import pack_u32
 from two1.lib.bitcoin.utils import pack_u64
 from two1.lib.bitcoin.utils import pack_var_str
-from two1.lib.bitcoin.utils import unpack_compact_int
-from two1.lib.bitcoin.utils import unpack_u32
-from two1.lib.bitcoin.utils import unpack_u64
+from two1.lib.bitcoin.utils import unpack_compact_int_from
+from two1.lib.bitcoin.utils import unpack_var_str_from
+
+
+def _notify_owners(component, sig_hash=True):
+    """ Invalidates the cached serialization of every frozen
+        transaction that component is a part of. If sig_hash is
+        False, cached signature hash state is kept: this is the case
+        when only an input script changes, as input scripts are never
+        part of a signature hash preimage.
+    """
+    owners = component.__dict__.get('_owners')
+    if owners:
+        for txn in list(owners.values()):
+            txn._invalidate_cache(sig_hash)
+
+
+def _attach_owner(component, txn):
+    # Keyed by id() as transactions are not necessarily hashable.
+    owners = component.__dict__.get('_owners')
+    if owners is None:
+        owners = weakref.WeakValueDictionary()
+        object.__setattr__(component, '_owners', owners)
+    owners[id(txn)] = txn
 
 
 class TransactionInput(object):
@@ -39,26 +60,57 @@ class TransactionInput(object):
             tuple: First element of the tuple is the TransactionInput
                    object and the second is the remaining byte stream.
         """
-        outpoint = b[0:32]
-        outpoint_index, b1 = unpack_u32(b[32:])
-        script, b1 = Script.from_bytes(b1)
-        sequence_num, b1 = unpack_u32(b1)
+        inp, offset = TransactionInput.from_buffer(memoryview(b))
+        return inp, b[offset:]
+
+    @staticmethod
+    def from_buffer(buf, offset=0):
+        """ Deserializes a TransactionInput found at offset in buf.
+
+            Only the outpoint and script are copied out of buf, so
+            walking a large transaction does not copy the remainder of
+            the stream for every field.
+
+        Args:
+            buf (bytes or memoryview): buffer containing the input.
+            offset (int): position in buf at which the outpoint starts.
+
+        Returns:
+            tuple: First element of the tuple is the TransactionInput
+                   object and the second is the offset of the first
+                   byte after it.
+        """
+        outpoint = bytes(buf[offset:offset + 32])
+        outpoint_index, = struct.unpack_from('<I', buf, offset + 32)
+        raw_script, offset = unpack_var_str_from(buf, offset + 36)
+        sequence_num, = struct.unpack_from('<I', buf, offset)
 
         return (
             TransactionInput(Hash(outpoint),
                              outpoint_index,
-                             script,
+                             Script(raw_script),
                              sequence_num),
-            b1
+            offset + 4
         )
 
     def __init__(self, outpoint, outpoint_index, script, sequence_num):
         if not isinstance(outpoint, Hash):
             raise TypeError("outpoint must be a Hash object.")
-        self.outpoint = outpoint
-        self.outpoint_index = outpoint_index
-        self.script = script
-        self.sequence_num = sequence_num
+        # Bypass __setattr__: a new input has no owners to notify.
+        self.__dict__.update(outpoint=outpoint,
+                             outpoint_index=outpoint_index,
+                             script=script,
+                             sequence_num=sequence_num)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if '_owners' in self.__dict__ and name in ('outpoint', 'outpoint_index', 'script', 'sequence_num'):
+            _notify_owners(self, name != 'script')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_owners', None)
+        return state
 
     def get_addresses(self, testnet=False):
         """ Returns all addresses associated with the script in this input.
@@ -181,15 +233,39 @@ class TransactionOutput(object):
             tuple: First element of the tuple is a TransactionOutput,
                    the second is the remainder of the byte stream.
         """
-        value, b0 = unpack_u64(b)
-        script_len, b0 = unpack_compact_int(b0)
+        out, offset = TransactionOutput.from_buffer(memoryview(b))
+        return out, b[offset:]
 
-        return (TransactionOutput(value, Script(b0[:script_len])),
-                b0[script_len:])
+    @staticmethod
+    def from_buffer(buf, offset=0):
+        """ Deserializes a TransactionOutput found at offset in buf.
+
+        Args:
+            buf (bytes or memoryview): buffer containing the output.
+            offset (int): position in buf at which the value starts.
+
+        Returns:
+            tuple: First element of the tuple is a TransactionOutput,
+                   the second is the offset of the first byte after it.
+        """
+        value, = struct.unpack_from('<Q', buf, offset)
+        raw_script, offset = unpack_var_str_from(buf, offset + 8)
+
+        return (TransactionOutput(value, Script(raw_script)), offset)
 
     def __init__(self, value, script):
-        self.value = value
-        self.script = script
+        # Bypass __setattr__: a new output has no owners to notify.
+        self.__dict__.update(value=value, script=script)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if '_owners' in self.__dict__ and name in ('value', 'script'):
+            _notify_owners(self)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_owners', None)
+        return state
 
     def get_addresses(self, testnet=False):
         """ Returns all addresses associated with the script in this output.
@@ -253,6 +329,170 @@ class UnspentTransactionOutput(object):
         return self.num_confirmations >= 6
 
 
+class _ComponentList(list):
+    """ List of the inputs or outputs of a frozen transaction that
+        invalidates the transaction's cached serialization whenever it
+        is modified.
+    """
+
+    def __init__(self, txn, components):
+        super().__init__(components)
+        self._txn = weakref.ref(txn)
+        for c in self:
+            _attach_owner(c, txn)
+
+    def _changed(self):
+        txn = self._txn()
+        if txn is not None:
+            for c in self:
+                _attach_owner(c, txn)
+            txn._invalidate_cache()
+
+    def __reduce_ex__(self, protocol):
+        return (list, (list(self),))
+
+
+def _list_mutator(name):
+    method = getattr(list, name)
+
+    def mutator(self, *args, **kwargs):
+        rv = method(self, *args, **kwargs)
+        self._changed()
+        return rv
+
+    mutator.__name__ = name
+    return mutator
+
+
+for _name in ['__setitem__', '__delitem__', '__iadd__', '__imul__', 'append',
+              'extend', 'insert', 'pop', 'remove', 'clear', 'sort',
+              'reverse']:
+    setattr(_ComponentList, _name, _list_mutator(_name))
+
+
+def _sign_digest(key, digest):
+    """ Signs a signature hash with the raw private key key.
+
+        This is a module-level function taking only ints and bytes so
+        that it can be run by a process pool.
+    """
+    return crypto.PrivateKey(key).sign(digest, False)
+
+
+class _SigHasher(object):
+    """ Computes legacy (pre-segwit) signature hashes for the inputs
+        of a transaction without copying or re-serializing it.
+
+        The parts of the preimage that do not depend on the input
+        being signed are serialized once: every input with an empty
+        script (all of which are 41 bytes long, so input i starts at
+        offset 41 * i), the outputs and the lock time. Hash midstates
+        of the version, input count and the inputs preceding each
+        input are cached as they are computed, so only the signed
+        input, the inputs following it and the outputs are hashed for
+        each signature.
+
+    Args:
+        txn (Transaction): The transaction. The hasher must be
+            discarded if anything other than an input script of txn
+            changes.
+    """
+    BLANK_INPUT_LEN = 41
+    NULL_OUTPUT = pack_u64(0xffffffffffffffff) + pack_compact_int(0)
+
+    def __init__(self, txn):
+        self.version = pack_u32(txn.version)
+        self.num_inputs = len(txn.inputs)
+        self.outpoints = [bytes(i.outpoint) + pack_u32(i.outpoint_index)
+                          for i in txn.inputs]
+        self.sequences = [pack_u32(i.sequence_num) for i in txn.inputs]
+        self.outputs = [bytes(o) for o in txn.outputs]
+        self.lock_time = pack_u32(txn.lock_time)
+
+        # Inputs with empty scripts, as they appear in SIG_HASH_ALL
+        # preimages and with zeroed sequence numbers as they appear in
+        # SIG_HASH_NONE and SIG_HASH_SINGLE preimages.
+        empty = pack_compact_int(0)
+        self.blank_inputs = {
+            True: memoryview(b''.join([op + empty + seq for op, seq in
+                                       zip(self.outpoints, self.sequences)])),
+            False: memoryview((empty + pack_u32(0)).join(
+                self.outpoints + [b''])),
+        }
+        self.outputs_all = (pack_compact_int(len(self.outputs)) +
+                            b''.join(self.outputs) +
+                            self.lock_time)
+
+        prefix = hashlib.sha256(self.version +
+                                pack_compact_int(self.num_inputs))
+        self.midstates = {True: [prefix], False: [prefix]}
+
+    def _midstate(self, keep_sequences, input_index):
+        """ Returns a copy of the hash state after the version, the
+            input count and all inputs preceding input_index.
+        """
+        midstates = self.midstates[keep_sequences]
+        blanks = self.blank_inputs[keep_sequences]
+        n = self.BLANK_INPUT_LEN
+        while len(midstates) <= input_index:
+            i = len(midstates) - 1
+            h = midstates[-1].copy()
+            h.update(blanks[i * n:(i + 1) * n])
+            midstates.append(h)
+
+        return midstates[input_index].copy()
+
+    def sig_hash(self, input_index, hash_type, script):
+        """ Computes the signature hash of an input.
+
+        Args:
+            input_index (int): The index of the input.
+            hash_type (int): What kind of signature hash to do.
+            script (bytes): The serialized script to place in the input.
+
+        Returns:
+            bytes: The double SHA-256 of the signature hash preimage.
+        """
+        base_type = hash_type & 0x1f
+        if base_type == Transaction.SIG_HASH_SINGLE and \
+           input_index >= len(self.outputs):
+            # This is to deal with the bug where specifying an index
+            # that is out of range (wrt outputs) results in a
+            # signature hash of 0x1 (little-endian)
+            return 0x1.to_bytes(32, 'little')
+
+        this_input = (self.outpoints[input_index] +
+                      pack_var_str(script) +
+                      self.sequences[input_index])
+
+        if hash_type & Transaction.SIG_HASH_ANY:
+            # Only the input being signed is included
+            h = hashlib.sha256(self.version +
+                               pack_compact_int(1) +
+                               this_input)
+        else:
+            keep_sequences = base_type not in (Transaction.SIG_HASH_NONE,
+                                               Transaction.SIG_HASH_SINGLE)
+            h = self._midstate(keep_sequences, input_index)
+            h.update(this_input)
+            h.update(self.blank_inputs[keep_sequences]
+                     [(input_index + 1) * self.BLANK_INPUT_LEN:])
+
+        if base_type == Transaction.SIG_HASH_NONE:
+            h.update(pack_compact_int(0) + self.lock_time)
+        elif base_type == Transaction.SIG_HASH_SINGLE:
+            h.update(pack_compact_int(input_index + 1) +
+                     self.NULL_OUTPUT * input_index +
+                     self.outputs[input_index] +
+                     self.lock_time)
+        else:
+            h.update(self.outputs_all)
+
+        h.update(pack_u32(hash_type))
+
+        return hashlib.sha256(h.digest()).digest()
+
+
 class Transaction(object):
     """ See https://bitcoin.org/en/developer-reference#raw-transaction-format
 
@@ -273,6 +513,15 @@ class Transaction(object):
     SIG_HASH_SINGLE = 0x03
     SIG_HASH_ANY = 0x80
 
+    # Fields that are part of the serialized transaction
+    _SERIALIZED_FIELDS = ('version', 'inputs', 'outputs', 'lock_time')
+
+    # Cached serialization state, see freeze()
+    _frozen = False
+    _raw = None
+    _hash = None
+    _sig_hasher = None
+
     @staticmethod
     def from_bytes(b):
         """ Deserializes a byte stream into a Transaction.
@@ -284,42 +533,69 @@ class Transaction(object):
             tuple: First element of the tuple is the Transaction,
                    second is the remainder of the byte stream.
         """
+        txn, offset = Transaction.from_buffer(memoryview(b))
+        return txn, b[offset:]
+
+    @staticmethod
+    def from_buffer(buf, offset=0):
+        """ Deserializes a Transaction found at offset in buf.
+
+            The buffer is walked with an offset cursor rather than by
+            slicing off the consumed bytes, so parsing time is linear
+            in the size of the transaction regardless of the number of
+            inputs and outputs.
+
+        Args:
+            buf (bytes or memoryview): buffer containing the transaction.
+            offset (int): position in buf at which the version starts.
+
+        Returns:
+            tuple: First element of the tuple is the Transaction,
+                   second is the offset of the first byte after it.
+        """
         # First 4 bytes are version
-        version = struct.unpack('<I', b[:4])[0]
-        b1 = b[4:]
+        version, = struct.unpack_from('<I', buf, offset)
 
         # Work on inputs
-        num_inputs, b1 = unpack_compact_int(b1)
+        num_inputs, offset = unpack_compact_int_from(buf, offset + 4)
 
         inputs = []
         for i in range(num_inputs):
-            inp, b1 = TransactionInput.from_bytes(b1)
+            inp, offset = TransactionInput.from_buffer(buf, offset)
             inputs.append(inp)
 
         # Work on outputs
-        num_outputs, b1 = unpack_compact_int(b1)
+        num_outputs, offset = unpack_compact_int_from(buf, offset)
 
         outputs = []
         for o in range(num_outputs):
-            out, b1 = TransactionOutput.from_bytes(b1)
+            out, offset = TransactionOutput.from_buffer(buf, offset)
             outputs.append(out)
 
         # Lock time
-        lock_time = struct.unpack('<I', b1[:4])[0]
+        lock_time, = struct.unpack_from('<I', buf, offset)
 
-        return (Transaction(version, inputs, outputs, lock_time), b1[4:])
+        return (Transaction(version, inputs, outputs, lock_time), offset + 4)
 
     @staticmethod
-    def from_hex(h):
+    def from_hex(h, frozen=False):
         """ Deserializes a hex-ecnoded string into a Transaction.
 
         Args:
             h (str): hex-encoded string starting with the version.
+            frozen (bool): If True, the returned transaction is frozen
+                (see freeze()) and its serialization cache is seeded
+                with the decoded bytes, so the txid can be computed
+                without re-serializing.
 
         Returns:
             Transaction: the deserialized Transaction object.
         """
-        tx, _ = Transaction.from_bytes(bytes.fromhex(h))
+        b = bytes.fromhex(h)
+        tx, offset = Transaction.from_buffer(b)
+        if frozen:
+            tx.freeze()
+            tx._raw = b[:offset]
         return tx
 
     def __init__(self, version, inputs, outputs, lock_time):
@@ -328,6 +604,74 @@ class Transaction(object):
         self.outputs = outputs
         self.lock_time = lock_time
 
+    def __setattr__(self, name, value):
+        if self._frozen and name in self._SERIALIZED_FIELDS:
+            if name in ('inputs', 'outputs'):
+                value = _ComponentList(self, value)
+            super().__setattr__(name, value)
+            self._invalidate_cache()
+        else:
+            super().__setattr__(name, value)
+
+    def __getstate__(self):
+        # Copies (including those made by copy.deepcopy) and
+        # unpickled transactions are not frozen.
+        state = self.__dict__.copy()
+        for k in ('_frozen', '_raw', '_hash', '_sig_hasher'):
+            state.pop(k, None)
+        state['inputs'] = list(self.inputs)
+        state['outputs'] = list(self.outputs)
+        return state
+
+    @property
+    def frozen(self):
+        """ Whether the serialization and hash of this transaction are
+            being cached. See freeze().
+        """
+        return self._frozen
+
+    def freeze(self):
+        """ Caches the serialization and hash of this transaction.
+
+            Once frozen, bytes(), to_hex() and hash serialize and
+            double-hash the transaction at most once until it is
+            modified, and the invariant parts of signature hash
+            preimages are shared by all sign_input() and
+            verify_input_signature() calls. The cache is invalidated whenever the version,
+            lock time or input/output lists are changed, or a field of
+            any input or output (including its script) is assigned.
+            Script objects themselves are treated as immutable, so
+            replace an input's or output's script rather than
+            modifying it in place.
+
+        Returns:
+            Transaction: this transaction, to allow chaining.
+        """
+        if not self._frozen:
+            self._frozen = True
+            self.inputs = self.inputs
+            self.outputs = self.outputs
+        return self
+
+    def thaw(self):
+        """ Stops caching the serialization and hash of this transaction.
+
+        Returns:
+            Transaction: this transaction, to allow chaining.
+        """
+        if self._frozen:
+            self._frozen = False
+            self._invalidate_cache()
+            self.inputs = list(self.inputs)
+            self.outputs = list(self.outputs)
+        return self
+
+    def _invalidate_cache(self, sig_hash=True):
+        self._raw = None
+        self._hash = None
+        if sig_hash:
+            self._sig_hasher = None
+
     @property
     def num_inputs(self):
         """ The number of inputs in the transaction.
@@ -340,43 +684,35 @@ class Transaction(object):
         """
         return len(self.outputs)
 
-    def _copy_for_sig(self, input_index, hash_type, sub_script):
-        """ Returns a copy of this txn appropriate for signing, based
-            on hash_type.
+    def sig_hash(self, input_index, hash_type, sub_script):
+        """ Computes the signature hash of an input.
+
+            This is the double SHA-256 hash of the transaction as
+            modified according to hash_type, with the input's script
+            replaced by sub_script, followed by hash_type. See
+            https://en.bitcoin.it/wiki/OP_CHECKSIG.
+
+        Args:
+            input_index (int): The index of the input.
+            hash_type (int): What kind of signature hash to do.
+            sub_script (Script): the scriptPubKey of the corresponding
+                utxo being spent if the outpoint is P2PKH or the redeem
+                script if the outpoint is P2SH.
+
+        Returns:
+            bytes: The 32-byte message that is signed by the input's
+                signature(s).
         """
-        new_txn = copy.deepcopy(self)
+        if input_index < 0 or input_index >= len(self.inputs):
+            raise ValueError("Invalid input index.")
 
-        # First deal w/the inputs
+        hasher = self._sig_hasher
+        if hasher is None:
+            hasher = _SigHasher(self)
+            if self._frozen:
+                self._sig_hasher = hasher
 
-        # For the SIG_HASH_ANY case, we only care about
-        # self.inputs[input_index]
-        if hash_type == self.SIG_HASH_ANY:
-            ti = new_txn.inputs[input_index]
-            new_txn.inputs = [ti]
-        else:
-            for i, inp in enumerate(new_txn.inputs):
-                inp.script = sub_script if i == input_index else Script("")
-
-                if hash_type & 0x1f in [self.SIG_HASH_NONE, self.SIG_HASH_SINGLE] and input_index != i:
-                    # Sequence numbers (nSequence) must be set to 0 for all but
-                    # the input we care about.
-                    inp.sequence_num = 0
-
-        # Now deal with outputs
-
-        if hash_type & 0x1f == self.SIG_HASH_NONE:
-            new_txn.outputs = []
-        elif hash_type & 0x1f == self.SIG_HASH_SINGLE:
-            # Resize output vector to input_index + 1
-            new_txn.outputs = new_txn.outputs[:input_index+1]
-            # All outputs except outputs[i] have a value of -1 (0xffffffff)
-            # and a blank script
-            for i, out in enumerate(new_txn.outputs):
-                if i != input_index:
-                    out.script = Script("")
-                    out.value = 0xffffffff
-
-        return new_txn
+        return hasher.sig_hash(input_index, hash_type, bytes(sub_script))
 
     def _get_public_key_bytes(self, private_key, compressed=True):
         # In the case of extended keys (HDPublicKey), need to get
@@ -400,12 +736,61 @@ class Transaction(object):
                 utxo being spent if the outpoint is P2PKH or the redeem
                 script if the outpoint is P2SH.
         """
+        sig_info = self._prepare_input_sig(input_index, hash_type,
+                                           private_key, sub_script)
+        sig = private_key.sign(sig_info['message'], False)
+        self._apply_input_sig(sig_info, sig)
+
+        return True
+
+    def sign_inputs_batch(self, signing_requests, executor=None):
+        """ Signs several inputs, optionally computing the signatures
+            in parallel.
+
+            Signature hashes and key checks are done on the calling
+            thread; only the ECDSA signing operations are handed to
+            executor. Signatures are applied to the inputs in the order
+            of signing_requests once they have all been computed, so
+            the result does not depend on the order in which they
+            complete. Multiple requests for the same multisig input
+            are allowed.
+
+        Args:
+            signing_requests (list(tuple)): A list of (input_index,
+                hash_type, private_key, sub_script) tuples with the
+                same meaning as the arguments to sign_input().
+            executor (concurrent.futures.Executor): Executor on which
+                to compute the signatures, e.g. a ProcessPoolExecutor.
+                If None, signatures are computed on the calling thread.
+
+        Returns:
+            bool: True if all inputs were signed.
+        """
+        sig_infos = [self._prepare_input_sig(input_index, hash_type,
+                                             private_key, sub_script)
+                     for input_index, hash_type, private_key, sub_script
+                     in signing_requests]
+
+        keys = [int(r[2]) for r in signing_requests]
+        messages = [s['message'] for s in sig_infos]
+        if executor is None:
+            sigs = map(_sign_digest, keys, messages)
+        else:
+            sigs = executor.map(_sign_digest, keys, messages)
+
+        for sig_info, sig in zip(sig_infos, list(sigs)):
+            self._apply_input_sig(sig_info, sig)
+
+        return True
+
+    def _prepare_input_sig(self, input_index, hash_type, private_key,
+                           sub_script):
+        """ Checks that private_key can sign the input and computes
+            the message to sign.
+        """
         if input_index < 0 or input_index >= len(self.inputs):
             raise ValueError("Invalid input index.")
 
-        inp = self.inputs[input_index]
-
-        curr_script_sig = inp.script
         multisig = False
         multisig_params = None
         multisig_key_index = -1
@@ -418,14 +803,12 @@ class Transaction(object):
         tmp_script = sub_script.remove_op("OP_CODESEPARATOR")
 
         compressed = False
-        if hash_type & 0x1f == self.SIG_HASH_SINGLE and len(self.inputs) > len(self.outputs):
+        if hash_type & 0x1f == self.SIG_HASH_SINGLE and input_index >= len(self.outputs):
             # This is to deal with the bug where specifying an index
             # that is out of range (wrt outputs) results in a
             # signature hash of 0x1 (little-endian)
             msg_to_sign = 0x1.to_bytes(32, 'little')
         else:
-            txn_copy = self._copy_for_sig(input_index, hash_type, tmp_script)
-
             if multisig:
                 # Determine which of the public keys this private key
                 # corresponds to.
@@ -460,29 +843,39 @@ class Transaction(object):
                 if h160 is None:
                     raise ValueError("Address derived from private key does not match sub_script!")
 
-            msg_to_sign = bytes(Hash.dhash(bytes(txn_copy) +
-                                           pack_u32(hash_type)))
+            msg_to_sign = self.sig_hash(input_index, hash_type, tmp_script)
+
+        return dict(input_index=input_index,
+                    hash_type=hash_type,
+                    message=msg_to_sign,
+                    multisig=multisig,
+                    multisig_key_index=multisig_key_index,
+                    pub_key_bytes=None if multisig else
+                    self._get_public_key_bytes(private_key, compressed),
+                    sub_script=tmp_script)
 
-        sig = private_key.sign(msg_to_sign, False)
+    def _apply_input_sig(self, sig_info, sig):
+        """ Builds the signature script for an input prepared by
+            _prepare_input_sig() using the signature sig.
+        """
+        inp = self.inputs[sig_info['input_index']]
+        hash_type = sig_info['hash_type']
 
-        if multisig:
+        if sig_info['multisig']:
             # For multisig, we need to determine if there are already
             # signatures and if so, where we insert this signature
-            inp.script = self._do_multisig_script([dict(index=multisig_key_index,
-                                                        signature=sig)],
-                                                  msg_to_sign,
-                                                  curr_script_sig,
-                                                  tmp_script,
-                                                  hash_type)
+            inp.script = self._do_multisig_script(
+                [dict(index=sig_info['multisig_key_index'], signature=sig)],
+                sig_info['message'],
+                inp.script,
+                sig_info['sub_script'],
+                hash_type)
         else:
-            pub_key_bytes = self._get_public_key_bytes(private_key, compressed)
-            pub_key_str = pack_var_str(pub_key_bytes)
+            pub_key_str = pack_var_str(sig_info['pub_key_bytes'])
             script_sig = pack_var_str(
                 sig.to_der() + pack_compact_int(hash_type)) + pub_key_str
             inp.script = Script(script_sig)
 
-        return True
-
     def _do_multisig_script(self, sigs, message, current_script_sig,
                             redeem_script, hash_type):
         # If the current script is empty or None, create it
@@ -587,6 +980,41 @@ class Transaction(object):
 
         return rv
 
+    def verify_all_inputs(self, sub_scripts):
+        """ Verifies the signatures for all inputs.
+
+            The signatures of P2PKH inputs are verified together in a
+            single batch, sharing the parsed public keys of inputs that
+            spend from the same address. Multi-sig inputs are verified
+            as in verify_input_signature().
+
+        Args:
+            sub_scripts (list(Script)): The script of the outpoint
+                spent by each input, in input order.
+
+        Returns:
+            bool: True if all inputs are verified, False otherwise.
+        """
+        if len(sub_scripts) != len(self.inputs):
+            raise ValueError("There must be exactly one sub_script per input.")
+
+        items = []
+        pub_keys = {}
+        for i, sub_script in enumerate(sub_scripts):
+            sig_script = self.inputs[i].script
+            if sig_script.is_multisig_sig():
+                if not self._verify_p2sh_multisig_input(i, sub_script):
+                    return False
+            elif sub_script.is_p2pkh():
+                hash_ok, item = self._p2pkh_verify_item(i, sub_script, pub_keys)
+                if not hash_ok:
+                    return False
+                items.append(item)
+            else:
+                return False
+
+        return all(crypto.PublicKey.verify_batch(items, False))
+
     def verify_partial_multisig(self, input_index, sub_script):
         """ Verifies a partially signed multi-sig input.
 
@@ -603,6 +1031,28 @@ class Transaction(object):
         return self._verify_p2sh_multisig_input(input_index, sub_script, True)
 
     def _verify_p2pkh_input(self, input_index, sub_script):
+        rv, (tx_digest, sig, pub_key) = self._p2pkh_verify_item(input_index,
+                                                                sub_script)
+        rv &= pub_key.verify(tx_digest, sig, False)
+
+        return rv
+
+    def _p2pkh_verify_item(self, input_index, sub_script, pub_keys=None):
+        """ Checks the public key of a P2PKH input against sub_script
+            and returns what remains to be verified.
+
+        Args:
+            input_index (int): The index of the input to verify.
+            sub_script (Script): The P2PKH script in the corresponding
+                outpoint.
+            pub_keys (dict): Optional cache of parsed public keys,
+                keyed by their serialized bytes.
+
+        Returns:
+            tuple: A bool that is True if the public key hash matches
+                sub_script, and a (digest, signature, public_key) tuple
+                for OP_CHECKSIG.
+        """
         if not sub_script.is_p2pkh():
             raise TypeError("sub_script is not a P2PKH script!")
 
@@ -621,7 +1071,13 @@ class Transaction(object):
 
         # OP_HASH160
         pub_key_bytes = stack.pop()
-        pub_key = crypto.PublicKey.from_bytes(pub_key_bytes)
+        if pub_keys is None:
+            pub_key = crypto.PublicKey.from_bytes(pub_key_bytes)
+        else:
+            pub_key = pub_keys.get(pub_key_bytes)
+            if pub_key is None:
+                pub_key = crypto.PublicKey.from_bytes(pub_key_bytes)
+                pub_keys[pub_key_bytes] = pub_key
         # Was it compressed?
         compressed = pub_key_bytes[0] in [0x02, 0x03]
         hash160 = pub_key.hash160(compressed=compressed)
@@ -636,18 +1092,10 @@ class Transaction(object):
         script_sig_complete = stack.pop()
         script_sig, hash_type = script_sig_complete[:-1], script_sig_complete[-1]
 
-        # Re-create txn for sig verification
-        txn_copy_bytes = bytes(self._copy_for_sig(input_index,
-                                                  hash_type,
-                                                  sub_script))
-
-        # Now verify
         sig = crypto.Signature.from_der(script_sig)
-        msg = txn_copy_bytes + pack_u32(hash_type)
-        tx_digest = hashlib.sha256(msg).digest()
-        rv &= pub_key.verify(tx_digest, sig)
+        tx_digest = self.sig_hash(input_index, hash_type, sub_script)
 
-        return rv
+        return rv, (tx_digest, sig, pub_key)
 
     def _verify_p2sh_multisig_input(self, input_index, sub_script,
                                     partial=False):
@@ -679,12 +1127,7 @@ class Transaction(object):
         redeem_script = sig_info['redeem_script']
         redeem_script_h160 = redeem_script.hash160()
 
-        # Re-create txn for sig verification
-        txn_copy_bytes = bytes(self._copy_for_sig(input_index,
-                                                  hash_type,
-                                                  redeem_script))
-        msg = txn_copy_bytes + pack_u32(hash_type)
-        txn_digest = hashlib.sha256(msg).digest()
+        txn_digest = self.sig_hash(input_index, hash_type, redeem_script)
 
         sub_script_h160 = bytes.fromhex(sub_script.get_hash160()[2:])
         rv = redeem_script_h160 == sub_script_h160
@@ -748,7 +1191,7 @@ class Transaction(object):
         for sig in sigs:
             matched_any = False
             for i, pub_key in enumerate(public_keys[last_match+1:]):
-                if pub_key.verify(txn_digest, sig):
+                if pub_key.verify(txn_digest, sig, False):
                     last_match = i
                     match_count += 1
                     matched_any = True
@@ -821,6 +1264,14 @@ class Transaction(object):
         Returns:
             b (bytes): The serialized transaction.
         """
+        if not self._frozen:
+            return self._to_bytes()
+
+        if self._raw is None:
+            self._raw = self._to_bytes()
+        return self._raw
+
+    def _to_bytes(self):
         return (
             pack_u32(self.version) +                      # Version
             pack_compact_int(self.num_inputs) +           # Input count
@@ -837,7 +1288,12 @@ class Transaction(object):
         Returns:
             dhash (bytes): Double SHA-256 hash of the serialized transaction.
         """
-        return Hash.dhash(bytes(self))
+        if not self._frozen:
+            return Hash.dhash(bytes(self))
+
+        if self._hash is None:
+            self._hash = Hash.dhash(bytes(self))
+        return self._hash
 
     def to_hex(self):
         """ Generates a hex encoding of the serialized transaction.
@@ -7,6 +7,8 @@ import random
 import struct
 import os
 
+from two1.lib.bitcoin.exceptions import DeserializationError
+
 """ This module provides a number of utility/helper functions that are
     commonly used with Bitcoin related objects. Primarily, the module
     provides functionality for serializing and deserializing various
@@ -136,6 +138,32 @@ def unpack_compact_int(bytestr):
         return None
 
 
+def unpack_compact_int_from(b, offset=0):
+    """ Deserializes a compact-size integer found at offset in b.
+
+        Unlike unpack_compact_int(), the remainder of the byte stream
+        is not copied: the caller advances through b using the
+        returned offset.
+
+    Args:
+        b (bytes or memoryview): buffer containing the serialized integer.
+        offset (int): position in b at which the integer starts.
+
+    Returns:
+        (n, offset) (tuple): A tuple containing the deserialized integer
+                             and the offset of the first byte after it.
+    """
+    b0 = b[offset]
+    if b0 < 0xfd:
+        return (b0, offset + 1)
+    elif b0 == 0xfd:
+        return (struct.unpack_from('<H', b, offset + 1)[0], offset + 3)
+    elif b0 == 0xfe:
+        return (struct.unpack_from('<I', b, offset + 1)[0], offset + 5)
+    else:
+        return (struct.unpack_from('<Q', b, offset + 1)[0], offset + 9)
+
+
 def pack_u32(i):
     """ Serializes a 32-bit integer into little-endian form.
 
@@ -215,6 +243,29 @@ def unpack_var_str(b):
     return (b0[:strlen], b0[strlen:])
 
 
+def unpack_var_str_from(b, offset=0):
+    """ Deserializes a variable length byte stream found at offset in b.
+
+        Only the returned string is copied out of b.
+
+    Args:
+        b (bytes or memoryview): buffer containing the variable length
+            byte stream.
+        offset (int): position in b at which the length prefix starts.
+
+    Returns:
+        (s, offset) (tuple): A tuple containing the variable length byte
+                             stream and the offset of the first byte
+                             after it.
+    """
+    strlen, offset = unpack_compact_int_from(b, offset)
+    end = offset + strlen
+    if end > len(b):
+        raise DeserializationError(
+            "Not enough bytes to unpack a %d byte string." % strlen)
+    return (bytes(b[offset:end]), end)
+
+
 def bits_to_target(bits):
     """ Decodes the full target from a compact representation.
         See: https://bitcoin.org/en/developer-reference#target-nbits
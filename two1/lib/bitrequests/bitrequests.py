@@ -67,6 +67,17 @@ class BitRequests(object):
         """
         raise NotImplementedError()
 
+    def release_402_payment(self, payment_headers):
+        """Release a payment that the API server rejected.
+
+        Does nothing by default; subclasses whose payments set funds aside
+        override it.
+
+        Args:
+            payment_headers (dict): headers returned by `make_402_payment()`.
+        """
+        pass
+
     def get_402_info(self, url):
         """Method for retrieving 402 metadata associated with the resource.
 
@@ -125,6 +136,9 @@ class BitRequests(object):
         if paid_response.status_code == requests.codes.ok:
             logger.debug('[BitRequests] Successfully purchased resource.')
         else:
+            if paid_response.status_code in (requests.codes.bad_request,
+                                             requests.codes.payment_required):
+                self.release_402_payment(payment_headers)
             if 'detail' in paid_response.text:
                 raise ValueError(paid_response.json()["detail"])
             logger.debug('[BitRequests] Could not purchase resource.')
@@ -264,6 +278,10 @@ class OnChainRequests(BitRequests):
             'Return-Wallet-Address': return_address
         }
 
+    def release_402_payment(self, payment_headers):
+        """Release the UTXOs spent by a rejected on-chain payment."""
+        self.wallet.release_transaction(payment_headers['Bitcoin-Transaction'])
+
     def get_402_info(self, url):
         """Get on-chain payment information about the resource."""
         headers = requests.get(url).headers
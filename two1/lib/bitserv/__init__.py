@@ -1,4 +1,5 @@
 from .payment_server import PaymentServer
 from .payment_server import PaymentServerError
 from .payment_methods import OnChain, PaymentChannel, BitTransfer
+from .payment_methods import HeaderCache, PayoutAddress
 from .models import DatabaseDjango, OnChainDjango
@@ -21,20 +21,25 @@ class Payment:
 
     """Class to store merchant settings."""
 
-    def __init__(self, wallet, allowed_methods=None):
+    def __init__(self, wallet, allowed_methods=None, rotate_address=None):
         """Configure bitserv settings.
 
         Args:
             wallet (two1.lib.wallet.Wallet): The merchant's wallet instance.
+            rotate_address (float): seconds between asking the wallet for a
+                new payout address, or None to keep the first one.
         """
         from .models import PaymentChannel, PaymentChannelSpend, BlockchainTransaction
         if allowed_methods is None:
             pc_db = bitserv.DatabaseDjango(PaymentChannel, PaymentChannelSpend)
             self.server = bitserv.PaymentServer(wallet, pc_db)
-            self.allowed_methods = [
+            payout = bitserv.PayoutAddress(wallet, rotate_address)
+            allowed_methods = [
                 bitserv.PaymentChannel(self.server, '/payments/channel'),
-                bitserv.OnChain(wallet, bitserv.OnChainDjango(BlockchainTransaction)),
-                bitserv.BitTransfer(wallet)]
+                bitserv.OnChain(wallet, bitserv.OnChainDjango(BlockchainTransaction),
+                                payout=payout),
+                bitserv.BitTransfer(wallet, payout=payout)]
+        self.allowed_methods = allowed_methods
 
     def required(self, price, **kwargs):
         """API route decorator to request payment for a resource.
@@ -50,7 +55,7 @@ class Payment:
                 nonlocal price
                 _price = price(request) if callable(price) else price
                 # Need better way to pass server url to payment methods (FIXME)
-                kwargs.update({'server_url': request.scheme + '://' + request.get_host()})
+                _kwargs = dict(kwargs, server_url=request.scheme + '://' + request.get_host())
 
                 # Convert from django META object to normal header format
                 headers = {}
@@ -60,14 +65,13 @@ class Payment:
                         headers[header] = v
 
                 # Continue to the API view if payment is valid or price is 0
-                if _price == 0 or self.is_valid_payment(_price, headers, **kwargs):
+                if _price == 0 or self.is_valid_payment(_price, headers, **_kwargs):
                     return fn(request, *fn_args, **fn_kwargs)
                 else:
                     # Get headers for initial 402 response
-                    payment_headers = {}
-                    for method in self.allowed_methods:
-                        payment_headers.update(method.get_402_headers(_price, **kwargs))
-                    return PaymentRequiredResponse(headers=payment_headers)
+                    return PaymentRequiredResponse(
+                        headers=payment_headers.get(_price, **_kwargs))
+            payment_headers = bitserv.HeaderCache(self.allowed_methods)
             return _fn
         return decorator
 
@@ -75,7 +75,7 @@ class ChannelViewSet(ViewSet):
                 return Response()
             elif 'payment_tx' in params:
                 # Receive a payment in the channel using the received payment
-                payment_tx = Transaction.from_hex(params['payment_tx'])
+                payment_tx = Transaction.from_hex(params['payment_tx'], frozen=True)
                 payment.server.receive_payment(pk, payment_tx)
                 return Response({'payment_txid': str(payment_tx.hash)})
             else:
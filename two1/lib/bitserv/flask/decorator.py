@@ -1,5 +1,4 @@
 """Flask bitserv payment library for selling 402 API endpoints."""
-from urllib.parse import urlparse
 from functools import wraps
 from flask import jsonify, request
 from flask.views import MethodView
@@ -10,6 +9,7 @@ from two1.lib.bitcoin import Transaction
 from two1.lib.bitcoin.utils import bytes_to_str
 
 from ..payment_methods import OnChain, PaymentChannel, BitTransfer
+from ..payment_methods import HeaderCache, PayoutAddress
 from ..payment_server import PaymentServer
 
 
@@ -19,11 +19,11 @@ class PaymentRequiredException(HTTPException):
 
     code = 402
 
-    def get_body(self, context):
+    def get_body(self, environ=None, scope=None):
         """402 response body."""
         return 'Payment Required'
 
-    def get_headers(self, context):
+    def get_headers(self, environ=None, scope=None):
         """402 response headers."""
         payment_headers = self.description
         return payment_headers
@@ -33,18 +33,22 @@ class Payment:
 
     """Class to store merchant settings."""
 
-    def __init__(self, app, wallet, allowed_methods=None):
+    def __init__(self, app, wallet, allowed_methods=None, rotate_address=None):
         """Configure bitserv settings.
 
         Args:
             app (flask.Flask): A flask app to wrap payment handling around.
             wallet (two1.lib.wallet.Wallet): The merchant's wallet instance.
+            rotate_address (float): seconds between asking the wallet for a
+                new payout address, or None to keep the first one.
         """
         if allowed_methods is None:
-            self.allowed_methods = [
+            payout = PayoutAddress(wallet, rotate_address)
+            allowed_methods = [
                 PaymentChannel(*flask_channel_adapter(app, PaymentServer(wallet))),
-                OnChain(wallet),
-                BitTransfer(wallet)]
+                OnChain(wallet, payout=payout),
+                BitTransfer(wallet, payout=payout)]
+        self.allowed_methods = allowed_methods
 
     def required(self, price, **kwargs):
         """API route decorator to request payment for a resource.
@@ -60,18 +64,15 @@ class Payment:
                 nonlocal price
                 _price = price(request) if callable(price) else price
                 # Need better way to pass server url to payment methods (FIXME)
-                url = urlparse(request.url_root)
-                kwargs.update({'server_url': url.scheme + '://' + url.netloc})
+                _kwargs = dict(kwargs, server_url=request.scheme + '://' + request.host)
 
                 # Continue to the API view if payment is valid or price is 0
-                if _price == 0 or self.is_valid_payment(_price, request.headers, **kwargs):
+                if _price == 0 or self.is_valid_payment(_price, request.headers, **_kwargs):
                     return fn(*fn_args, **fn_kwargs)
                 else:
                     # Get headers for initial 402 response
-                    payment_headers = {}
-                    for method in self.allowed_methods:
-                        payment_headers.update(method.get_402_headers(_price, **kwargs))
-                    raise PaymentRequiredException(payment_headers)
+                    raise PaymentRequiredException(headers.get(_price, **_kwargs))
+            headers = HeaderCache(self.allowed_methods)
             return _fn
         return decorator
 
@@ -167,7 +168,7 @@ class Channel(MethodView):
                 return jsonify()
             elif 'payment_tx' in params:
                 # Receive a payment in the channel using the received payment
-                payment_tx = Transaction.from_hex(params['payment_tx'])
+                payment_tx = Transaction.from_hex(params['payment_tx'], frozen=True)
                 self.server.receive_payment(deposit_txid, payment_tx)
                 return jsonify({'payment_txid': str(payment_tx.hash)})
             else:
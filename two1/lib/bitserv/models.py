@@ -1,7 +1,10 @@
 """"""
 import time
 import codecs
+import queue
 import sqlite3
+import threading
+from concurrent.futures import Future
 from two1.lib.bitcoin import Transaction
 
 
@@ -95,9 +98,9 @@ class ChannelDjango(ChannelDatabase):
     def lookup(self, deposit_txid):
         """Look up a payment channel entry by deposit txid."""
         rv = self.Channel.objects.get(deposit_txid=deposit_txid)
-        deposit_tx = Transaction.from_hex(rv.deposit_tx) if rv.deposit_tx else None
-        payment_tx = Transaction.from_hex(rv.payment_tx) if rv.payment_tx else None
-        refund_tx = Transaction.from_hex(rv.refund_tx) if rv.refund_tx else None
+        deposit_tx = Transaction.from_hex(rv.deposit_tx, frozen=True) if rv.deposit_tx else None
+        payment_tx = Transaction.from_hex(rv.payment_tx, frozen=True) if rv.payment_tx else None
+        refund_tx = Transaction.from_hex(rv.refund_tx, frozen=True) if rv.refund_tx else None
         return {'deposit_txid': rv.deposit_txid, 'state': rv.state,
                 'deposit_tx': deposit_tx, 'payment_tx': payment_tx,
                 'refund_tx': refund_tx, 'merchant_pubkey': rv.merchant_pubkey,
@@ -115,10 +118,15 @@ class ChannelDjango(ChannelDatabase):
         return True
 
     def update_payment(self, deposit_txid, payment_tx, pmt_amt):
-        """Update a payment channel with a new payment transaction."""
-        self.Channel.objects.get(deposit_txid=deposit_txid).update(
-            payment_tx=payment_tx, last_payment_amount=pmt_amt)
-        return True
+        """Update a payment channel with a new payment transaction.
+
+        The channel is only updated if `pmt_amt` is greater than its last
+        payment amount; returns whether it was.
+        """
+        updated = self.Channel.objects.filter(
+            deposit_txid=deposit_txid, last_payment_amount__lt=pmt_amt).update(
+            payment_tx=payment_tx.to_hex(), last_payment_amount=pmt_amt)
+        return updated > 0
 
     def update_state(self, deposit_txid, new_state):
         """Update payment channel state."""
@@ -142,7 +150,7 @@ class PaymentDjango(ChannelDatabase):
         """Look up a payment entry by deposit txid."""
         rv = self.Payment.objects.get(payment_txid=payment_txid)
         return {'payment_txid': rv.payment_txid,
-                'payment_tx': Transaction.from_hex(rv.payment_tx),
+                'payment_tx': Transaction.from_hex(rv.payment_tx, frozen=True),
                 'amount': rv.amount, 'is_redeemed': rv.is_redeemed,
                 'deposit_txid': rv.deposit_txid}
 
@@ -152,31 +160,198 @@ class PaymentDjango(ChannelDatabase):
         return True
 
 
-class DatabaseSQLite3:
+class _SQLite3Store:
+
+    """Thread-safe access to an SQLite3 database.
+
+    The database is put in WAL mode, so reads never wait on writes. Reads
+    run on a pool of connections, one per concurrently reading thread. All
+    writes go through a single writer thread (see _SQLite3Writer) that
+    commits the writes of many concurrent requests in one transaction, and
+    only returns to each request once its writes are on disk.
+
+    Note: THIS IS NOT A PUBLIC API.
+    """
+
+    # Number of idle read connections kept open for reuse
+    MAX_IDLE_CONNECTIONS = 16
+    # Seconds a connection waits for a lock held by another connection
+    BUSY_TIMEOUT = 10
+
+    def __init__(self, db='payment.sqlite3'):
+        self.db = db
+        self._idle = queue.LifoQueue()
+        # An in-memory database only exists for the connection that created
+        # it, so the writer's connection is used for reads as well.
+        self._in_memory = (db == ':memory:')
+        self._writer = _SQLite3Writer(self._connect)
+
+    def _connect(self):
+        """Open a connection to the database."""
+        connection = sqlite3.connect(self.db, timeout=self.BUSY_TIMEOUT,
+                                     check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        # In WAL mode this syncs the log on every commit, which makes each
+        # acknowledged write durable.
+        connection.execute('PRAGMA synchronous=FULL')
+        return connection
+
+    def read(self, func):
+        """Run func with a cursor on a read connection.
+
+        Args:
+            func (function): function taking a sqlite3.Cursor.
+
+        Returns:
+            The return value of func.
+        """
+        if self._in_memory:
+            return self._writer.submit(func)
+
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            connection = self._connect()
+
+        try:
+            return func(connection.cursor())
+        finally:
+            if self._idle.qsize() < self.MAX_IDLE_CONNECTIONS:
+                self._idle.put(connection)
+            else:
+                connection.close()
+
+    def write(self, func):
+        """Run func with a cursor on the writer's connection and commit.
+
+        func runs in a transaction shared with the writes of other requests.
+        If it raises, only its own changes are rolled back and the exception
+        is raised here.
+
+        Args:
+            func (function): function taking a sqlite3.Cursor.
+
+        Returns:
+            The return value of func, once it has been committed.
+        """
+        return self._writer.submit(func)
+
+    def close(self):
+        """Stop the writer and close all connections."""
+        self._writer.close()
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class DatabaseSQLite3(_SQLite3Store):
 
     """Default payment channel data bindings when no data service is provided."""
 
     def __init__(self, db='payment.sqlite3'):
-        self.connection = sqlite3.connect(db, check_same_thread=False)
-        self.c = self.connection.cursor()
+        super().__init__(db)
         self.pc = ChannelSQLite3(self)
         self.pmt = PaymentSQLite3(self)
 
 
+class _SQLite3Writer:
+
+    """Group-commit writer for DatabaseSQLite3.
+
+    Write requests are queued and run by a single thread, so writers never
+    contend for the database lock. Every request that queued up while the
+    previous transaction was being committed is run in the next transaction,
+    each in its own savepoint. That costs one sync to disk per batch rather
+    than one per request.
+
+    Note: THIS IS NOT A PUBLIC API.
+    """
+
+    # Maximum number of requests committed in one transaction
+    MAX_BATCH = 256
+
+    def __init__(self, connect):
+        self._connection = connect()
+        # Transactions are started and ended explicitly.
+        self._connection.isolation_level = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, func):
+        """Queue func to run in the next transaction and wait for its commit."""
+        future = Future()
+        self._queue.put((func, future))
+        return future.result()
+
+    def close(self):
+        """Commit the queued requests and stop the writer thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        c = self._connection.cursor()
+
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while len(batch) < self.MAX_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [r for r in batch if r is not None]
+            if batch:
+                self._commit(c, batch)
+
+        self._connection.close()
+
+    def _commit(self, c, batch):
+        """Run a batch of requests in one transaction and resolve their futures."""
+        results = []
+        try:
+            c.execute('BEGIN IMMEDIATE')
+            for func, future in batch:
+                c.execute('SAVEPOINT request')
+                try:
+                    results.append((future, func(c), None))
+                except Exception as e:
+                    c.execute('ROLLBACK TO request')
+                    results.append((future, None, e))
+                c.execute('RELEASE request')
+            c.execute('COMMIT')
+        except Exception as e:
+            if c.connection.in_transaction:
+                c.execute('ROLLBACK')
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
 # *************************** Default SQLite3 ****************************** #
 
 class ChannelSQLite3(ChannelDatabase):
 
     def __init__(self, db):
         """Instantiate SQLite3 for storing channel transaction data."""
-        self.c = db.c
-        self.connection = db.connection
-        self.c.execute("CREATE TABLE IF NOT EXISTS 'payment_channel' "
-                       "(deposit_txid text unique, state text,"
-                       "deposit_tx text, payment_tx text, refund_tx text, "
-                       "merchant_pubkey text, created_at timestamp, "
-                       "expires_at timestamp, amount integer, "
-                       "last_payment_amount integer)")
+        self.db = db
+        self.db.write(lambda c: c.execute(
+            "CREATE TABLE IF NOT EXISTS 'payment_channel' "
+            "(deposit_txid text unique, state text,"
+            "deposit_tx text, payment_tx text, refund_tx text, "
+            "merchant_pubkey text, created_at timestamp, "
+            "expires_at timestamp, amount integer, "
+            "last_payment_amount integer)"))
 
     def create(self, refund_tx, merch_pubkey):
         """Create a payment channel entry."""
@@ -186,21 +361,21 @@ class ChannelSQLite3(ChannelDatabase):
         expiry = refund_tx.lock_time
         mp = codecs.encode(merch_pubkey.compressed_bytes, 'hex_codec').decode()
         insert = 'INSERT INTO payment_channel VALUES (?' + ',?' * 9 + ')'
-        self.c.execute(insert, (deposit_txid, state, None, None,
-                                refund_tx.to_hex(), mp, now, expiry, 0, 0))
-        self.connection.commit()
+        row = (deposit_txid, state, None, None, refund_tx.to_hex(), mp, now,
+               expiry, 0, 0)
+        self.db.write(lambda c: c.execute(insert, row))
         return True
 
     def lookup(self, deposit_txid):
         """Look up a payment channel entry by deposit txid."""
         select = 'SELECT * FROM payment_channel WHERE deposit_txid=?'
-        self.c.execute(select, (deposit_txid,))
-        rv = self.c.fetchone()
+        rv = self.db.read(
+            lambda c: c.execute(select, (deposit_txid,)).fetchone())
         if rv is None:
             raise ModelNotFound()
-        deposit_tx = Transaction.from_hex(rv[2]) if rv[2] else None
-        payment_tx = Transaction.from_hex(rv[3]) if rv[3] else None
-        refund_tx = Transaction.from_hex(rv[4]) if rv[4] else None
+        deposit_tx = Transaction.from_hex(rv[2], frozen=True) if rv[2] else None
+        payment_tx = Transaction.from_hex(rv[3], frozen=True) if rv[3] else None
+        refund_tx = Transaction.from_hex(rv[4], frozen=True) if rv[4] else None
         return {'deposit_txid': rv[0], 'state': rv[1],
                 'deposit_tx': deposit_tx, 'payment_tx': payment_tx,
                 'refund_tx': refund_tx, 'merchant_pubkey': rv[5],
@@ -209,31 +384,37 @@ class ChannelSQLite3(ChannelDatabase):
 
     def update_deposit(self, deposit_txid, deposit_tx, amount):
         """Update a payment channel with the deposit transaction."""
-        # Make sure there isn't already a deposit in this channel
         select = 'SELECT deposit_tx FROM payment_channel WHERE deposit_txid=?'
-        self.c.execute(select, (deposit_txid,))
-        deposit = self.c.fetchone()[0]
-        if deposit is not None:
-            raise DuplicateRequestError()
-        # Update the channel with the new deposit
         update = ('UPDATE payment_channel SET deposit_tx=?, amount=? '
                   'WHERE deposit_txid=?')
-        self.c.execute(update, (deposit_tx.to_hex(), amount, deposit_txid))
-        self.connection.commit()
+
+        def _update_deposit(c):
+            # Make sure there isn't already a deposit in this channel
+            deposit = c.execute(select, (deposit_txid,)).fetchone()[0]
+            if deposit is not None:
+                raise DuplicateRequestError()
+            # Update the channel with the new deposit
+            c.execute(update, (deposit_tx.to_hex(), amount, deposit_txid))
+
+        self.db.write(_update_deposit)
         return True
 
     def update_payment(self, deposit_txid, payment_tx, pmt_amt):
-        """Update a payment channel with a new payment transaction."""
+        """Update a payment channel with a new payment transaction.
+
+        The channel is only updated if `pmt_amt` is greater than its last
+        payment amount; returns whether it was.
+        """
         update = ('UPDATE payment_channel SET payment_tx=?,'
-                  'last_payment_amount=? WHERE deposit_txid=?')
-        self.c.execute(update, (payment_tx.to_hex(), pmt_amt, deposit_txid))
-        return True
+                  'last_payment_amount=? WHERE deposit_txid=? '
+                  'AND last_payment_amount<?')
+        row = (payment_tx.to_hex(), pmt_amt, deposit_txid, pmt_amt)
+        return self.db.write(lambda c: c.execute(update, row).rowcount) > 0
 
     def update_state(self, deposit_txid, new_state):
         """Update payment channel state."""
         update = 'UPDATE payment_channel SET state=? WHERE deposit_txid=?'
-        self.c.execute(update, (new_state, deposit_txid))
-        self.connection.commit()
+        self.db.write(lambda c: c.execute(update, (new_state, deposit_txid)))
         return True
 
 
@@ -241,30 +422,38 @@ class PaymentSQLite3(PaymentDatabase):
 
     def __init__(self, db):
         """Instantiate SQLite3 for storing channel payment data."""
-        self.c = db.c
-        self.connection = db.connection
-        self.c.execute("CREATE TABLE IF NOT EXISTS 'payment_channel_spend' "
-                       "(payment_txid text unique, payment_tx text, "
-                       "amount integer, is_redeemed integer, "
-                       "deposit_txid text)")
+        self.db = db
+
+        def _create_tables(c):
+            c.execute("CREATE TABLE IF NOT EXISTS 'payment_channel_spend' "
+                      "(payment_txid text unique, payment_tx text, "
+                      "amount integer, is_redeemed integer, "
+                      "deposit_txid text)")
+            # payment_txid (like payment_channel's deposit_txid) is already
+            # indexed by its unique constraint.
+            c.execute("CREATE INDEX IF NOT EXISTS "
+                      "'payment_channel_spend_deposit_txid' ON "
+                      "'payment_channel_spend' (deposit_txid)")
+
+        self.db.write(_create_tables)
 
     def create(self, deposit_txid, payment_tx, amount):
         """Create a payment entry."""
         insert = 'INSERT INTO payment_channel_spend VALUES (?,?,?,?,?)'
-        self.c.execute(insert, (str(payment_tx.hash), payment_tx.to_hex(),
-                                amount, 0, deposit_txid))
-        self.connection.commit()
+        row = (str(payment_tx.hash), payment_tx.to_hex(), amount, 0,
+               deposit_txid)
+        self.db.write(lambda c: c.execute(insert, row))
         return True
 
     def lookup(self, payment_txid):
         """Look up a payment entry by deposit txid."""
         select = 'SELECT * FROM payment_channel_spend WHERE payment_txid=?'
-        self.c.execute(select, (payment_txid,))
-        rv = self.c.fetchone()
+        rv = self.db.read(
+            lambda c: c.execute(select, (payment_txid,)).fetchone())
         if rv is None:
             raise ModelNotFound()
         return {'payment_txid': rv[0],
-                'payment_tx': Transaction.from_hex(rv[1]),
+                'payment_tx': Transaction.from_hex(rv[1], frozen=True),
                 'amount': rv[2], 'is_redeemed': (rv[3] == 1),
                 'deposit_txid': rv[4]}
 
@@ -272,8 +461,7 @@ class PaymentSQLite3(PaymentDatabase):
         """Update payment entry to be redeemed."""
         update = ('UPDATE payment_channel_spend SET is_redeemed=? '
                   'WHERE payment_txid=?')
-        self.c.execute(update, (1, payment_txid))
-        self.connection.commit()
+        self.db.write(lambda c: c.execute(update, (1, payment_txid)))
         return True
 
 
@@ -287,12 +475,16 @@ class OnChainError(Exception):
     pass
 
 
+class DuplicateTransactionError(OnChainError):
+    pass
+
+
 class OnChainDatabase:
 
     def __init__(self):
         pass
 
-    def create(txid):
+    def create(self, txid, amount, raw_tx=None):
         pass
 
     def lookup(txid):
@@ -301,6 +493,22 @@ class OnChainDatabase:
     def delete(txid):
         pass
 
+    def update_status(self, txid, status):
+        """Record whether a transaction is 'pending', 'broadcast' or 'failed'."""
+        pass
+
+    def pending(self):
+        """List the (txid, raw_tx) of transactions waiting to be broadcast."""
+        return []
+
+    def claim(self, txid):
+        """Claim a pending transaction for broadcast.
+
+        Returns:
+            (bool): True if the caller should broadcast the transaction.
+        """
+        return True
+
 # *************************** Django Data ORM ****************************** #
 
 
@@ -309,7 +517,7 @@ class OnChainDjango(OnChainDatabase):
     def __init__(self, BlockchainTransaction):
         self.BlockchainTransaction = BlockchainTransaction
 
-    def create(self, txid, amount):
+    def create(self, txid, amount, raw_tx=None):
         """Create a transaction entry."""
         bt = self.BlockchainTransaction(txid=txid, amount=amount)
         bt.save()
@@ -336,30 +544,102 @@ class OnChainDjango(OnChainDatabase):
 
 class OnChainSQLite3(OnChainDatabase):
 
+    # Seconds after which a broadcast that was claimed but never finished
+    # (e.g. by a process that was killed) can be claimed again.
+    CLAIM_TIMEOUT = 600
+
     def __init__(self, db='payment.sqlite3'):
         """Instantiate SQLite3 for storing on chain transaction data."""
-        self.connection = sqlite3.connect(db, check_same_thread=False)
-        self.c = self.connection.cursor()
-        self.c.execute("CREATE TABLE IF NOT EXISTS 'payment_onchain' (txid text, amount integer)")
-
-    def create(self, txid, amount):
-        """Create a transaction entry."""
-        insert = 'INSERT INTO payment_onchain VALUES (?, ?)'
-        self.c.execute(insert, (txid, amount))
-        self.connection.commit()
+        self.store = _SQLite3Store(db)
+
+        def _create_table(c):
+            c.execute("CREATE TABLE IF NOT EXISTS 'payment_onchain' "
+                      "(txid text, amount integer, status text, "
+                      "raw_tx text, claimed real)")
+            # Tables created before the broadcast status was recorded
+            columns = [r[1] for r in
+                       c.execute("PRAGMA table_info('payment_onchain')")]
+            for column, kind in [('status', 'text'), ('raw_tx', 'text'),
+                                 ('claimed', 'real')]:
+                if column not in columns:
+                    c.execute("ALTER TABLE 'payment_onchain' ADD COLUMN "
+                              "{} {}".format(column, kind))
+            c.execute("CREATE UNIQUE INDEX IF NOT EXISTS "
+                      "'payment_onchain_txid' ON 'payment_onchain' (txid)")
+
+        self.store.write(_create_table)
+
+    def create(self, txid, amount, raw_tx=None):
+        """Create a transaction entry.
+
+        If raw_tx is given the entry is claimed for broadcast by the caller,
+        who must record the outcome with `update_status()`.
+
+        Raises:
+            DuplicateTransactionError: if there already is an entry for txid.
+        """
+        insert = 'INSERT INTO payment_onchain VALUES (?, ?, ?, ?, ?)'
+        if raw_tx:
+            row = (txid, amount, 'broadcasting', raw_tx, time.time())
+        else:
+            row = (txid, amount, None, None, None)
+        try:
+            self.store.write(lambda c: c.execute(insert, row))
+        except sqlite3.IntegrityError:
+            raise DuplicateTransactionError()
         return {'txid': txid, 'amount': amount}
 
     def lookup(self, txid):
         """Look up a transaction entry."""
-        select = 'SELECT txid, amount FROM payment_onchain WHERE txid=?'
-        self.c.execute(select, (txid,))
-        rv = self.c.fetchone()
+        select = 'SELECT txid, amount, status FROM payment_onchain WHERE txid=?'
+        rv = self.store.read(lambda c: c.execute(select, (txid,)).fetchone())
         if rv is None:
             return rv
-        return {'txid': rv[0], 'amount': rv[1]}
+        return {'txid': rv[0], 'amount': rv[1], 'status': rv[2]}
 
     def delete(self, txid):
         """Delete a transaction entry."""
         delete = 'DELETE FROM payment_onchain WHERE txid=?'
-        self.c.execute(delete, (txid,))
-        self.connection.commit()
+        self.store.write(lambda c: c.execute(delete, (txid,)))
+
+    def update_status(self, txid, status):
+        """Record whether a transaction is 'pending', 'broadcast' or 'failed'.
+
+        Once a transaction is no longer pending its raw transaction is
+        dropped.
+        """
+        if status == 'pending':
+            update = ('UPDATE payment_onchain SET status=?, claimed=NULL '
+                      'WHERE txid=?')
+        else:
+            update = ('UPDATE payment_onchain SET status=?, raw_tx=NULL, '
+                      'claimed=NULL WHERE txid=?')
+        self.store.write(lambda c: c.execute(update, (status, txid)))
+
+    def pending(self):
+        """List the (txid, raw_tx) of transactions waiting to be broadcast.
+
+        These are the pending transactions and those whose broadcast was
+        claimed more than CLAIM_TIMEOUT seconds ago without finishing.
+        """
+        select = ("SELECT txid, raw_tx FROM payment_onchain "
+                  "WHERE status='pending' OR "
+                  "(status='broadcasting' AND claimed < ?)")
+        stale = time.time() - OnChainSQLite3.CLAIM_TIMEOUT
+        return self.store.read(lambda c: c.execute(select, (stale,)).fetchall())
+
+    def claim(self, txid):
+        """Claim a pending transaction for broadcast.
+
+        Only one caller, in any process, gets the claim.
+
+        Returns:
+            (bool): True if the caller should broadcast the transaction.
+        """
+        update = ("UPDATE payment_onchain SET status='broadcasting', "
+                  "claimed=? WHERE txid=? AND (status='pending' OR "
+                  "(status='broadcasting' AND claimed < ?))")
+        now = time.time()
+        stale = now - OnChainSQLite3.CLAIM_TIMEOUT
+        return self.store.write(
+            lambda c: c.execute(update, (now, txid, stale)).rowcount) == 1
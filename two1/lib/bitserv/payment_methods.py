@@ -1,14 +1,19 @@
 """Allowed payment methods."""
+import heapq
 import json
 import logging
 import requests
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from two1.lib.bitcoin.txn import Transaction
 from two1.lib.blockchain.twentyone_provider import TwentyOneProvider
 from two1.commands.config import TWO1_PROVIDER_HOST, TWO1_HOST
 from two1.commands.config import TWO1_CONFIG_FILE
 from .models import OnChainSQLite3
+from .models import DuplicateTransactionError
 from .payment_server import PaymentServer
 
 logger = logging.getLogger('bitserv')
@@ -46,6 +51,15 @@ class PaymentBase:
 
     """Base class for payment methods."""
 
+    @property
+    def headers_version(self):
+        """Version of the headers returned by `get_402_headers()`.
+
+        402 headers are cached per price, so derived methods whose headers
+        change for the same price must change their version when they do.
+        """
+        return 0
+
     def should_redeem(self, request_headers):
         """Method for checking if we should use a derived payment method."""
         return all(h in request_headers.keys() for h in self.payment_headers)
@@ -95,35 +109,191 @@ class PaymentBase:
         raise NotImplementedError()
 
 
+class HeaderCache:
+
+    """Cache of the 402 response headers of a route.
+
+    The headers of all payment methods are merged once per price and server
+    url, and again whenever the `headers_version` of a method changes.
+    """
+
+    MAX_ENTRIES = 1024
+
+    def __init__(self, methods):
+        """Initialize the cache for the given payment methods."""
+        self.methods = methods
+        self._entries = {}
+
+    def get(self, price, **kwargs):
+        """Dict of headers to return in the initial 402 response."""
+        versions = tuple(m.headers_version for m in self.methods)
+        key = (price, kwargs.get('server_url'))
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == versions:
+            return entry[1]
+
+        headers = {}
+        for method in self.methods:
+            headers.update(method.get_402_headers(price, **kwargs))
+        # Prices and server urls can come from requests: bound the cache
+        if len(self._entries) >= HeaderCache.MAX_ENTRIES:
+            self._entries.clear()
+        self._entries[key] = (versions, headers)
+        return headers
+
+
+class PayoutAddress:
+
+    """Payout address to advertise in 402 responses.
+
+    With `rotate_every` set, the wallet is asked for its payout address again
+    every `rotate_every` seconds, which gives a new address once the current
+    one has been paid to. Payments to the last KEEP addresses advertised are
+    accepted. Otherwise the address the wallet gave at construction is used.
+    """
+
+    KEEP = 10
+
+    def __init__(self, wallet, rotate_every=None):
+        """Initialize with the wallet's current payout address."""
+        self.wallet = wallet
+        self.rotate_every = rotate_every
+        self._address = wallet.get_payout_address()
+        self._addresses = [self._address]
+        self._fetched = time.time()
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def _rotate(self):
+        """Get the wallet's payout address if it is time to."""
+        if self.rotate_every is None or \
+           time.time() - self._fetched < self.rotate_every:
+            return
+        with self._lock:
+            if time.time() - self._fetched < self.rotate_every:
+                return
+            try:
+                address = self.wallet.get_payout_address()
+            except Exception as e:
+                logger.warning('[BitServ] Could not get payout address: {}'.format(e))
+                address = self._address
+            self._fetched = time.time()
+            if address != self._address:
+                if address in self._addresses:
+                    self._addresses.remove(address)
+                self._addresses = (self._addresses + [address])[-PayoutAddress.KEEP:]
+                self._address = address
+                self._version += 1
+
+    @property
+    def address(self):
+        """Address to advertise."""
+        self._rotate()
+        return self._address
+
+    @property
+    def addresses(self):
+        """Addresses that payments are accepted to, newest last."""
+        return self._addresses
+
+    @property
+    def version(self):
+        """Number of times the address has changed."""
+        self._rotate()
+        return self._version
+
+
 ###############################################################################
 
 
 class OnChain(PaymentBase):
 
-    """Making a payment on the bitcoin blockchain."""
+    """Making a payment on the bitcoin blockchain.
+
+    By default a payment is only accepted once its transaction has been
+    broadcast, which is when the network checks its inputs and signatures.
+
+    With `async_broadcast` a valid payment is recorded in the database and
+    the request is let through right away. The transaction is then broadcast
+    by a pool of background workers, retrying with exponential backoff.
+    WARNING: the resource is then served before the network has checked the
+    transaction, so a well-formed transaction spending inputs that don't
+    exist, or with bad signatures, pays for it. Only use it for resources
+    that are cheap to give away. Transactions that can't be broadcast are
+    flagged as 'failed' in the database and kept there, so they can't be
+    used to pay again. Transactions whose broadcast was interrupted (e.g. by
+    a restart) are claimed and broadcast again when an OnChain object with
+    `async_broadcast` is created.
+    """
 
-    lock = threading.Lock()
     http_payment_data = 'Bitcoin-Transaction'
     http_402_price = 'Price'
     http_402_address = 'Bitcoin-Address'
     DUST_LIMIT = 546  # dust limit in satoshi
+    BROADCAST_WORKERS = 4
+    MAX_BROADCAST_ATTEMPTS = 5
+    BROADCAST_RETRY_DELAY = 2  # seconds, doubled after each attempt
 
-    def __init__(self, wallet, db=None):
-        """Initialize payment handling for on-chain payments."""
+    def __init__(self, wallet, db=None, payout=None, async_broadcast=False):
+        """Initialize payment handling for on-chain payments.
+
+        Args:
+            payout (PayoutAddress): payout address to advertise, shared with
+                other payment methods. Defaults to the wallet's current one.
+            async_broadcast (bool): accept payments before broadcasting them.
+                See the class docstring for the risk this carries.
+        """
         self.db = db or OnChainSQLite3()
-        self.address = wallet.get_payout_address()
+        self.payout = payout or PayoutAddress(wallet)
         self.provider = TwentyOneProvider(TWO1_PROVIDER_HOST)
+        self.async_broadcast = async_broadcast
+        self._txid_locks = {}
+        self._txid_locks_lock = threading.Lock()
+        self._broadcaster = None
+        if async_broadcast:
+            self._broadcaster = ThreadPoolExecutor(
+                max_workers=OnChain.BROADCAST_WORKERS)
+            for txid, raw_tx in self.db.pending():
+                if self.db.claim(txid):
+                    self._broadcaster.submit(self._broadcast, txid, raw_tx)
 
     @property
     def payment_headers(self):
         """List of headers to use for payment processing."""
         return [OnChain.http_payment_data]
 
+    @property
+    def address(self):
+        """Payout address to advertise."""
+        return self.payout.address
+
+    @property
+    def headers_version(self):
+        """Version of the 402 headers, changed when the address rotates."""
+        return self.payout.version
+
     def get_402_headers(self, price, **kwargs):
         """Dict of headers to return in the initial 402 response."""
         return {OnChain.http_402_price: price,
                 OnChain.http_402_address: kwargs.get('address', self.address)}
 
+    @contextmanager
+    def _txid_lock(self, txid):
+        """Hold a lock that is specific to txid."""
+        with self._txid_locks_lock:
+            lock, users = self._txid_locks.get(txid, (threading.Lock(), 0))
+            self._txid_locks[txid] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._txid_locks_lock:
+                lock, users = self._txid_locks[txid]
+                if users == 1:
+                    del self._txid_locks[txid]
+                else:
+                    self._txid_locks[txid] = (lock, users - 1)
+
     def redeem_payment(self, price, request_headers, **kwargs):
         """Validate the transaction and broadcast it to the blockchain."""
         raw_tx = request_headers[OnChain.http_payment_data]
@@ -135,12 +305,19 @@ class OnChain(PaymentBase):
                 'Payment amount is below dust limit ({} Satoshi)'.format(OnChain.DUST_LIMIT))
 
         try:
-            payment_tx = Transaction.from_hex(raw_tx)
+            payment_tx = Transaction.from_hex(raw_tx, frozen=True)
         except:
             raise InvalidPaymentParameterError('Invalid transaction hex.')
 
         # Find the output with the merchant's address
-        payment_index = payment_tx.output_index_for_address(kwargs.get('address', self.address))
+        if 'address' in kwargs:
+            addresses = [kwargs['address']]
+        else:
+            addresses = reversed(self.payout.addresses)
+        for address in addresses:
+            payment_index = payment_tx.output_index_for_address(address)
+            if payment_index is not None:
+                break
         if payment_index is None:
             raise InvalidPaymentParameterError('Not paid to merchant.')
 
@@ -148,25 +325,62 @@ class OnChain(PaymentBase):
         if payment_tx.outputs[payment_index].value != price:
             raise InsufficientPaymentError('Incorrect payment amount.')
 
-        # Synchronize the next block of code to manage its atomicity
-        with self.lock:
-            # Verify that we haven't seen this transaction before
-            if self.db.lookup(str(payment_tx.hash)):
+        # Verify that we haven't seen this transaction before. Databases
+        # with a unique constraint on the txid also reject duplicates
+        # inserted by other processes.
+        txid = str(payment_tx.hash)
+        with self._txid_lock(txid):
+            if self.db.lookup(txid):
+                raise DuplicatePaymentError('Payment already used.')
+            try:
+                if self.async_broadcast:
+                    self.db.create(txid, price, raw_tx)
+                else:
+                    self.db.create(txid, price)
+            except DuplicateTransactionError:
                 raise DuplicatePaymentError('Payment already used.')
-            else:
-                self.db.create(str(payment_tx.hash), price)
+
+            if self.async_broadcast:
+                self._broadcaster.submit(self._broadcast, txid, raw_tx)
+                return True
 
             try:
                 # Broadcast payment to network
-                txid = self.provider.broadcast_transaction(raw_tx)
+                self.provider.broadcast_transaction(raw_tx)
                 logger.debug('[BitServ] Broadcasted: ' + txid)
             except Exception as e:
                 # Roll back the database entry if the broadcast fails
-                self.db.delete(str(payment_tx.hash))
+                self.db.delete(txid)
                 raise TransactionBroadcastError(str(e))
 
         return True
 
+    def _broadcast(self, txid, raw_tx):
+        """Broadcast a recorded payment, retrying if it fails."""
+        delay = OnChain.BROADCAST_RETRY_DELAY
+        for attempt in range(1, OnChain.MAX_BROADCAST_ATTEMPTS + 1):
+            try:
+                self.provider.broadcast_transaction(raw_tx)
+                logger.debug('[BitServ] Broadcasted: ' + txid)
+                status = 'broadcast'
+                break
+            except Exception as e:
+                logger.warning('[BitServ] Broadcast of {} failed (attempt {}): {}'.format(
+                    txid, attempt, e))
+                status = 'failed'
+                if attempt < OnChain.MAX_BROADCAST_ATTEMPTS:
+                    time.sleep(delay)
+                    delay *= 2
+
+        if status == 'failed':
+            logger.error('[BitServ] Giving up on broadcasting {}.'.format(txid))
+        try:
+            self.db.update_status(txid, status)
+        except Exception as e:
+            logger.error('[BitServ] Could not record broadcast of {}: {}'.format(
+                txid, e))
+        return status == 'broadcast'
+
 
 class PaymentChannel(PaymentBase):
 
@@ -203,6 +417,194 @@ class PaymentChannel(PaymentBase):
             raise e
 
 
+class BitTransferVerifier:
+
+    """Verifies BitTransfers with the BitTransfer verification server.
+
+    Requests reuse keep-alive connections from a pooled session and time out
+    after TIMEOUT seconds. The signature of every transfer is remembered for
+    REPLAY_WINDOW seconds after the transfer's timestamp, so a replayed
+    transfer is rejected without asking the server. Older transfers are
+    rejected outright, as their signatures may have been forgotten, and so
+    are transfers dated more than MAX_CLOCK_SKEW seconds in the future. If
+    more than MAX_SEEN signatures are remembered the oldest are forgotten
+    early, and transfers signed before them are rejected as well.
+    """
+
+    TIMEOUT = 10
+    POOL_SIZE = 16
+    REPLAY_WINDOW = 3600
+    MAX_CLOCK_SKEW = 300
+    MAX_SEEN = 100000
+
+    def __init__(self, verification_url, seller_username):
+        """Initialize the verifier.
+
+        Args:
+            verification_url (str): URL of the verification endpoint, with a
+                '{}' placeholder for the seller's username.
+            seller_username (str): username of the seller receiving transfers.
+        """
+        self.url = verification_url.format(seller_username)
+        # Endpoint verifying a list of transfers in one request
+        self.batch_url = self.url.rstrip('/') + '/batch/'
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=BitTransferVerifier.POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['content-type'] = 'application/json'
+        # Signature -> transfer timestamp
+        self._seen = {}
+        # Heap of (timestamp, signature), including forgotten signatures
+        self._expiry = []
+        self._horizon = 0
+        self._lock = threading.Lock()
+
+    def _remember(self, bittransfer, signature):
+        """Remember a transfer's signature, rejecting replays."""
+        try:
+            timestamp = float(json.loads(bittransfer)['timestamp'])
+        except (ValueError, KeyError, TypeError):
+            raise InvalidPaymentParameterError('Invalid BitTransfer.')
+
+        now = time.time()
+        if timestamp > now + BitTransferVerifier.MAX_CLOCK_SKEW:
+            raise InvalidPaymentParameterError(
+                'BitTransfer is dated in the future.')
+
+        with self._lock:
+            horizon = max(self._horizon,
+                          now - BitTransferVerifier.REPLAY_WINDOW)
+            while self._expiry and \
+                (self._expiry[0][0] <= horizon or
+                 len(self._seen) >= BitTransferVerifier.MAX_SEEN):
+                oldest, seen = heapq.heappop(self._expiry)
+                if self._seen.get(seen) == oldest:
+                    del self._seen[seen]
+                self._horizon = horizon = max(horizon, oldest)
+
+            if timestamp <= horizon:
+                raise InvalidPaymentParameterError('BitTransfer has expired.')
+            if signature in self._seen:
+                raise DuplicatePaymentError('Payment already used.')
+            self._seen[signature] = timestamp
+            heapq.heappush(self._expiry, (timestamp, signature))
+
+    def _forget(self, signature):
+        """Forget the signature of a transfer that wasn't verified."""
+        with self._lock:
+            self._seen.pop(signature, None)
+
+    @staticmethod
+    def _response_error(response):
+        """Return the exception for an unsuccessful verification response."""
+        if 'message' in response.text:
+            return InvalidPaymentParameterError(response.json()['message'])
+        else:
+            return ServerError('Verification failed ({}).'.format(
+                response.status_code))
+
+    def verify(self, bittransfer, signature):
+        """Verify a transfer.
+
+        Args:
+            bittransfer (str): JSON-serialized BitTransfer.
+            signature (str): payer's signature of the transfer.
+
+        Returns:
+            (boolean): True if the transfer is valid.
+        Raises:
+            DuplicatePaymentError: the transfer has already been used.
+            InvalidPaymentParameterError: the transfer is invalid.
+            ServerError: the verification server couldn't be reached.
+        """
+        self._remember(bittransfer, signature)
+        try:
+            response = self.session.post(
+                self.url,
+                data=json.dumps({'bittransfer': bittransfer,
+                                 'signature': signature}),
+                timeout=BitTransferVerifier.TIMEOUT)
+        except requests.RequestException as e:
+            self._forget(signature)
+            logger.debug('[BitServ] Client failed to connect to server.')
+            raise ServerError('Could not reach verification server: {}'.format(e))
+
+        if response.ok:
+            return True
+
+        self._forget(signature)
+        raise self._response_error(response)
+
+    def verify_batch(self, transfers):
+        """Verify many transfers in one request to the verification server.
+
+        If the server doesn't support batches, the transfers are verified
+        one at a time.
+
+        Args:
+            transfers (list): (bittransfer, signature) tuples.
+
+        Returns:
+            (list): for each transfer, True if it is valid or the exception
+                `verify()` would have raised for it.
+        """
+        results = [None] * len(transfers)
+        pending = []
+        for i, (bittransfer, signature) in enumerate(transfers):
+            try:
+                self._remember(bittransfer, signature)
+                pending.append(i)
+            except PaymentError as e:
+                results[i] = e
+        if not pending:
+            return results
+
+        body = [{'bittransfer': transfers[i][0], 'signature': transfers[i][1]}
+                for i in pending]
+        error = ServerError('Verification server gave no reason.')
+        try:
+            response = self.session.post(
+                self.batch_url, data=json.dumps({'transfers': body}),
+                timeout=BitTransferVerifier.TIMEOUT)
+            if response.status_code in (404, 405):
+                # No batch endpoint: verify one at a time
+                for i in pending:
+                    self._forget(transfers[i][1])
+                    try:
+                        results[i] = self.verify(*transfers[i])
+                    except (PaymentError, ServerError) as e:
+                        results[i] = e
+                return results
+            if not response.ok:
+                error = self._response_error(response)
+                batch_results = [{'ok': False}] * len(pending)
+            else:
+                batch_results = response.json()['results']
+                if len(batch_results) != len(pending):
+                    error = ServerError(
+                        'Verification response has {} results for {} '
+                        'transfers.'.format(len(batch_results), len(pending)))
+                    batch_results = [{'ok': False}] * len(pending)
+        except (requests.RequestException, ValueError, KeyError,
+                TypeError) as e:
+            error = ServerError('Could not verify transfers: {}'.format(e))
+            batch_results = [{'ok': False}] * len(pending)
+
+        for i, r in zip(pending, batch_results):
+            if not isinstance(r, dict):
+                r = {'ok': False}
+            if r.get('ok') is True:
+                results[i] = True
+            else:
+                self._forget(transfers[i][1])
+                results[i] = (InvalidPaymentParameterError(r['message'])
+                              if 'message' in r else error)
+
+        return results
+
+
 class BitTransfer(PaymentBase):
 
     """Making a payment via 21 BitTransfer protocol."""
@@ -216,9 +618,15 @@ class BitTransfer(PaymentBase):
     verification_url = TWO1_HOST + '/pool/account/{}/bittransfer/'
     account_file = TWO1_CONFIG_FILE
 
-    def __init__(self, wallet, verification_url=None, seller_account=None):
-        """Initialize payment handling for on-chain payments."""
-        self.address = wallet.get_payout_address()
+    def __init__(self, wallet, verification_url=None, seller_account=None,
+                 payout=None):
+        """Initialize payment handling for BitTransfers.
+
+        Args:
+            payout (PayoutAddress): payout address to advertise, shared with
+                other payment methods. Defaults to the wallet's current one.
+        """
+        self.payout = payout or PayoutAddress(wallet)
         self.verification_url = verification_url or BitTransfer.verification_url
         acct = seller_account or BitTransfer.account_file
 
@@ -226,12 +634,23 @@ class BitTransfer(PaymentBase):
             account = json.loads(f.read())
         seller = account['username']
         self.seller_username = seller
+        self.verifier = BitTransferVerifier(self.verification_url, seller)
 
     @property
     def payment_headers(self):
         """List of headers to use for payment processing."""
         return [BitTransfer.http_payment_data, BitTransfer.http_authorization]
 
+    @property
+    def address(self):
+        """Payout address to advertise."""
+        return self.payout.address
+
+    @property
+    def headers_version(self):
+        """Version of the 402 headers, changed when the address rotates."""
+        return self.payout.version
+
     def get_402_headers(self, price, **kwargs):
         """Dict of headers to return in the initial 402 response."""
         return {BitTransfer.http_402_price: price,
@@ -256,26 +675,4 @@ class BitTransfer(PaymentBase):
             raise InsufficientPaymentError('Incorrect payment amount.')
 
         # now verify with 21.co server that transfer is valid
-        try:
-            verification_response = requests.post(
-                self.verification_url.format(
-                    self.seller_username
-                ),
-                data=json.dumps({
-                    'bittransfer': bittransfer,
-                    'signature': signature
-                }),
-                headers={'content-type': 'application/json'}
-            )
-            if verification_response.ok:
-                return True
-        except requests.ConnectionError:
-            logger.debug('[BitServ] Client failed to connect to server.')
-
-        # handle verification server bad response
-        if 'message' in verification_response.text:
-            raise InvalidPaymentParameterError(
-                verification_response.json()['message']
-            )
-        else:
-            raise ServerError
+        return self.verifier.verify(bittransfer, signature)
@@ -1,6 +1,9 @@
 """Tools for Payment Channels."""
 import time
 import codecs
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from two1.lib.bitcoin.crypto import PublicKey
 from two1.commands.config import TWO1_PROVIDER_HOST
 from two1.lib.blockchain.twentyone_provider import TwentyOneProvider
@@ -30,6 +33,112 @@ class BadTransactionError(PaymentServerError):
     pass
 
 
+class ChannelStateCache:
+
+    """Write-through cache of payment channel state.
+
+    Looking a channel up in the database parses its transactions and
+    merchant key every time. This keeps the channel as returned by
+    `db.pc.lookup()`, along with its parsed merchant public key
+    ('merchant_key') and redeem script ('redeem_script'), for the channels
+    in use. The PaymentServer updates a cached channel whenever it writes
+    that channel to the database. Payments are only recorded if they are
+    greater than the one in the database, so a channel cached while another
+    process took a payment in it is dropped when its next payment is
+    rejected; other changes by other writers are not seen until the channel
+    is evicted.
+
+    Each channel has a lock, and a channel may only be looked up or updated
+    while its lock is held (see `lock()`). This serializes concurrent
+    payments in one channel. If anything raises while the lock is held, the
+    cached channel is dropped, as the database may have been updated without
+    it. At most `max_channels` channels are kept, and
+    channels unused for `idle_timeout` seconds are evicted.
+    """
+
+    MAX_CHANNELS = 1000
+    IDLE_TIMEOUT = 600
+
+    def __init__(self, db, max_channels=MAX_CHANNELS,
+                 idle_timeout=IDLE_TIMEOUT):
+        """Initialize the cache.
+
+        Args:
+            db (.models.DatabaseSQLite3): database the channels are stored in.
+            max_channels (int): maximum number of channels to keep.
+            idle_timeout (float): seconds after which an unused channel is
+                evicted.
+        """
+        self._db = db
+        self.max_channels = max_channels
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # deposit_txid -> [channel lock, channel or None, time last used],
+        # least recently used first.
+        self._entries = OrderedDict()
+
+    @contextmanager
+    def lock(self, deposit_txid):
+        """Hold the lock of a channel for the duration of a `with` block."""
+        while True:
+            with self._lock:
+                entry = self._entries.get(deposit_txid)
+                if entry is None:
+                    entry = [threading.Lock(), None, time.time()]
+                    self._entries[deposit_txid] = entry
+                    self._evict()
+
+            entry[0].acquire()
+            # The entry may have been evicted before we got its lock.
+            with self._lock:
+                if self._entries.get(deposit_txid) is entry:
+                    entry[2] = time.time()
+                    self._entries.move_to_end(deposit_txid)
+                    break
+            entry[0].release()
+
+        try:
+            yield
+        except BaseException:
+            # Read the channel from the database again next time
+            entry[1] = None
+            raise
+        finally:
+            entry[0].release()
+
+    def _evict(self):
+        """Evict idle channels, then the least recently used ones, if there
+        are too many. Channels whose lock is held are never evicted. Must be
+        called with the cache lock held."""
+        idle = time.time() - self.idle_timeout
+        excess = len(self._entries) - self.max_channels
+        for deposit_txid, entry in list(self._entries.items()):
+            if excess <= 0 and entry[2] >= idle:
+                break
+            if not entry[0].locked():
+                del self._entries[deposit_txid]
+                excess -= 1
+
+    def get(self, deposit_txid):
+        """Get a channel, reading it from the database if it isn't cached.
+
+        The channel's lock must be held. The returned dict may be modified
+        to update the cached channel.
+
+        Raises:
+            .models.ModelNotFound: if the channel doesn't exist.
+        """
+        entry = self._entries[deposit_txid]
+        if entry[1] is None:
+            channel = self._db.pc.lookup(deposit_txid)
+            channel['merchant_key'] = PublicKey.from_bytes(
+                codecs.decode(channel['merchant_pubkey'], 'hex_codec'))
+            channel['redeem_script'] = get_redeem_script(channel['refund_tx'])
+            entry[1] = channel
+
+        return entry[1]
+
+
 class PaymentServer:
 
     """Payment channel handling.
@@ -62,6 +171,7 @@ class PaymentServer:
             self._db = DatabaseSQLite3()
         if blockchain is None:
             self._blockchain = TwentyOneProvider(TWO1_PROVIDER_HOST)
+        self._channels = ChannelStateCache(self._db)
 
     def discovery(self):
         """Return the merchant's public key.
@@ -132,31 +242,33 @@ class PaymentServer:
         Returns:
             (boolean): whether the handshake was successfully completed.
         """
-        try:
-            channel = self._db.pc.lookup(deposit_txid)
-        except:
-            raise PaymentServerNotFoundError('Related channel not found.')
-
-        # Get the refund spend address
-        refund_tx = channel['refund_tx']
-
-        # Find the payment amount associated with the refund
-        refund_hash160 = get_redeem_script(refund_tx).hash160()
-        deposit_index = deposit_tx.output_index_for_address(refund_hash160)
-
-        # Verify that the deposit funds the refund in our records
-        if deposit_index is not None:
-            deposit_amt = deposit_tx.outputs[deposit_index].value
-        else:
-            raise BadTransactionError('Deposit must fund refund.')
-
-        # Save the deposit transaction
-        try:
-            self._db.pc.update_deposit(deposit_txid, deposit_tx, deposit_amt)
-        except:
-            raise BadTransactionError('Deposit already used.')
-
-        self._db.pc.update_state(deposit_txid, 'confirming')
+        with self._channels.lock(deposit_txid):
+            try:
+                channel = self._channels.get(deposit_txid)
+            except:
+                raise PaymentServerNotFoundError('Related channel not found.')
+
+            # Find the payment amount associated with the refund
+            refund_hash160 = channel['redeem_script'].hash160()
+            deposit_index = deposit_tx.output_index_for_address(refund_hash160)
+
+            # Verify that the deposit funds the refund in our records
+            if deposit_index is not None:
+                deposit_amt = deposit_tx.outputs[deposit_index].value
+            else:
+                raise BadTransactionError('Deposit must fund refund.')
+
+            # Save the deposit transaction
+            try:
+                self._db.pc.update_deposit(deposit_txid, deposit_tx,
+                                           deposit_amt)
+            except:
+                raise BadTransactionError('Deposit already used.')
+            channel['deposit_tx'] = deposit_tx
+            channel['amount'] = deposit_amt
+
+            self._db.pc.update_state(deposit_txid, 'confirming')
+            channel['state'] = 'confirming'
 
         return True
 
@@ -182,47 +294,52 @@ class PaymentServer:
         # Verify that the transaction is what we expect
         self._wallet.verify_half_signed_tx(payment_tx)
 
-        # Get channel and addresses related to the deposit
-        try:
-            channel = self._db.pc.lookup(deposit_txid)
-        except:
-            raise PaymentServerNotFoundError('Related channel not found.')
-
-        # Get merchant public key information from payment channel
-        last_pmt_amt = channel['last_payment_amount']
-        merch = channel['merchant_pubkey']
-        merch_pubkey = PublicKey.from_bytes(codecs.decode(merch, 'hex_codec'))
-        index = payment_tx.output_index_for_address(merch_pubkey.hash160())
-
-        # Verify that the payment channel is still open
-        if (channel['state'] != 'confirming' and channel['state'] != 'ready'):
-            raise ChannelClosedError('Payment channel closed.')
-
-        # Find the payment amount associated with the merchant address
-        if index is None:
-            raise BadTransactionError('Payment must pay to merchant pubkey.')
-
-        # Validate that the payment is more than the last one
-        new_pmt_amt = payment_tx.outputs[index].value
-        if new_pmt_amt <= last_pmt_amt:
-            raise BadTransactionError('Micropayment must be greater than 0.')
-
-        # Verify that the payment channel is still open
-        if (channel['state'] != 'confirming' and channel['state'] != 'ready'):
-            raise ChannelClosedError('Payment channel closed.')
-
-        # Verify that the transaction has adequate fees
-        net_pmt_amount = sum([d.value for d in payment_tx.outputs])
-        deposit_amount = channel['amount']
-        if deposit_amount < net_pmt_amount + PaymentServer.MIN_TX_FEE:
-            raise BadTransactionError('Payment must have adequate fees.')
-
-        # Sign the remaining half of the transaction
-        self._wallet.sign_half_signed_tx(payment_tx, merch_pubkey)
-
-        # Update the current payment transaction
-        self._db.pc.update_payment(deposit_txid, payment_tx, new_pmt_amt)
-        self._db.pmt.create(deposit_txid, payment_tx, new_pmt_amt-last_pmt_amt)
+        with self._channels.lock(deposit_txid):
+            # Get channel and addresses related to the deposit
+            try:
+                channel = self._channels.get(deposit_txid)
+            except:
+                raise PaymentServerNotFoundError('Related channel not found.')
+
+            # Get merchant public key information from payment channel
+            last_pmt_amt = channel['last_payment_amount']
+            merch_pubkey = channel['merchant_key']
+            index = payment_tx.output_index_for_address(merch_pubkey.hash160())
+
+            # Verify that the payment channel is still open
+            if (channel['state'] != 'confirming' and channel['state'] != 'ready'):
+                raise ChannelClosedError('Payment channel closed.')
+
+            # Verify that the payment spends this channel's deposit
+            if str(payment_tx.inputs[0].outpoint) != deposit_txid:
+                raise BadTransactionError('Payment must spend the channel deposit.')
+
+            # Find the payment amount associated with the merchant address
+            if index is None:
+                raise BadTransactionError('Payment must pay to merchant pubkey.')
+
+            # Validate that the payment is more than the last one
+            new_pmt_amt = payment_tx.outputs[index].value
+            if new_pmt_amt <= last_pmt_amt:
+                raise BadTransactionError('Micropayment must be greater than 0.')
+
+            # Verify that the transaction has adequate fees
+            net_pmt_amount = sum([d.value for d in payment_tx.outputs])
+            deposit_amount = channel['amount']
+            if deposit_amount < net_pmt_amount + PaymentServer.MIN_TX_FEE:
+                raise BadTransactionError('Payment must have adequate fees.')
+
+            # Sign the remaining half of the transaction
+            self._wallet.sign_half_signed_tx(payment_tx, merch_pubkey)
+
+            # Update the current payment transaction, unless a greater payment
+            # was recorded since the channel was cached
+            if not self._db.pc.update_payment(deposit_txid, payment_tx, new_pmt_amt):
+                raise BadTransactionError('Micropayment must be greater than 0.')
+            self._db.pmt.create(deposit_txid, payment_tx,
+                                new_pmt_amt - last_pmt_amt)
+            channel['payment_tx'] = payment_tx
+            channel['last_payment_amount'] = new_pmt_amt
 
         return True
 
@@ -233,10 +350,11 @@ class PaymentServer:
             deposit_txid (string): string representation of the deposit
                 transaction hash. This is used to look up the payment channel.
         """
-        try:
-            channel = self._db.pc.lookup(deposit_txid)
-        except:
-            raise PaymentServerNotFoundError('Related channel not found.')
+        with self._channels.lock(deposit_txid):
+            try:
+                channel = self._channels.get(deposit_txid)
+            except:
+                raise PaymentServerNotFoundError('Related channel not found.')
 
         return {'status': channel['state'],
                 'balance': channel['last_payment_amount'],
@@ -251,20 +369,22 @@ class PaymentServer:
             txid_signature (string): a signed message consisting solely of the
                 deposit_txid to verify the authenticity of the close request.
         """
-        try:
-            channel = self._db.pc.lookup(deposit_txid)
-        except:
-            raise PaymentServerNotFoundError('Related channel not found.')
+        with self._channels.lock(deposit_txid):
+            try:
+                channel = self._channels.get(deposit_txid)
+            except:
+                raise PaymentServerNotFoundError('Related channel not found.')
 
-        # Verify that there is a valid payment to close
-        if not channel['payment_tx']:
-            raise BadTransactionError('No payments made in channel.')
+            # Verify that there is a valid payment to close
+            if not channel['payment_tx']:
+                raise BadTransactionError('No payments made in channel.')
 
-        # Broadcast payment transaction to the blockchain
-        self._blockchain.broadcast_transaction(channel['payment_tx'].to_hex())
+            # Broadcast payment transaction to the blockchain
+            self._blockchain.broadcast_transaction(channel['payment_tx'].to_hex())
 
-        # Record the broadcast in the database
-        self._db.pc.update_state(deposit_txid, 'closed')
+            # Record the broadcast in the database
+            self._db.pc.update_state(deposit_txid, 'closed')
+            channel['state'] = 'closed'
 
         return str(channel['payment_tx'].hash)
 
@@ -288,19 +408,22 @@ class PaymentServer:
             raise PaymentServerNotFoundError('Payment not found.')
 
         # Verify that this payment exists within a channel (do we need this?)
-        try:
-            channel = self._db.pc.lookup(payment['deposit_txid'])
-        except:
-            raise PaymentServerNotFoundError('Channel not found.')
-
-        # Verify that the payment channel is still open
-        if (channel['state'] != 'confirming' and channel['state'] != 'ready'):
-            raise ChannelClosedError('Payment channel closed.')
-
-        # Verify that the most payment has not already been redeemed
-        if payment['is_redeemed']:
-            raise RedeemPaymentError('Payment already redeemed.')
-
-        # Calculate and redeem the current payment
-        self._db.pmt.redeem(payment_txid)
+        with self._channels.lock(payment['deposit_txid']):
+            try:
+                channel = self._channels.get(payment['deposit_txid'])
+            except:
+                raise PaymentServerNotFoundError('Channel not found.')
+
+            # Verify that the payment channel is still open
+            if (channel['state'] != 'confirming' and channel['state'] != 'ready'):
+                raise ChannelClosedError('Payment channel closed.')
+
+            # Verify that the most payment has not already been redeemed. It
+            # is looked up again now that the channel is locked, in case it
+            # was redeemed concurrently.
+            if self._db.pmt.lookup(payment_txid)['is_redeemed']:
+                raise RedeemPaymentError('Payment already redeemed.')
+
+            # Calculate and redeem the current payment
+            self._db.pmt.redeem(payment_txid)
         return payment['amount']
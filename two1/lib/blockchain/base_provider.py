@@ -65,6 +65,17 @@ class BaseProvider(object):
         """
         raise NotImplementedError
 
+    def invalidate(self, address_list):
+        """ Tells the provider that addresses may have new
+            transactions, so that any cached data about them is
+            refreshed. Providers that don't cache ignore it.
+
+        Args:
+            address_list (list(str)): List of Base58Check encoded
+                Bitcoin addresses.
+        """
+        pass
+
     def broadcast_transaction(self, transaction):
         """ Broadcasts a transaction to the Bitcoin network
 
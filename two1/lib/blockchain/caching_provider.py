@@ -0,0 +1,550 @@
+import json
+import os
+import threading
+import time
+
+from collections import defaultdict
+from two1.lib.bitcoin.hash import Hash
+from two1.lib.bitcoin.txn import Transaction
+from two1.lib.blockchain.base_provider import BaseProvider
+
+
+class CachingProvider(BaseProvider):
+    """ Caches the responses of another blockchain data provider.
+
+        Transactions with at least permanent_confirmations
+        confirmations are considered final: they are kept for as long
+        as the provider lives and, if cache_path is given, in a file
+        so that they survive restarts. For a provider that can limit
+        transactions by height (see BaseProvider.can_limit_by_height),
+        get_transactions() only asks for the transactions of an
+        address after the last block from which all of its final
+        transactions are known, and serves the rest from the cache.
+
+        Everything else (balances, UTXOs, unconfirmed and recent
+        transactions) is cached for at most ttl seconds, and only
+        until get_block_height() returns a different height or a
+        transaction is broadcast. invalidate() drops it for specific
+        addresses, e.g. ones a payment was just sent to.
+
+        The number of lookups served from either cache is counted in
+        hits and misses, keyed by method name.
+
+        Args:
+            provider (BaseProvider): The provider to get data from.
+            cache_path (str): Path of the file to keep final
+                transactions in. If None, they are only kept in memory.
+            ttl (float): Number of seconds to keep other data for.
+            permanent_confirmations (int): Number of confirmations after
+                which a transaction is kept permanently.
+    """
+    DEFAULT_TTL = 60
+    PERMANENT_CONFIRMATIONS = 100
+    # Minimum number of seconds between automatic saves of the cache
+    # file.
+    SAVE_INTERVAL = 60
+    CACHE_VERSION = 1
+
+    def __init__(self, provider, cache_path=None, ttl=DEFAULT_TTL,
+                 permanent_confirmations=PERMANENT_CONFIRMATIONS):
+        super().__init__()
+        self.provider = provider
+        self.can_limit_by_height = provider.can_limit_by_height
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.permanent_confirmations = permanent_confirmations
+
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+        self._lock = threading.Lock()
+        self._block_height = None
+        # Bumped whenever the recent cache is cleared, so that data
+        # fetched before that isn't stored in it afterwards.
+        self._generation = 0
+        self._recent = {}
+        self._txns = {}
+        self._addresses = {}
+        self._dirty = False
+        self._last_save = time.time()
+
+        if cache_path is not None and os.path.exists(cache_path):
+            self.load()
+
+    def __getattr__(self, name):
+        # Anything not implemented here (e.g. server_url) comes from
+        # the wrapped provider.
+        if name == "provider":
+            raise AttributeError(name)
+        return getattr(self.provider, name)
+
+    @property
+    def testnet(self):
+        return self.provider.testnet
+
+    @testnet.setter
+    def testnet(self, v):
+        if bool(v) != bool(getattr(self.provider, "testnet", False)):
+            # Nothing cached is valid on the other network.
+            with self._lock:
+                self._clear_recent()
+                self._txns = {}
+                self._addresses = {}
+                self._block_height = None
+                self._dirty = True
+        self.provider.testnet = v
+
+    def hit_rate(self, method=None):
+        """ Returns the fraction of lookups served from the cache.
+
+        Args:
+            method (str): Only count lookups of this method. If None,
+                counts all of them.
+
+        Returns:
+            float: The hit rate, or 0.0 if nothing was looked up yet.
+        """
+        with self._lock:
+            if method is None:
+                hits = sum(self.hits.values())
+                misses = sum(self.misses.values())
+            else:
+                hits = self.hits[method]
+                misses = self.misses[method]
+
+        total = hits + misses
+        return hits / total if total else 0.0
+
+    def _clear_recent(self):
+        """ Drops everything that isn't permanently cached. Must be
+            called with the lock held.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        self._recent = {}
+        self._generation += 1
+
+    def _get_recent(self, method, keys):
+        """ Looks up keys in the recent cache.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+
+        Returns:
+            tuple: A dict of the values found, keyed by key, a list of
+                the keys that weren't found and the current generation.
+        """
+        found = {}
+        missing = []
+        now = time.time()
+        with self._lock:
+            for k in keys:
+                entry = self._recent.get((method, k), None)
+                if entry is not None and entry[0] > now:
+                    found[k] = entry[1]
+                else:
+                    missing.append(k)
+            self.hits[method] += len(found)
+            self.misses[method] += len(missing)
+
+            return found, missing, self._generation
+
+    def _put_recent(self, method, values, generation):
+        """ Stores values, a dict keyed by key, in the recent cache
+            unless it was cleared since generation.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        expiry = time.time() + self.ttl
+        with self._lock:
+            if generation != self._generation:
+                return
+            for k, v in values.items():
+                self._recent[(method, k)] = (expiry, v)
+
+    def _current_height(self):
+        """ Returns the last known block height, getting it from the
+            provider if none is known yet.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        height = self._block_height
+        if height is None:
+            height = self.get_block_height()
+
+        return height
+
+    def _is_final(self, metadata, height):
+        """ Returns whether a transaction is deep enough in the chain
+            to be cached permanently.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        block = metadata['block']
+        if block is None or block < 0 or height is None:
+            return False
+
+        return height - block + 1 >= self.permanent_confirmations
+
+    def _from_final(self, txid, height):
+        """ Returns a permanently cached transaction in the format of
+            get_transactions(), with its confirmations updated for
+            height. Must be called with the lock held.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        metadata, txn = self._txns[txid]
+        metadata = dict(metadata,
+                        confirmations=height - metadata['block'] + 1)
+
+        return dict(metadata=metadata, transaction=txn)
+
+    def _add_final(self, t):
+        """ Permanently caches a transaction. Must be called with the
+            lock held.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+
+        Returns:
+            str: The txid.
+        """
+        txn = t['transaction'].freeze()
+        txid = str(txn.hash)
+        if txid not in self._txns:
+            metadata = {k: v for k, v in t['metadata'].items()
+                        if k != 'confirmations'}
+            self._txns[txid] = (metadata, txn)
+            self._dirty = True
+
+        return txid
+
+    def get_block_height(self):
+        """ Returns the latest block height. If it changed, the data
+            that isn't permanently cached is dropped.
+
+        Returns:
+            int: Block height
+        """
+        height = self.provider.get_block_height()
+        with self._lock:
+            if height is not None and height != self._block_height:
+                self._block_height = height
+                self._clear_recent()
+
+        return height
+
+    def invalidate(self, address_list):
+        """ Drops the balances, UTXOs and recent transactions cached
+            for addresses, so that they are fetched again.
+
+        Args:
+            address_list (list(str)): List of Base58Check encoded
+                Bitcoin addresses.
+        """
+        addresses = set(address_list)
+
+        def _address(key):
+            method, k = key
+            return k[0] if method == "get_transactions" else k
+
+        with self._lock:
+            self._recent = {key: v for key, v in self._recent.items()
+                            if key[0] == "get_transactions_by_id" or
+                            _address(key) not in addresses}
+            # Data for these addresses fetched before now mustn't be
+            # stored.
+            self._generation += 1
+
+    def get_balance(self, address_list):
+        """ Provides the balance for each address.
+
+        Args:
+            address_list (list(str)): List of Base58Check encoded
+                Bitcoin addresses.
+
+        Returns:
+            dict: A dict keyed by address with each value being a
+                dict containing the confirmed and total balances.
+        """
+        found, missing, generation = self._get_recent("get_balance",
+                                                      address_list)
+        if missing:
+            fetched = self.provider.get_balance(missing)
+            self._put_recent("get_balance", fetched, generation)
+            found.update(fetched)
+
+        return {a: found[a] for a in address_list if a in found}
+
+    def get_utxos(self, address_list):
+        """ Provides all unspent transactions associated with each
+            address in address_list.
+
+        Args:
+            address_list (list(str)): List of Base58Check encoded
+                Bitcoin addresses.
+
+        Returns:
+            dict: A dict keyed by address with each value being a list
+                of UnspentTransactionOutput objects.
+        """
+        found, missing, generation = self._get_recent("get_utxos",
+                                                      address_list)
+        if missing:
+            fetched = self.provider.get_utxos(missing)
+            fetched = {a: fetched.get(a, []) for a in missing}
+            self._put_recent("get_utxos", fetched, generation)
+            found.update(fetched)
+
+        ret = defaultdict(list)
+        for a in address_list:
+            if found[a]:
+                ret[a] = list(found[a])
+
+        return ret
+
+    def get_transactions(self, address_list, limit=100, min_block=None):
+        """ Provides transactions associated with each address in address_list.
+
+        Args:
+            address_list (list(str)): List of Base58Check encoded Bitcoin
+                addresses.
+            limit (int): Maximum number of transactions to return.
+            min_block (int): Block height from which to start getting
+                transactions. If None, will get transactions from the
+                entire blockchain.
+
+        Returns:
+            dict: A dict keyed by address with each value being a list
+                of Transaction objects.
+        """
+        keys = [(a, limit, min_block) for a in address_list]
+        found, missing, generation = self._get_recent("get_transactions",
+                                                      keys)
+        if missing:
+            fetched = self._fetch_transactions([k[0] for k in missing],
+                                               limit, min_block)
+            fetched = {(a, limit, min_block): txns
+                       for a, txns in fetched.items()}
+            self._put_recent("get_transactions", fetched, generation)
+            found.update(fetched)
+            self._autosave()
+
+        ret = defaultdict(list)
+        for k in keys:
+            if found[k]:
+                ret[k[0]] = list(found[k])
+
+        return ret
+
+    def _fetch_transactions(self, addresses, limit, min_block):
+        """ Gets the transactions of addresses, from the permanent
+            cache where possible and from the provider otherwise.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+
+        Returns:
+            dict: A dict keyed by address (including the ones without
+                transactions) with each value being a list of
+                transactions.
+        """
+        height = self._current_height()
+
+        if not self.can_limit_by_height:
+            fetched = self.provider.get_transactions(addresses, limit=limit)
+            with self._lock:
+                for a in addresses:
+                    for t in fetched.get(a, []):
+                        if self._is_final(t['metadata'], height):
+                            self._add_final(t)
+
+            return {a: fetched.get(a, []) for a in addresses}
+
+        # Group the addresses by the block from which they need to be
+        # fetched: right after the last block up to which all their
+        # final transactions are cached, unless min_block is past it.
+        groups = defaultdict(list)
+        with self._lock:
+            for a in addresses:
+                start = min_block
+                known = self._addresses.get(a, None)
+                if known is not None and \
+                   (min_block is None or min_block <= known[0] + 1):
+                    start = known[0] + 1
+                groups[start].append(a)
+
+        ret = {}
+        for start in sorted(groups, key=lambda s: -1 if s is None else s):
+            group = groups[start]
+            fetched = self.provider.get_transactions(group,
+                                                     limit=limit,
+                                                     min_block=start)
+            # If the provider hit the limit some transactions may be
+            # missing, so the cache can't be marked complete.
+            complete = sum(len(v) for v in fetched.values()) < limit
+            final_block = height - self.permanent_confirmations + 1
+            with self._lock:
+                for a in group:
+                    known_block, txids = self._addresses.get(a, (-1, []))
+                    txids = list(txids)
+                    cached = [self._from_final(txid, height)
+                              for txid in txids
+                              if self._txns[txid][0]['block'] >=
+                              (min_block or 0)]
+                    self.hits["confirmed_transactions"] += len(cached)
+                    self.misses["confirmed_transactions"] += len(
+                        fetched.get(a, []))
+
+                    for t in fetched.get(a, []):
+                        if self._is_final(t['metadata'], height):
+                            txid = self._add_final(t)
+                            if txid not in txids:
+                                txids.append(txid)
+
+                    if complete and \
+                       (start is None or start <= known_block + 1) and \
+                       final_block > known_block:
+                        self._addresses[a] = (final_block, txids)
+                        self._dirty = True
+
+                    ret[a] = cached + fetched.get(a, [])
+
+        return ret
+
+    def get_transactions_by_id(self, ids):
+        """ Gets transactions by their IDs.
+
+        Args:
+            ids (list(str)): List of TXIDs to retrieve.
+
+        Returns:
+            dict: A dict keyed by TXID of Transaction objects.
+        """
+        height = self._current_height()
+        ret = {}
+        with self._lock:
+            for txid in ids:
+                if txid in self._txns:
+                    ret[txid] = self._from_final(txid, height)
+            self.hits["confirmed_transactions"] += len(ret)
+
+        found, missing, generation = self._get_recent(
+            "get_transactions_by_id", [txid for txid in ids
+                                       if txid not in ret])
+        ret.update(found)
+        if missing:
+            fetched = self.provider.get_transactions_by_id(missing)
+            recent = {}
+            with self._lock:
+                for txid, t in fetched.items():
+                    if self._is_final(t['metadata'], height):
+                        self._add_final(t)
+                    else:
+                        recent[txid] = t
+            self._put_recent("get_transactions_by_id", recent, generation)
+            ret.update(fetched)
+            self._autosave()
+
+        return ret
+
+    def broadcast_transaction(self, transaction):
+        """ Broadcasts a transaction to the Bitcoin network. Balances,
+            UTXOs and recent transactions are dropped from the cache,
+            as the transaction changes them.
+
+        Args:
+            transaction (bytes or str): serialized, signed transaction
+
+        Returns:
+            str: The transaction ID
+        """
+        try:
+            return self.provider.broadcast_transaction(transaction)
+        finally:
+            with self._lock:
+                self._clear_recent()
+
+    def _autosave(self):
+        """ Saves the cache file if there is anything new to save and
+            it wasn't saved in the last SAVE_INTERVAL seconds.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        if self.cache_path is not None and self._dirty and \
+           time.time() - self._last_save > self.SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        """ Writes the permanently cached transactions to cache_path.
+        """
+        if self.cache_path is None:
+            return
+
+        with self._lock:
+            if not self._dirty:
+                return
+
+            txns = {}
+            for txid, (metadata, txn) in self._txns.items():
+                d = dict(metadata)
+                if d['block_hash'] is not None:
+                    d['block_hash'] = str(d['block_hash'])
+                d['transaction'] = txn.to_hex()
+                txns[txid] = d
+
+            data = json.dumps(dict(version=self.CACHE_VERSION,
+                                   testnet=bool(getattr(self.provider,
+                                                        "testnet",
+                                                        False)),
+                                   txns=txns,
+                                   addresses=self._addresses),
+                              sort_keys=True).encode('utf-8')
+            self._dirty = False
+            self._last_save = time.time()
+
+        # Write to a temporary file first so that a crash can't leave
+        # a truncated cache behind.
+        tmp = self.cache_path + ".tmp"
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        with os.fdopen(os.open(tmp, flags=flags, mode=0o600), 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp, self.cache_path)
+
+    def load(self):
+        """ Reads the permanently cached transactions from cache_path.
+
+            A file written by a different version, or for the other
+            network, is ignored.
+        """
+        with open(self.cache_path) as f:
+            try:
+                cache = json.load(f)
+            except ValueError:
+                return
+
+        if cache.get("version", None) != self.CACHE_VERSION or \
+           cache.get("testnet", False) != bool(getattr(self.provider,
+                                                       "testnet",
+                                                       False)):
+            return
+
+        txns = {}
+        for txid, d in cache["txns"].items():
+            txn = Transaction.from_hex(d.pop('transaction'), frozen=True)
+            if d['block_hash'] is not None:
+                d['block_hash'] = Hash(d['block_hash'])
+            txns[txid] = (d, txn)
+
+        with self._lock:
+            self._txns = txns
+            self._addresses = {a: (block, txids)
+                               for a, (block, txids) in
+                               cache["addresses"].items()}
+            self._dirty = False
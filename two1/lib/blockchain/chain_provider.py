@@ -1,9 +1,13 @@
 import arrow
 import json
+import re
+import threading
+import time
 
 from calendar import timegm
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from two1.lib.blockchain import exceptions
 from two1.lib.blockchain.base_provider import BaseProvider
 from two1.lib.bitcoin.hash import Hash
@@ -12,10 +16,43 @@ from two1.lib.bitcoin.txn import TransactionInput
 from two1.lib.bitcoin.txn import TransactionOutput
 from two1.lib.bitcoin.txn import Transaction
 from two1.lib.bitcoin.utils import bytes_to_str
-from two1.lib.bitcoin.utils import pack_var_str
 from two1.lib.bitcoin.script import Script
 
 
+_ISO8601_RE = re.compile(r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.\d+)?"
+                         r"(?:(Z)|([+-])(\d\d):?(\d\d))$")
+
+
+def _timestamp_from_iso8601(s):
+    """ Converts an ISO-8601 date and time, as returned by the API,
+        into a POSIX timestamp (in whole seconds).
+
+        The "YYYY-MM-DDTHH:MM:SS[.fff](Z|+HH:MM)" format the API uses
+        is picked apart with a regular expression, which is much
+        cheaper than a general purpose parser. Anything else is left
+        to arrow.
+
+    Note:
+        THIS IS NOT A PUBLIC API.
+
+    Args:
+        s (str): The date and time.
+
+    Returns:
+        int: The number of seconds since the epoch.
+    """
+    m = _ISO8601_RE.match(s)
+    if m is None:
+        return timegm(arrow.get(s).to('UTC').datetime.timetuple())
+
+    ts = timegm(tuple(int(x) for x in m.group(1, 2, 3, 4, 5, 6)) + (0, 0, 0))
+    if m.group(8):
+        offset = int(m.group(9)) * 3600 + int(m.group(10)) * 60
+        ts += -offset if m.group(8) == '+' else offset
+
+    return ts
+
+
 class ChainProvider(BaseProvider):
     """ Transaction data provider using the chain API
 
@@ -24,16 +61,32 @@ class ChainProvider(BaseProvider):
             api_key_secret (str): chain.com API secret
             testnet (bool, optional): True for testnet, False for
             mainnet (default)
+            connection_pool_size (int, optional): Maximum number of
+            HTTP connections kept open to the service.
+            max_concurrent_requests (int, optional): Maximum number of
+            chunk requests a single call issues at the same time. 1
+            issues them one after another.
     """
+    DEFAULT_MAX_CONCURRENT_REQUESTS = 8
+    # Failed GET requests are retried MAX_RETRIES times, waiting
+    # RETRY_BACKOFF seconds before the first retry and doubling the
+    # wait before each following one.
+    MAX_RETRIES = 3
+    RETRY_BACKOFF = 0.5
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
 
     def __init__(self, api_key_id, api_key_secret, testnet=False,
-                 connection_pool_size=0):
+                 connection_pool_size=0,
+                 max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS):
         super().__init__()
         self.testnet = testnet
         self.auth = (api_key_id, api_key_secret)
         self._set_url()
         self._session = None
+        self._session_lock = threading.Lock()
         self._pool_size = connection_pool_size
+        self._max_concurrent_requests = max(1, max_concurrent_requests)
+        self._executor = None
 
     @property
     def testnet(self):
@@ -51,9 +104,13 @@ class ChainProvider(BaseProvider):
     def _create_session(self):
         import requests
         self._session = requests.Session()
-        if self._pool_size > 0:
-            adapter = requests.adapters.HTTPAdapter(pool_connections=self._pool_size,
-                                                    pool_maxsize=self._pool_size)
+        # Keep enough connections open for all concurrent chunk
+        # requests to reuse one.
+        pool_size = max(self._pool_size, self._max_concurrent_requests)
+        if self._pool_size > 0 or \
+           pool_size > requests.adapters.DEFAULT_POOLSIZE:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                    pool_maxsize=pool_size)
             self._session.mount('http://', adapter)
             self._session.mount('https://', adapter)
         self._session.auth = self.auth
@@ -102,29 +159,32 @@ class ChainProvider(BaseProvider):
         # "amount": 290000
         # },
         # Transaction.DEFAULT_TRANSACTION_VERSION
-        inputs = []
-        outputs = []
         addr_keys = set()
         for i in txn_json["inputs"]:
-            # Chain doesn't return the stuff about script length etc, so
-            # we need to prepend that.
-            script, _ = Script.from_bytes(
-                pack_var_str(bytes.fromhex(i["script_signature_hex"])))
-            inputs.append(TransactionInput(Hash(i["output_hash"]),
-                                           i["output_index"],
-                                           script,
-                                           i["sequence"]))
             if "addresses" in i:
                 addr_keys.add(i["addresses"][0])
-
         for i in txn_json["outputs"]:
-            script, _ = Script.from_bytes(
-                pack_var_str(bytes.fromhex(i["script_hex"])))
-            outputs.append(TransactionOutput(i["value"],
-                                             script))
             if "addresses" in i:
                 addr_keys.add(i["addresses"][0])
 
+        # If the API gives us the serialized transaction, parse it
+        # with the binary parser: it's as fast as putting it together
+        # from the JSON fields and also gets the version right.
+        if txn_json.get("hex"):
+            return Transaction.from_hex(txn_json["hex"]), addr_keys
+
+        # Chain doesn't return the stuff about script length etc, but
+        # Script() takes the raw script bytes directly and only
+        # disassembles/parses them if something asks for it.
+        inputs = [TransactionInput(Hash(i["output_hash"]),
+                                   i["output_index"],
+                                   Script(bytes.fromhex(i["script_signature_hex"])),
+                                   i["sequence"])
+                  for i in txn_json["inputs"]]
+        outputs = [TransactionOutput(i["value"],
+                                     Script(bytes.fromhex(i["script_hex"])))
+                   for i in txn_json["outputs"]]
+
         txn = Transaction(Transaction.DEFAULT_TRANSACTION_VERSION,
                           inputs,
                           outputs,
@@ -132,15 +192,101 @@ class ChainProvider(BaseProvider):
 
         return txn, addr_keys
 
+    @staticmethod
+    def metadata_from_json(txn_json):
+        """ Extracts the metadata returned along with transactions by
+            get_transactions() and get_transactions_by_id() from a
+            transaction returned by the API.
+
+        Args:
+            txn_json (dict): A transaction as returned by the API.
+
+        Returns:
+            dict: The block height, block hash, network time and
+                number of confirmations of the transaction.
+        """
+        block_hash = None
+        if txn_json['block_hash']:
+            block_hash = Hash(txn_json['block_hash'])
+
+        return dict(block=txn_json['block_height'],
+                    block_hash=block_hash,
+                    network_time=_timestamp_from_iso8601(
+                        txn_json['chain_received_at']),
+                    confirmations=txn_json['confirmations'])
+
     @staticmethod
     def _list_chunks(lst, chunk_size):
         for i in range(0, len(lst), chunk_size):
             yield lst[i:i + chunk_size]
 
+    def _map_chunks(self, func, chunks):
+        """ Calls func on every chunk, with up to max_concurrent_requests
+            calls running at the same time.
+
+            The results are returned in the same order as chunks no
+            matter in which order the calls finish, so merging them
+            gives the same result as calling func on each chunk one
+            after another. If a call raises, the calls that haven't
+            started yet are cancelled and the exception of the first
+            failed chunk is raised.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+
+        Args:
+            func (function): Function taking a single chunk.
+            chunks (iterable): Chunks as returned by _list_chunks().
+
+        Returns:
+            list: The return value of func for each chunk.
+        """
+        chunks = list(chunks)
+        if len(chunks) <= 1 or self._max_concurrent_requests == 1:
+            return [func(c) for c in chunks]
+
+        with self._session_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._max_concurrent_requests)
+
+        futures = [self._executor.submit(func, c) for c in chunks]
+        try:
+            return [f.result() for f in futures]
+        finally:
+            for f in futures:
+                f.cancel()
+
     def _request(self, method, path, **kwargs):
+        """ Sends a request to the service.
+
+            GET requests that could not be sent, timed out or failed
+            with one of RETRY_STATUS_CODES are retried up to MAX_RETRIES
+            times with exponential backoff. Other requests are not
+            retried as they may not be idempotent.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        retries = self.MAX_RETRIES if method == "GET" else 0
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(self.RETRY_BACKOFF * 2 ** (attempt - 1))
+            try:
+                return self._request_once(method, path,
+                                          retry=attempt < retries,
+                                          **kwargs)
+            except _RetryableError:
+                continue
+            except exceptions.DataProviderUnavailableError:
+                if attempt == retries:
+                    raise
+
+    def _request_once(self, method, path, retry=False, **kwargs):
         import requests
-        if self._session is None:
-            self._create_session()
+        with self._session_lock:
+            if self._session is None:
+                self._create_session()
 
         url = self.server_url + path
         result = None
@@ -150,12 +296,17 @@ class ChainProvider(BaseProvider):
                                            auth=self.auth,
                                            **kwargs)
 
+            if retry and result.status_code in self.RETRY_STATUS_CODES:
+                raise _RetryableError(result.status_code)
+
             # A non 200 status_code from Chain API is an exception
             if result.status_code != 200:
                 data = result.json()
                 raise exceptions.DataProviderError(data['message'])
             return result
 
+        except _RetryableError:
+            raise
         except requests.exceptions.ConnectionError:
             raise exceptions.DataProviderUnavailableError("Could not connect to service.")
         except requests.exceptions.Timeout:
@@ -189,10 +340,13 @@ class ChainProvider(BaseProvider):
             dict: A dict keyed by address with each value being a dict
             containing the confirmed and total balances.
         """
-        ret = {}
-        for addresses in self._list_chunks(address_list, 25):
+        def get_chunk(addresses):
             r = self._request("GET", "addresses/" + ",".join(addresses))
-            data = r.json()
+            return r.json()
+
+        ret = {}
+        for data in self._map_chunks(get_chunk,
+                                     self._list_chunks(address_list, 25)):
 
             # for each address
 
@@ -232,22 +386,18 @@ class ChainProvider(BaseProvider):
             Transaction
                objects.
         """
-        ret = defaultdict(list)
-        for addresses in self._list_chunks(address_list, 199):
-            r = self._request("GET", "addresses/" + ",".join(addresses)
-                              + "/transactions?limit={}".format(limit))
-            txn_data = r.json()
+        def get_chunk(addresses):
+            r = self._request("GET", self._transactions_path(addresses,
+                                                             limit,
+                                                             min_block))
+            return addresses, r.json()
 
+        ret = defaultdict(list)
+        chunks = self._list_chunks(address_list, 199)
+        for addresses, txn_data in self._map_chunks(get_chunk, chunks):
+            addresses = set(addresses)
             for data in txn_data:
-                block_hash = None
-                if data['block_hash']:
-                    block_hash = Hash(data['block_hash'])
-                metadata = dict(block=data['block_height'],
-                                block_hash=block_hash,
-                                network_time=timegm(arrow.get(
-                                    data['chain_received_at']).datetime.timetuple()),
-                                confirmations=data['confirmations'])
-
+                metadata = self.metadata_from_json(data)
                 txn, addr_keys = self.txn_from_json(data)
                 for addr in addr_keys:
                     if addr in addresses:
@@ -256,6 +406,18 @@ class ChainProvider(BaseProvider):
 
         return ret
 
+    def _transactions_path(self, addresses, limit, min_block):
+        """ Returns the path to get the transactions of addresses.
+
+            The Chain API can't limit transactions by block height, so
+            min_block is ignored.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        return "addresses/" + ",".join(addresses) \
+            + "/transactions?limit={}".format(limit)
+
     def get_transactions_by_id(self, ids):
         """ Gets transactions by their IDs.
 
@@ -265,20 +427,17 @@ class ChainProvider(BaseProvider):
         Returns:
             dict: A dict keyed by TXID of Transaction objects.
         """
+        def get_chunk(txids):
+            r = self._request("GET", "transactions/%s" % txids[0])
+            return txids[0], r
+
         ret = {}
-        for txid in ids:
-            r = self._request("GET", "transactions/%s" % txid)
+        for txid, r in self._map_chunks(get_chunk,
+                                        self._list_chunks(list(ids), 1)):
             data = r.json()
 
             if r.status_code == 200:
-                block_hash = None
-                if data['block_hash']:
-                    block_hash = Hash(data['block_hash'])
-                metadata = dict(block=data['block_height'],
-                                block_hash=block_hash,
-                                network_time=timegm(arrow.get(
-                                    data['chain_received_at']).datetime.timetuple()),
-                                confirmations=data['confirmations'])
+                metadata = self.metadata_from_json(data)
                 txn, _ = self.txn_from_json(data)
                 assert str(txn.hash) == txid
 
@@ -299,11 +458,14 @@ class ChainProvider(BaseProvider):
             dict: A dict keyed by address with each value being a list of
                UnspentTransactionOutput objects.
         """
-        ret = defaultdict(list)
-        for addresses in self._list_chunks(address_list, 199):
+        def get_chunk(addresses):
             r = self._request("GET", "addresses/" + ",".join(addresses)
                               + "/unspents")
-            data = r.json()
+            return r.json()
+
+        ret = defaultdict(list)
+        for data in self._map_chunks(get_chunk,
+                                     self._list_chunks(address_list, 199)):
 
             # for each address
             # {
@@ -324,8 +486,7 @@ class ChainProvider(BaseProvider):
             for d in data:
                 address = d["addresses"][0]
                 txn_hash = Hash(d["transaction_hash"])
-                script, _ = Script.from_bytes(
-                    pack_var_str(bytes.fromhex(d["script_hex"])))
+                script = Script(bytes.fromhex(d["script_hex"]))
                 ret[address].append(UnspentTransactionOutput(txn_hash,
                                                              d["output_index"],
                                                              d["value"],
@@ -381,3 +542,13 @@ class ChainProvider(BaseProvider):
             ret = data['height']
 
         return ret
+
+
+class _RetryableError(Exception):
+    """ Raised by ChainProvider._request_once() when a request failed
+        with a status code that is worth retrying.
+
+    Note:
+        THIS IS NOT A PUBLIC API.
+    """
+    pass
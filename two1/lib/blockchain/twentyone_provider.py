@@ -1,11 +1,4 @@
-from calendar import timegm
-from collections import defaultdict
-
-import arrow
-
-
 from urllib.parse import urljoin
-from two1.lib.bitcoin.hash import Hash
 from two1.lib.blockchain.chain_provider import ChainProvider
 
 
@@ -18,11 +11,13 @@ class TwentyOneProvider(ChainProvider):
     DEFAULT_HOST = "https://dotco-devel-pool2.herokuapp.com"
 
     def __init__(self, twentyone_host_name=DEFAULT_HOST, testnet=False,
-                 connection_pool_size=0):
+                 connection_pool_size=0,
+                 max_concurrent_requests=ChainProvider.DEFAULT_MAX_CONCURRENT_REQUESTS):
         self.host_name = twentyone_host_name
 
         super().__init__(None, None, testnet,
-                         connection_pool_size=connection_pool_size)
+                         connection_pool_size=connection_pool_size,
+                         max_concurrent_requests=max_concurrent_requests)
         self.testnet = testnet
         self.auth = None
         self.can_limit_by_height = True
@@ -30,46 +25,16 @@ class TwentyOneProvider(ChainProvider):
     def _set_url(self):
         self.server_url = urljoin(self.host_name, "blockchain") + "/" + self.chain + "/"
 
-    def get_transactions(self, address_list, limit=100, min_block=None):
-        """ Provides transactions associated with each address in address_list.
-
-        Args:
-            address_list (list(str)): List of Base58Check encoded Bitcoin
-            addresses.
-            limit (int): Maximum number of transactions to return.
-            min_block (int): Block height from which to start getting
-                transactions. If None, will get transactions from the
-                entire blockchain.
+    def _transactions_path(self, addresses, limit, min_block):
+        """ Returns the path to get the transactions of addresses,
+            starting at block min_block if it's given.
 
-        Returns:
-            dict: A dict keyed by address with each value being a list of
-            Transaction
-               objects.
+        Note:
+            THIS IS NOT A PUBLIC API.
         """
-        ret = defaultdict(list)
-        for addresses in self._list_chunks(address_list, 199):
-            path = "addresses/" + ",".join(addresses) \
-                   + "/transactions?limit={}".format(limit)
-            if min_block:
-                path += "&min_block={}".format(min_block)
-
-            r = self._request("GET", path)
-            txn_data = r.json()
-
-            for data in txn_data:
-                block_hash = None
-                if data['block_hash']:
-                    block_hash = Hash(data['block_hash'])
-                metadata = dict(block=data['block_height'],
-                                block_hash=block_hash,
-                                network_time=timegm(arrow.get(
-                                    data['chain_received_at']).datetime.timetuple()),
-                                confirmations=data['confirmations'])
-
-                txn, addr_keys = self.txn_from_json(data)
-                for addr in addr_keys:
-                    if addr in addresses:
-                        ret[addr].append(dict(metadata=metadata,
-                                              transaction=txn))
+        path = "addresses/" + ",".join(addresses) \
+               + "/transactions?limit={}".format(limit)
+        if min_block:
+            path += "&min_block={}".format(min_block)
 
-        return ret
+        return path
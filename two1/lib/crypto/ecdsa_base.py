@@ -121,6 +121,28 @@ class EllipticCurveBase(object):
         """
         raise NotImplementedError
 
+    def verify_batch(self, items, do_hash=True):
+        """ Verifies a number of signatures at once.
+
+            Implementations may amortize work that is common to the
+            signatures (key setup, modular inversions, etc.) across
+            the batch. The default implementation simply calls
+            verify() for each item.
+
+        Args:
+            items (list(tuple)): A list of (message, signature,
+               public_key) tuples with the same meaning as the
+               arguments to verify().
+            do_hash (bool): True if the messages should be hashed prior
+               to verifying, False if not.
+
+        Returns:
+            list(bool): Whether each signature is verified, in the
+               same order as items.
+        """
+        return [self.verify(message, signature, public_key, do_hash)
+                for message, signature, public_key in items]
+
     def _nonce_random(self):
         return random.SystemRandom().randrange(1, self.n - 1)
 
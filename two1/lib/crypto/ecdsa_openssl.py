@@ -432,6 +432,52 @@ class EllipticCurve(EllipticCurveBase):
 
         return bool(verified)
 
+    def verify_batch(self, items, do_hash=True):
+        """ Verifies a number of signatures at once.
+
+            An OpenSSL key object is only set up once for each distinct
+            public key in items and is shared by all of its signatures.
+
+        Args:
+            items (list(tuple)): A list of (message, signature,
+               public_key) tuples with the same meaning as the
+               arguments to verify().
+            do_hash (bool): True if the messages should be hashed prior
+               to verifying, False if not.
+
+        Returns:
+            list(bool): Whether each signature is verified, in the
+               same order as items.
+        """
+        rv = []
+        keys = {}
+        try:
+            for message, signature, public_key in items:
+                key_id = (public_key.x, public_key.y, public_key.infinity)
+                key = keys.get(key_id)
+                if key is None:
+                    key = c_void_p(ossl.lc.EC_KEY_new_by_curve_name(self.curve_name))
+                    keys[key_id] = key
+                    ossl.set_public_key_from_ints(key=key,
+                                                  x=public_key.x,
+                                                  y=public_key.y,
+                                                  infinity=public_key.infinity)
+
+                sig = ossl.sig_new_from_ints(signature.x, signature.y)
+                hashed = self.hash_function(message).digest() if do_hash else message
+                dig_buf = create_string_buffer(hashed)
+
+                # ECDSA_do_verify() returns -1 on error
+                verified = ossl.lc.ECDSA_do_verify(dig_buf, len(hashed), sig, key)
+                rv.append(verified == 1)
+
+                ossl.lc.ECDSA_SIG_free(sig)
+        finally:
+            for key in keys.values():
+                ossl.lc.EC_KEY_free(key)
+
+        return rv
+
 
 class p256(EllipticCurve):
     curve_name = ossl.lc.OBJ_sn2nid(c_char_p(b"prime256v1"))
@@ -64,6 +64,50 @@ def montgomery_ladder(k, p):
     return r[0]
 
 
+def wnaf(k, w):
+    """ Computes the width-w non-adjacent form of k.
+
+        Every non-zero digit is odd and less than 2**(w-1) in absolute
+        value, and any w consecutive digits contain at most one
+        non-zero digit. This makes it well suited to multiplying a
+        point by a public scalar, but the pattern of additions leaks
+        the scalar, so it must not be used with secret scalars.
+
+    Args:
+        k (int): The (non-negative) scalar to convert.
+        w (int): The window width.
+
+    Returns:
+        list(int): The digits of k, least significant first.
+    """
+    digits = []
+    full = 1 << w
+    half = 1 << (w - 1)
+    while k:
+        if k & 1:
+            d = k & (full - 1)
+            if d >= half:
+                d -= full
+            k -= d
+        else:
+            d = 0
+        digits.append(d)
+        k >>= 1
+
+    return digits
+
+
+def _odd_multiples(p, w):
+    """ Returns [p, 3p, 5p, ..., (2**(w-1) - 1)p] for use with wnaf().
+    """
+    p2 = p.double()
+    rv = [p]
+    for i in range(1, 1 << (w - 2)):
+        rv.append(rv[-1] + p2)
+
+    return rv
+
+
 class ECPoint(object):
     """ Base class for any elliptic curve point implementations.
 
@@ -505,6 +549,11 @@ class EllipticCurve(EllipticCurveBase):
         h (int): The curve co-factor.
         hash_function (function): The function to use for hashing messages.
     """
+    # wNAF widths for multiples of G and of other points with public
+    # scalars.
+    G_WNAF_WIDTH = 7
+    WNAF_WIDTH = 5
+
     @staticmethod
     def _extended_gcd(aa, bb):
         # https://en.wikipedia.org/wiki/Extended_Euclidean_algorithm
@@ -533,6 +582,39 @@ class EllipticCurve(EllipticCurveBase):
             raise ValueError("in EllipticCurve.modinv: g (%d) != 1, x = %d, y = %d" % (g, x, y))
         return x % n
 
+    @staticmethod
+    def batch_modinv(values, n):
+        """ Provides the modular inverses of all the values wrt n.
+
+            This uses Montgomery's trick so that only a single
+            modular inversion is done for the whole list.
+
+        Args:
+            values (list(int)): numbers to find modular inverses of.
+               None of them may be 0 mod n.
+            n (int): modulus
+
+        Returns:
+            list(int): The modular inverses, in the same order as values.
+        """
+        if not values:
+            return []
+
+        prefix = []
+        acc = 1
+        for a in values:
+            acc = (acc * a) % n
+            prefix.append(acc)
+
+        inv = EllipticCurve.modinv(acc, n)
+        rv = [0] * len(values)
+        for i in reversed(range(1, len(values))):
+            rv[i] = (inv * prefix[i - 1]) % n
+            inv = (inv * values[i]) % n
+        rv[0] = inv
+
+        return rv
+
     @staticmethod
     def modsqrt(a, n):
         if a == 0:
@@ -556,6 +638,9 @@ class EllipticCurve(EllipticCurveBase):
         self.nlen = self.n.bit_length()
         self.plen = self.p.bit_length()
 
+        # Precomputed multiples of G, built on first use.
+        self._g_wnaf_table = None
+
     def __eq__(self, other_curve):
         return (self.a == other_curve.a) and (self.b == other_curve.b) and \
             (self.p == other_curve.p) and (self.n == other_curve.n) and (self.G == other_curve.G)
@@ -580,6 +665,59 @@ class EllipticCurve(EllipticCurveBase):
         """
         return ECPointJacobian(self, self.G.x, self.G.y, 1)
 
+    def _base_wnaf_table(self):
+        """ Returns the odd multiples of G used with wnaf(), building
+            them on first use.
+
+        Returns:
+            list(ECPointJacobian): The odd multiples of G.
+        """
+        if self._g_wnaf_table is None:
+            self._g_wnaf_table = [
+                pt.to_affine().to_jacobian()
+                for pt in _odd_multiples(self.base_point, self.G_WNAF_WIDTH)]
+
+        return self._g_wnaf_table
+
+    def _mul_double(self, u, v, q, q_table=None):
+        """ Computes u * G + v * q using interleaved wNAF
+            multiplication (Shamir's trick).
+
+            The running time depends on u and v, so this must only be
+            used with public scalars (e.g. when verifying).
+
+        Args:
+            u (int): The (non-negative) scalar to multiply G by.
+            v (int): The (non-negative) scalar to multiply q by.
+            q (ECPointJacobian): The second point.
+            q_table (list(ECPointJacobian)): The odd multiples of q
+               returned by _odd_multiples(q, WNAF_WIDTH), if already
+               computed.
+
+        Returns:
+            ECPointJacobian: u * G + v * q
+        """
+        u_naf = wnaf(u, self.G_WNAF_WIDTH)
+        v_naf = wnaf(v, self.WNAF_WIDTH)
+        g_table = self._base_wnaf_table() if u_naf else []
+        if q_table is None:
+            q_table = _odd_multiples(q, self.WNAF_WIDTH) if v_naf else []
+
+        r = ECPointJacobian(self, 0, 1, 0, True)
+        for i in reversed(range(max(len(u_naf), len(v_naf)))):
+            if not r.infinity:
+                r = r.double()
+
+            for naf, table in ((u_naf, g_table), (v_naf, q_table)):
+                d = naf[i] if i < len(naf) else 0
+                if d > 0:
+                    r = r + table[d >> 1]
+                elif d < 0:
+                    pt = table[-d >> 1]
+                    r = r + ECPointJacobian(self, pt.x, self.p - pt.y, pt.z)
+
+        return r
+
     def y_from_x(self, x):
         """ Computes the y component corresponding to x.
 
@@ -678,13 +816,15 @@ class EllipticCurve(EllipticCurveBase):
                     y = ys[k ^ 1]
                 R = ECPointJacobian(self, r, y, 1)
 
-                if not (R * self.n).to_affine().infinity:
+                if not self._mul_double(0, self.n, R).infinity:
                     continue
 
                 z = int.from_bytes(self.hash_function(message).digest()[:num_bytes], 'big')
 
-                zG = self.base_point * z
-                pub_key = ((R  * s - zG) * r_modinv).to_affine()
+                # pub_key = r^-1 * (s * R - z * G)
+                pub_key = self._mul_double((-z * r_modinv) % self.n,
+                                           (s * r_modinv) % self.n,
+                                           R).to_affine()
 
                 rv.append((pub_key, 2 * i + k))
 
@@ -736,8 +876,6 @@ class EllipticCurve(EllipticCurveBase):
         hashed = self.hash_function(message).digest() if do_hash else message
         z = int.from_bytes(hashed, 'big')
 
-        G = self.base_point
-
         assert public_key.x >= 1 and public_key.x <= (self.n - 1)
         assert public_key.y >= 1 and public_key.y <= (self.n - 1)
 
@@ -745,10 +883,65 @@ class EllipticCurve(EllipticCurveBase):
         u = (z * w) % self.n
 
         v = (r * w) % self.n
-        pt = (G * u + ECPointJacobian.from_affine(public_key) * v).to_affine()
+        pt = self._mul_double(u, v,
+                              ECPointJacobian.from_affine(public_key)).to_affine()
 
         return r == (pt.x % self.n)
 
+    def verify_batch(self, items, do_hash=True):
+        """ Verifies a number of signatures at once.
+
+            The inverses of all the s values are computed with a single
+            modular inversion, the precomputed multiples of each
+            distinct public key are shared by all of its signatures
+            and the result of each double-scalar multiplication is
+            checked in Jacobian coordinates, without an inversion.
+
+        Args:
+            items (list(tuple)): A list of (message, signature,
+               public_key) tuples with the same meaning as the
+               arguments to verify().
+            do_hash (bool): True if the messages should be hashed prior
+               to verifying, False if not.
+
+        Returns:
+            list(bool): Whether each signature is verified, in the
+               same order as items.
+        """
+        items = list(items)
+        rv = [False] * len(items)
+
+        valid = [i for i, (message, signature, public_key) in enumerate(items)
+                 if 1 <= signature.x < self.n and 1 <= signature.y < self.n and
+                 not public_key.infinity]
+        s_invs = self.batch_modinv([items[i][1].y for i in valid], self.n)
+
+        q_tables = {}
+        for i, w in zip(valid, s_invs):
+            message, signature, public_key = items[i]
+            r = signature.x
+
+            hashed = self.hash_function(message).digest() if do_hash else message
+            z = int.from_bytes(hashed, 'big')
+
+            q = ECPointJacobian(self, public_key.x, public_key.y, 1)
+            key = (public_key.x, public_key.y)
+            if key not in q_tables:
+                q_tables[key] = _odd_multiples(q, self.WNAF_WIDTH)
+
+            pt = self._mul_double((z * w) % self.n, (r * w) % self.n,
+                                  q, q_tables[key])
+            if pt.infinity:
+                continue
+
+            # pt.x / pt.z^2 == r (mod n), checked without inverting pt.z
+            # by trying both x-coordinates that reduce to r.
+            rv[i] = (r * pt.z2 - pt.x) % self.p == 0 or \
+                (r + self.n < self.p and
+                 ((r + self.n) * pt.z2 - pt.x) % self.p == 0)
+
+        return rv
+
 
 class p256(EllipticCurve):
     """ P-256 NIST-defined curve
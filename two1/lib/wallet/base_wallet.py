@@ -135,6 +135,16 @@ class BaseWallet(object):
         """
         raise NotImplementedError('Abstract class, `broadcast_transaction` must be overridden')
 
+    def release_transaction(self, tx):
+        """ Releases the funds a transaction made with
+            make_signed_transaction_for() set aside, when it will not
+            be broadcast. Does nothing by default.
+
+        Args:
+            tx (str): Hex string serialization of the transaction.
+        """
+        pass
+
     def make_signed_transaction_for(self, address, amount):
         """ Makes a raw signed unbrodcasted transaction for the specified amount.
 
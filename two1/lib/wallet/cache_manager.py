@@ -26,8 +26,16 @@ class CacheManager(object):
     PROVISIONAL_TXN_TIMEOUT = 24 * 60  # 24 hours
     CACHE_VERSION = "0.2.0"
 
+    # Changes are appended to a journal next to the cache file and
+    # folded into a new snapshot once the journal has more than this
+    # many records (or more records than there are transactions).
+    JOURNAL_SUFFIX = ".journal"
+    JOURNAL_COMPACT_MIN = 1000
+
     def __init__(self, testnet=False):
         self._address_cache = {}
+        # Reverse index of _address_cache: address -> (account, chain, index)
+        self._address_paths = {}
         self._txns_by_addr = {}
         self._deposits_for_addr = {}
         self._spends_for_addr = {}
@@ -35,8 +43,27 @@ class CacheManager(object):
         self._outputs_cache = {}
         self._txn_cache = {}
 
+        # Index of UTXOs and balances by address, maintained as
+        # outputs change status. See _index_output().
+        self._output_addrs = {}
+        self._spend_addrs = {}
+        self._indexed_outputs = {}
+        self._utxos_by_addr = {}
+        self._balances_by_addr = {}
+
+        # Objects (e.g. a UTXOPool) told about every change to the
+        # UTXOs. See add_utxo_listener().
+        self._utxo_listeners = []
+
         self._dirty = False
 
+        # Records not yet appended to the journal, the cache file
+        # whose snapshot + journal they are relative to and the
+        # number of records already in that journal.
+        self._journal = []
+        self._snapshot_file = None
+        self._journal_len = 0
+
         self._last_block = None
 
         self.testnet = testnet
@@ -54,6 +81,7 @@ class CacheManager(object):
     def last_block(self, b):
         if self._last_block is None or b > self._last_block:
             self._last_block = b
+            self._journal.append(dict(op="last_block", block=b))
             self._dirty = True
 
     def _serialize_cache(self, cache):
@@ -85,15 +113,41 @@ class CacheManager(object):
             by default, nothing will be written. However, this can be
             modified by setting force=True.
 
+            Only the changes made since the last write are appended
+            to a journal file next to filename. The whole cache is
+            only written out (as a snapshot, replacing the journal)
+            when forced, when filename is not the file the cache was
+            loaded from or last written to, or when the journal has
+            grown too large.
+
         Args:
             filename (str): The full path of the file to write the
                 caches to. If the file exists, it will be overwritten.
-            force (bool): Forces a write to the file even if the caches
-                are clean.
+            force (bool): Forces a snapshot to be written even if the
+                caches are clean.
         """
         if not self._dirty and not force:
             return
 
+        p = os.path.abspath(filename)
+        compact_at = max(self.JOURNAL_COMPACT_MIN, len(self._txn_cache))
+        if force or p != self._snapshot_file or not os.path.exists(p) or \
+           self._journal_len + len(self._journal) > compact_at:
+            self._write_snapshot(p)
+        elif self._journal:
+            self._append_journal(p)
+
+        self._dirty = False
+
+    def _write_snapshot(self, p):
+        """ Writes out the whole cache to p and removes its journal.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+
+        Args:
+            p (str): The absolute path of the cache file.
+        """
         # All we really need to serialize is the address and txn caches
         d = json.dumps(dict(addresses=self._address_cache,
                             txns=self._serialize_cache(self._txn_cache),
@@ -101,13 +155,41 @@ class CacheManager(object):
                             version=self.CACHE_VERSION),
                        sort_keys=True).encode('utf-8')
 
-        p = os.path.abspath(filename)
-
+        # Write to a temporary file first so that a crash can't
+        # leave a truncated snapshot behind.
+        tmp = p + ".tmp"
         flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
-        with os.fdopen(os.open(p, flags=flags, mode=0o700), 'wb') as fp:
+        with os.fdopen(os.open(tmp, flags=flags, mode=0o700), 'wb') as fp:
             fp.write(d)
+        os.replace(tmp, p)
 
-        self._dirty = False
+        if os.path.exists(p + self.JOURNAL_SUFFIX):
+            os.remove(p + self.JOURNAL_SUFFIX)
+
+        self._journal = []
+        self._journal_len = 0
+        self._snapshot_file = p
+
+    def _append_journal(self, p):
+        """ Appends the pending journal records to the journal of the
+            cache file p.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+
+        Args:
+            p (str): The absolute path of the cache file.
+        """
+        d = "".join(json.dumps(r, sort_keys=True) + "\n"
+                    for r in self._journal).encode('utf-8')
+
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        with os.fdopen(os.open(p + self.JOURNAL_SUFFIX, flags=flags,
+                               mode=0o700), 'wb') as fp:
+            fp.write(d)
+
+        self._journal_len += len(self._journal)
+        self._journal = []
 
     def load_from_dict(self, d, prune_provisional=True):
         """ Loads the cache manager from a dict
@@ -130,23 +212,61 @@ class CacheManager(object):
                                                        for k3, v3 in v2.items()}
                                              for k2, v2 in v1.items()}
                                    for k1, v1 in d['addresses'].items()}
+            self._address_paths = {
+                address: (acct_index, chain, index)
+                for acct_index, chains in self._address_cache.items()
+                for chain, addrs in chains.items()
+                for index, address in addrs.items()}
 
         if "txns" in d:
-            now = time.time()
-            _age_seconds = 60 * self.PROVISIONAL_TXN_TIMEOUT
             for txid in d['txns']:
-                t = WalletTransaction._deserialize(d['txns'][txid])
-                if t.provisional:
-                    if not prune_provisional or \
-                       now - t.provisional < _age_seconds:
-                        self.insert_txn(t, mark_provisional=True)
-                else:
-                    self.insert_txn(t, mark_provisional=False)
+                self._load_txn(d['txns'][txid], prune_provisional)
+
+        if self._utxo_listeners:
+            utxos = self._all_utxos()
+            for listener in self._utxo_listeners:
+                listener.load(utxos)
 
+        # Whatever file this gets written to needs a full snapshot.
+        self._journal = []
+        self._snapshot_file = None
         self._dirty = True
 
+    def _load_txn(self, txn_dict, prune_provisional):
+        """ Inserts a serialized transaction read from a cache file.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+
+        Args:
+            txn_dict (dict): The serialized WalletTransaction.
+            prune_provisional (bool): If True, does not insert
+                provisionally-marked txns that are older than
+                self.PROVISIONAL_TXN_TIMEOUT.
+        """
+        t = WalletTransaction._deserialize(txn_dict)
+        if t.provisional:
+            _age_seconds = 60 * self.PROVISIONAL_TXN_TIMEOUT
+            if not prune_provisional or \
+               time.time() - t.provisional < _age_seconds:
+                self.insert_txn(t, mark_provisional=True)
+        else:
+            self.insert_txn(t, mark_provisional=False)
+
+    def cache_exists(self, filename):
+        """ Returns whether there is a cache to load for filename.
+
+        Args:
+            filename (str): The full path of the cache file.
+
+        Returns:
+            bool: True if load_from_file(filename) has something to load.
+        """
+        return os.path.exists(filename)
+
     def load_from_file(self, filename):
-        """ Loads the dicts from a JSON-serialized file.
+        """ Loads the dicts from a JSON-serialized file and replays
+            any journal written after it.
 
         Args:
             filename (str): The full path of the file containing the
@@ -157,6 +277,50 @@ class CacheManager(object):
             cache = json.load(cf)
 
         self.load_from_dict(cache)
+        if cache.get("version", None) != self.CACHE_VERSION:
+            return
+
+        num_records = 0
+        complete = True
+        journal_file = cache_file + self.JOURNAL_SUFFIX
+        if os.path.exists(journal_file):
+            with open(journal_file) as jf:
+                for line in jf:
+                    try:
+                        r = json.loads(line)
+                    except ValueError:
+                        # Only the last record can be incomplete, if
+                        # the process died while appending it.
+                        complete = False
+                        break
+                    self._replay(r)
+                    num_records += 1
+
+        self._journal = []
+        self._journal_len = num_records
+        # Don't append after an incomplete record: write a new
+        # snapshot instead.
+        self._snapshot_file = cache_file if complete else None
+
+    def _replay(self, record):
+        """ Applies a journal record to the cache.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+
+        Args:
+            record (dict): A record written by _append_journal().
+        """
+        op = record['op']
+        if op == "txn":
+            self._load_txn(record['txn'], prune_provisional=True)
+        elif op == "delete_txn":
+            self._delete_txn(record['txid'])
+        elif op == "address":
+            self.insert_address(record['account'], record['chain'],
+                                record['index'], record['address'])
+        elif op == "last_block":
+            self.last_block = record['block']
 
     def insert_address(self, acct_index, chain, index, address):
         """ Inserts an address into the cache
@@ -179,9 +343,18 @@ class CacheManager(object):
             self._address_cache[acct_index] = {0: {}, 1: {}}
 
         self._address_cache[acct_index][chain][index] = address
+        self._address_paths[address] = (acct_index, chain, index)
 
+        self._journal.append(dict(op="address", account=acct_index,
+                                  chain=chain, index=index, address=address))
         self._dirty = True
 
+        # UTXOs for the address may have been inserted before it was
+        # known to belong to an account.
+        if self._utxo_listeners and address in self._utxos_by_addr:
+            for txid, i in list(self._utxos_by_addr[address].keys()):
+                self._notify_utxo_listeners(txid, i)
+
     def get_address(self, acct_index, chain, index):
         """ Returns the address for chain/index, if it exists in the cache
 
@@ -204,6 +377,20 @@ class CacheManager(object):
 
         return rv
 
+    def lookup_paths(self, addresses):
+        """ Returns the derivation paths of addresses in the cache.
+
+        Args:
+            addresses (iterable(str)): The addresses to look up.
+
+        Returns:
+            dict: Keyed by address, with (account index, chain, index)
+                tuples as values. Only addresses in the cache are
+                included.
+        """
+        paths = self._address_paths
+        return {addr: paths[addr] for addr in addresses if addr in paths}
+
     def get_addresses_for_chain(self, acct_index, chain):
         """ Returns all addresses for a particular chain, in order by
             their index in the chain.
@@ -262,6 +449,10 @@ class CacheManager(object):
                 are not also seen by normal transaction
                 updates/insertions within a certain time period.
         """
+        # Cached transactions are hashed and serialized repeatedly
+        # (comparisons, lookups, writing the cache file), so have them
+        # cache their serialization.
+        wallet_txn.freeze()
         txid = str(wallet_txn.hash)
 
         # Check if it's already in with no change in status
@@ -326,6 +517,9 @@ class CacheManager(object):
                 x['spend_txid'] = txid
                 x['spend_index'] = i
 
+            self._spend_addrs[(out_txid, inp.outpoint_index)] = addrs['inputs'][i]
+            self._index_output(out_txid, inp.outpoint_index)
+
         for i, out in enumerate(wallet_txn.outputs):
             if i in self._outputs_cache[txid]:
                 o = self._outputs_cache[txid][i]
@@ -341,9 +535,13 @@ class CacheManager(object):
                                                     spend_txid=None,
                                                     spend_index=None)
 
+            self._output_addrs[(txid, i)] = addrs['outputs'][i]
+            self._index_output(txid, i)
+
         self._insert_txid(txid, addrs['inputs'], 'input')
         self._insert_txid(txid, addrs['outputs'], 'output')
 
+        self._journal.append(dict(op="txn", txn=wallet_txn._serialize()))
         self._dirty = True
 
     def _insert_txid(self, txid, addresses, inout):
@@ -380,6 +578,133 @@ class CacheManager(object):
                     self._txns_by_addr[a] = set()
                 self._txns_by_addr[a].add(_txid)
 
+    def _index_output(self, txid, index):
+        """ Updates the per-address UTXO and balance indices after the
+            outputs cache entry for txid:index has changed.
+
+            The previous contribution of the output to the indices is
+            backed out and its current one added in, so the indices
+            always reflect the outputs cache without having to rescan it.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+
+        Args:
+            txid (str): The txid of the output.
+            index (int): The index of the output within the transaction.
+        """
+        key = (txid, index)
+        for addr, confirmed, total in self._indexed_outputs.pop(key, []):
+            balance = self._balances_by_addr[addr]
+            balance[0] -= confirmed
+            balance[1] -= total
+            if addr in self._utxos_by_addr:
+                self._utxos_by_addr[addr].pop(key, None)
+
+        o = self._outputs_cache.get(txid, {}).get(index, None)
+        if o is None or o['output'] is None:
+            if self._utxo_listeners:
+                self._notify_utxo_listeners(txid, index)
+            return
+
+        status = o['status']
+        value = o['output'].value
+        contributions = []
+        if status & self.UNSPENT:
+            utxo = UnspentTransactionOutput(
+                transaction_hash=Hash(txid),
+                outpoint_index=index,
+                value=value,
+                scr=o['output'].script,
+                confirmations=self._txn_cache[txid].confirmations)
+            for addr in self._output_addrs.get(key, []):
+                if addr not in self._utxos_by_addr:
+                    self._utxos_by_addr[addr] = {}
+                self._utxos_by_addr[addr][key] = (status, utxo)
+                contributions.append(
+                    (addr, value if status == self.UNSPENT else 0, value))
+        elif status & (self.UNCONFIRMED | self.PROVISIONAL) and \
+                self._txn_cache[txid].confirmations > 0:
+            # Unconfirmed spends of confirmed outputs still count
+            # towards the confirmed balance of the spending address
+            # so that it isn't shown lower than it actually is.
+            for addr in self._spend_addrs.get(key, []):
+                contributions.append((addr, value, 0))
+
+        for addr, confirmed, total in contributions:
+            if addr not in self._balances_by_addr:
+                self._balances_by_addr[addr] = [0, 0]
+            balance = self._balances_by_addr[addr]
+            balance[0] += confirmed
+            balance[1] += total
+
+        if contributions:
+            self._indexed_outputs[key] = contributions
+
+        if self._utxo_listeners:
+            self._notify_utxo_listeners(txid, index)
+
+    def add_utxo_listener(self, listener):
+        """ Registers an object to be told about all UTXOs in the
+            cache and every later change to them.
+
+            listener must have three methods:
+
+            load(utxos): replaces whatever the listener knows with a
+                list of (address, account index, utxo, status)
+                tuples, one per UTXO. It is called once, from here.
+            update_utxo(address, account_index, utxo, status): the
+                UTXO was added or changed.
+            remove_utxo(txid, index): the output is no longer a UTXO.
+
+            account_index is None for addresses that aren't (yet)
+            known to belong to an account and status is UNSPENT,
+            possibly or'ed with UNCONFIRMED and PROVISIONAL.
+
+        Args:
+            listener (object): The listener.
+        """
+        listener.load(self._all_utxos())
+        self._utxo_listeners.append(listener)
+
+    def _all_utxos(self):
+        """ Returns all UTXOs in the cache for add_utxo_listener().
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        rv = {}
+        for addr, utxos in self._utxos_by_addr.items():
+            path = self._address_paths.get(addr, None)
+            for key, (status, utxo) in utxos.items():
+                if key not in rv or rv[key][1] is None:
+                    rv[key] = (addr, None if path is None else path[0], utxo, status)
+
+        return list(rv.values())
+
+    def _notify_utxo_listeners(self, txid, index):
+        """ Tells the UTXO listeners about the current state of the
+            output txid:index.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        o = self._outputs_cache.get(txid, {}).get(index, None)
+        if o is None or o['output'] is None or \
+           not (o['status'] & self.UNSPENT) or \
+           not self._output_addrs.get((txid, index), None):
+            for listener in self._utxo_listeners:
+                listener.remove_utxo(txid, index)
+            return
+
+        # Prefer an address that belongs to an account
+        addrs = self._output_addrs[(txid, index)]
+        addr = next((a for a in addrs if a in self._address_paths), addrs[0])
+        path = self._address_paths.get(addr, None)
+        status, utxo = self._utxos_by_addr[addr][(txid, index)]
+        for listener in self._utxo_listeners:
+            listener.update_utxo(addr, None if path is None else path[0], utxo, status)
+
     def _delete_txn(self, txid):
         """ Removes a transaction from the cache and updates any
             ancestor/descendant transactions' statuses so that it was
@@ -405,15 +730,22 @@ class CacheManager(object):
             # Update the status of any outpoints
             out_txid = str(inp.outpoint)
 
-            x = self._outputs_cache[out_txid][inp.outpoint_index]
-            x['status'] = self.UNSPENT
-            out_txn = self._txn_cache[out_txid]
-            if out_txn.provisional:
-                x['status'] |= self.PROVISIONAL
-            if out_txn.confirmations == 0:
-                x['status'] |= self.UNCONFIRMED
-            x['spend_txid'] = None
-            x['spend_index'] = None
+            # The spent transaction may not be in the cache (or may
+            # have been removed before this one, when pruning).
+            x = self._outputs_cache.get(out_txid, {}).get(inp.outpoint_index, None)
+            if x is not None:
+                x['status'] = self.UNSPENT
+                out_txn = self._txn_cache.get(out_txid, None)
+                if out_txn is not None:
+                    if out_txn.provisional:
+                        x['status'] |= self.PROVISIONAL
+                    if out_txn.confirmations == 0:
+                        x['status'] |= self.UNCONFIRMED
+                x['spend_txid'] = None
+                x['spend_index'] = None
+
+            self._spend_addrs.pop((out_txid, inp.outpoint_index), None)
+            self._index_output(out_txid, inp.outpoint_index)
 
         addresses = set()
         for addr_list in addrs['inputs'] + addrs['outputs']:
@@ -439,6 +771,11 @@ class CacheManager(object):
 
         del self._txn_cache[_txid]
 
+        for i in range(len(txn.outputs)):
+            self._output_addrs.pop((_txid, i), None)
+            self._index_output(_txid, i)
+
+        self._journal.append(dict(op="delete_txn", txid=_txid))
         self._dirty = True
 
     def prune_provisional_txns(self, age):
@@ -451,7 +788,7 @@ class CacheManager(object):
         """
         now = time.time()
         _age_seconds = 60 * age
-        for txid in self._txn_cache.keys():
+        for txid in list(self._txn_cache.keys()):
             txn = self._txn_cache[txid]
             if txn.provisional and now - txn.provisional >= _age_seconds:
                 self._delete_txn(txid)
@@ -503,6 +840,30 @@ class CacheManager(object):
         _txid = str(txid) if isinstance(txid, Hash) else txid
         return _txid in self._txn_cache and self._txn_cache[_txid]
 
+    def get_output(self, txid, index):
+        """ Returns an output of a transaction in the cache.
+
+        Args:
+            txid (Hash or str): The txid of the transaction.
+            index (int): The index of the output.
+
+        Returns:
+            TransactionOutput: The output or None if it is not in the
+                cache.
+        """
+        o = self._outputs_cache.get(str(txid), {}).get(index, None)
+        return None if o is None else o['output']
+
+    def get_txids_by_time(self):
+        """ Returns the txids of all transactions in the cache, ordered
+            from oldest to most recent.
+
+        Returns:
+            list(str): The txids.
+        """
+        return sorted(self._txn_cache.keys(),
+                      key=lambda txid: self._txn_cache[txid].network_time)
+
     def get_txns_for_address(self, address):
         """ Returns a list of transactions for the address
 
@@ -541,36 +902,15 @@ class CacheManager(object):
             dict: Keys are addresses, values are lists of
                 UnspentTransactionOutput objects for the address.
         """
-        unconfirmed_mask = self.UNSPENT | self.UNCONFIRMED | self.PROVISIONAL
         rv = {}
         for addr in addresses:
-            # Get the list of unspent deposits.
-            if addr not in self._deposits_for_addr:
+            if addr not in self._utxos_by_addr:
                 continue
 
-            for txid in self._deposits_for_addr[addr]:
-                for i in self._deposits_for_addr[addr][txid]:
-                    # Look up the status in the outputs cache
-                    if txid not in self._outputs_cache or \
-                       i not in self._outputs_cache[txid]:
-                        raise Exception("Don't have information for %r:%r" %
-                                        (txid, i))
-
-                    status = self._outputs_cache[txid][i]['status']
-                    if status & self.UNSPENT:
-                        if (status & unconfirmed_mask and include_unconfirmed) or \
-                           (status == self.UNSPENT and not include_unconfirmed):
-                            out = self._outputs_cache[txid][i]['output']
-                            utxo = UnspentTransactionOutput(
-                                transaction_hash=Hash(txid),
-                                outpoint_index=i,
-                                value=out.value,
-                                scr=out.script,
-                                confirmations=self._txn_cache[txid].confirmations)
-
-                            if addr not in rv:
-                                rv[addr] = []
-                            rv[addr].append(utxo)
+            utxos = [utxo for status, utxo in self._utxos_by_addr[addr].values()
+                     if include_unconfirmed or status == self.UNSPENT]
+            if utxos:
+                rv[addr] = utxos
 
         return rv
 
@@ -587,41 +927,7 @@ class CacheManager(object):
             dict: Keys are addresses, values are balances for the address.
         """
         # Confirmed Balance = sum(all confirmed utxos) + unconfirmed spends
-        utxos_by_addr = self.get_utxos(addresses, include_unconfirmed)
-
-        balances = {}
-
-        for addr, utxo_list in utxos_by_addr.items():
-            balances[addr] = sum([u.value for u in utxo_list])
-
-        for addr in addresses:
-            if addr in self._spends_for_addr and not include_unconfirmed:
-                # If we're doing confirmed balances, we need to add in
-                # unconfirmed spends so that we're not unnecessarily
-                # showing a lower confirmed balance
-                for txid, indices in self._spends_for_addr[addr].items():
-                    for i in indices:
-                        inp = self._inputs_cache[txid][i]
-                        out_txid = str(inp.outpoint)
-                        out_index = inp.outpoint_index
-
-                        # Don't add in chained unconfirmed spends
-                        if self._txn_cache[out_txid].confirmations == 0:
-                            continue
-
-                        # Look up the outpoint index and see what
-                        # the status is
-                        out = self._outputs_cache[out_txid][out_index]
-                        if (out['status'] & self.SPENT) and \
-                           (out['status'] & self.UNCONFIRMED or
-                            out['status'] & self.PROVISIONAL):
-                            if addr not in balances:
-                                balances[addr] = 0
-                            balances[addr] += out['output'].value
-
-            # For any addresses that don't have UTXOs, set their
-            # balance to 0
-            if addr not in balances:
-                balances[addr] = 0
-
-        return balances
+        i = 1 if include_unconfirmed else 0
+        return {addr: self._balances_by_addr[addr][i]
+                if addr in self._balances_by_addr else 0
+                for addr in addresses}
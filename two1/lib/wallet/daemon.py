@@ -7,18 +7,24 @@ import time
 
 import click
 import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from jsonrpcserver import Methods
 from jsonrpcserver.exceptions import ServerError
 from path import Path
 from two1.lib.bitcoin.crypto import PublicKey
 from two1.lib.bitcoin.crypto import HDPublicKey
+from two1.lib.blockchain.caching_provider import CachingProvider
+from two1.lib.wallet.socket_rpc_server import ReadWriteLock
 from two1.lib.wallet.socket_rpc_server import UnixSocketJSONRPCServer
+from two1.lib.wallet.sync_scheduler import SyncScheduler
 from two1.lib.wallet.exceptions import AccountCreationError
 from two1.lib.wallet.exceptions import DaemonRunningError
 from two1.lib.wallet.exceptions import WalletBalanceError
 from two1.lib.wallet.exceptions import WalletLockedError
 from two1.lib.wallet.exceptions import WalletNotLoadedError
 from two1.lib.wallet.two1_wallet import Two1Wallet
+from two1.lib.wallet.utxo_selectors import utxo_selectors
 from two1.lib.wallet.cli import validate_data_provider
 from two1.lib.wallet.cli import WALLET_VERSION
 
@@ -28,16 +34,24 @@ MAX_WALLET_UPDATE_INTERVAL = 300  # seconds
 
 logger = logging.getLogger('walletd')
 methods = Methods()
+# Methods that don't modify the wallet, which the RPC server runs
+# concurrently with each other.
+read_only_methods = set()
 wallet = dict(obj=None,
               locked=False,
               path=None,
               data_provider=None,
+              signing_executor=None,
+              cache_backend="json",
+              utxo_selector="smallest_first",
               update_info=dict(interval=DEF_WALLET_UPDATE_INTERVAL,
                                last_update=time.time(),
                                last_connection=time.time(),
                                in_need=False))
 wallet_dict_lock = threading.Lock()
-client_lock = threading.Lock()
+wallet_load_lock = threading.Lock()
+sync_scheduler = SyncScheduler()
+client_lock = ReadWriteLock()
 
 
 def track_connections_cb(data):
@@ -53,6 +67,7 @@ def track_connections_cb(data):
         if wallet_dict_lock.acquire(True, 0.01):
             wallet['update_info']['in_need'] = True
             wallet_dict_lock.release()
+            sync_scheduler.wake()
 
     curr_interval = wallet['update_info']['interval']
     if curr_interval > DEF_WALLET_UPDATE_INTERVAL:
@@ -76,6 +91,8 @@ def sig_handler(sig_num, stack_frame):
     logger.info("Shutting down...")
     rpc_server.STOP_EVENT.set()
     rpc_server.shutdown()
+    if wallet['signing_executor'] is not None:
+        wallet['signing_executor'].shutdown(wait=False)
 
 
 def _handle_exception(e):
@@ -94,9 +111,9 @@ def do_update(block_on_acquire=True):
             if wallet_dict_lock.acquire(block_on_acquire):
                 lock_acquired = True
                 logger.debug("Starting wallet update ...")
-                wallet['obj']._sync_accounts()
+                synced = sync_scheduler.sync(wallet['obj'])
                 wallet['update_info']['last_update'] = time.time()
-                logger.debug("Completed update.")
+                logger.debug("Completed update (%s)." % synced)
 
                 if wallet['update_info']['in_need']:
                     wallet['update_info']['in_need'] = False
@@ -127,18 +144,22 @@ def data_updater():
     """ Update thread target.
 
         This function updates the account balances based on the
-        interval (default of 25 secons).
+        interval (default of 25 secons), or sooner if a sync is
+        requested. sync_scheduler decides how much actually gets
+        synced each time.
     """
     # This is a daemon thread so no need to explicitly
     # poll for any shutdown events.
     sleep_time = 0
     while True:
         interval = wallet['update_info']['interval']
-        if time.time() > sleep_time + interval or \
-           wallet['update_info']['in_need']:
-            do_update()
-            sleep_time = time.time()
-        time.sleep(1)
+        timeout = sleep_time + interval - time.time()
+        if timeout > 0 and not wallet['update_info']['in_need']:
+            if not sync_scheduler.wait(timeout):
+                # Check again in case the interval has changed.
+                continue
+        do_update()
+        sleep_time = time.time()
 
 
 def load_wallet(wallet_path, data_provider, passphrase):
@@ -159,7 +180,10 @@ def load_wallet(wallet_path, data_provider, passphrase):
         logger.debug("\tpassphrase = %r" % bool(passphrase))
         wallet['obj'] = Two1Wallet(params_or_file=wallet_path,
                                    data_provider=data_provider,
-                                   passphrase=passphrase)
+                                   passphrase=passphrase,
+                                   cache_backend=wallet['cache_backend'],
+                                   utxo_selector=wallet['utxo_selector'])
+        wallet['obj'].signing_executor = wallet['signing_executor']
         wallet['locked'] = False
     except Exception as e:
         raise WalletNotLoadedError("Wallet loading failed: %s" % e)
@@ -171,13 +195,16 @@ def _check_wallet_loaded():
     logger.debug("wallet obj = %r, wallet locked = %r" % (wallet['obj'],
                                                           wallet['locked']))
     if wallet['obj'] is None and not wallet['locked']:
-        # Try loading
-        try:
-            load_wallet(wallet_path=wallet['path'],
-                        data_provider=wallet['data_provider'],
-                        passphrase="")
-        except WalletNotLoadedError as e:
-            _handle_exception(e)
+        # Try loading. Read-only methods can get here concurrently, so
+        # make sure only one of them does it.
+        with wallet_load_lock:
+            if wallet['obj'] is None and not wallet['locked']:
+                try:
+                    load_wallet(wallet_path=wallet['path'],
+                                data_provider=wallet['data_provider'],
+                                passphrase="")
+                except WalletNotLoadedError as e:
+                    _handle_exception(e)
 
     if wallet['locked']:
         _handle_exception(WalletLockedError(
@@ -211,7 +238,25 @@ def daemon_method(f):
     return wrapper
 
 
-@daemon_method
+def read_only_daemon_method(f):
+    """ Decorator function to create a daemon method that doesn't
+        modify the wallet.
+
+        Read-only methods can be run at the same time as each other, but
+        not at the same time as any other method.
+
+    Args:
+        f (function): The function to make a daemon method
+
+    Returns:
+        function: A wrapper function
+    """
+    read_only_methods.add(f.__name__)
+
+    return daemon_method(f)
+
+
+@read_only_daemon_method
 def testnet():
     """ RPC method to determine whether the wallet is a testnet wallet.
 
@@ -221,7 +266,7 @@ def testnet():
     return wallet['obj'].testnet
 
 
-@daemon_method
+@read_only_daemon_method
 def confirmed_balance(account=None):
     """ RPC method to get the current confirmed balance.
 
@@ -231,7 +276,7 @@ def confirmed_balance(account=None):
     return wallet['obj'].confirmed_balance(account)
 
 
-@daemon_method
+@read_only_daemon_method
 def unconfirmed_balance(account=None):
     """ RPC method to get the current unconfirmed balance.
 
@@ -263,7 +308,7 @@ def get_private_for_public(public_key):
     return priv_key.to_b58check() if priv_key is not None else None
 
 
-@daemon_method
+@read_only_daemon_method
 def current_address():
     """ RPC method to get the current payout address.
 
@@ -273,7 +318,7 @@ def current_address():
     return wallet['obj'].current_address
 
 
-@daemon_method
+@read_only_daemon_method
 def get_change_address(account=None):
     """ RPC method to get the current change address.
 
@@ -283,7 +328,7 @@ def get_change_address(account=None):
     return wallet['obj'].get_change_address(account)
 
 
-@daemon_method
+@read_only_daemon_method
 def get_payout_address(account=None):
     """ RPC method to get the current payout address.
 
@@ -315,7 +360,7 @@ def get_payout_public_key(account=None):
     return wallet['obj'].get_payout_public_key(account).to_b58check()
 
 
-@daemon_method
+@read_only_daemon_method
 def sign_message(message,
                  account_name_or_index=None,
                  key_index=0):
@@ -352,7 +397,7 @@ def sign_bitcoin_message(message, address):
     return wallet['obj'].sign_bitcoin_message(message, address)
 
 
-@daemon_method
+@read_only_daemon_method
 def verify_bitcoin_message(message, signature, address):
     """ RPC method to verify a bitcoin signed message
 
@@ -370,7 +415,7 @@ def verify_bitcoin_message(message, signature, address):
                                                 address)
 
 
-@daemon_method
+@read_only_daemon_method
 def get_message_signing_public_key(account_name_or_index=None,
                                    key_index=0):
     """ RPC method to get the public key used for message signing.
@@ -456,6 +501,17 @@ def make_signed_transaction_for(address, amount,
     return txns_ser
 
 
+@daemon_method
+def release_transaction(tx):
+    """ RPC method to release the UTXOs spent by a transaction that
+        will not be broadcast.
+
+    Args:
+        tx (str): Hex string serialization of the transaction.
+    """
+    wallet['obj'].release_transaction(tx)
+
+
 @daemon_method
 def send_to(address, amount,
             use_unconfirmed=False, fees=None,
@@ -502,7 +558,7 @@ def unlock(passphrase):
     logger.info("... loading complete.")
 
 
-@daemon_method
+@read_only_daemon_method
 def is_locked():
     """ RPC method to determine whether the wallet is currently locked.
 
@@ -512,7 +568,7 @@ def is_locked():
     return wallet['locked']
 
 
-@daemon_method
+@read_only_daemon_method
 def wallet_path():
     """ RPC method to return the wallet path of the currently loaded wallet.
 
@@ -522,6 +578,18 @@ def wallet_path():
     return wallet['path']
 
 
+@read_only_daemon_method
+def request_sync(addresses=None):
+    """ RPC method to have the wallet synced as soon as possible.
+
+    Args:
+        addresses (list(str)): Addresses that may have new
+            transactions, which are synced even if no new block has
+            been found since the last sync.
+    """
+    sync_scheduler.request_sync(addresses)
+
+
 @daemon_method
 def sync_wallet_file():
     """ RPC method to trigger a write to the wallet file.
@@ -536,28 +604,28 @@ def create_account(name):
     return wallet['obj'].create_account(name)
 
 
-@daemon_method
+@read_only_daemon_method
 def account_names():
     """ RPC method to return all account names
     """
     return wallet['obj'].account_names
 
 
-@daemon_method
+@read_only_daemon_method
 def account_map():
     """ RPC method to return the account map
     """
     return wallet['obj'].account_map
 
 
-@daemon_method
+@read_only_daemon_method
 def addresses(accounts):
     """ RPC method to return all addresses
     """
     return wallet['obj'].addresses(accounts)
 
 
-@daemon_method
+@read_only_daemon_method
 def balances_by_address(account):
     """ RPC method to return balances by address
     """
@@ -584,7 +652,7 @@ def spread_utxos(num_addresses, threshold, accounts=[]):
     return txns_ser
 
 
-@daemon_method
+@read_only_daemon_method
 def transaction_history(accounts=[]):
     """ RPC method to get dict containing transaction history
     """
@@ -618,6 +686,25 @@ def transaction_history(accounts=[]):
               default=DEF_WALLET_UPDATE_INTERVAL,
               show_default=True,
               help='How often to update wallet data (seconds)')
+@click.option('--signing-processes', '-sp',
+              type=click.IntRange(min=0),
+              default=0,
+              show_default=True,
+              help='Number of processes used to sign inputs of large transactions (0 to sign in the daemon process)')
+@click.option('--cache-backend', '-cb',
+              type=click.Choice(['json', 'sqlite']),
+              default='json',
+              show_default=True,
+              help='How to store the wallet cache (sqlite migrates an existing JSON cache)')
+@click.option('--utxo-selector', '-us',
+              type=click.Choice(sorted(utxo_selectors.keys())),
+              default='smallest_first',
+              show_default=True,
+              help='How to choose the UTXOs spent by transactions')
+@click.option('--provider-cache/--no-provider-cache',
+              default=True,
+              show_default=True,
+              help='Cache blockchain data provider responses (confirmed transactions are kept on disk)')
 @click.option('--debug', '-d',
               is_flag=True,
               help='Sets the logging level to debug')
@@ -625,6 +712,7 @@ def transaction_history(accounts=[]):
 @click.pass_context
 def main(ctx, wallet_path, blockchain_data_provider,
          chain_api_key_id, chain_api_key_secret, data_update_interval,
+         signing_processes, cache_backend, utxo_selector, provider_cache,
          debug):
     """ Two1 Wallet daemon
     """
@@ -655,6 +743,10 @@ def main(ctx, wallet_path, blockchain_data_provider,
         sys.exit(-1)
 
     wallet['data_provider'] = ctx.obj['data_provider']
+    if provider_cache:
+        wallet['data_provider'] = CachingProvider(
+            ctx.obj['data_provider'],
+            cache_path=str(wp.dirname().joinpath("provider_cache.json")))
     if data_update_interval is not None:
         DEF_WALLET_UPDATE_INTERVAL = data_update_interval
         wallet['update_info']['interval'] = data_update_interval
@@ -662,8 +754,24 @@ def main(ctx, wallet_path, blockchain_data_provider,
     logger.info("Starting daemon for wallet %s" % wallet_path)
     logger.info("Blockchain data provider: %s" %
                 ctx.obj['data_provider'].__class__.__name__)
+    logger.info("Provider cache: %s" % ("on" if provider_cache else "off"))
     logger.info("Update interval: %ds" % data_update_interval)
 
+    wallet['cache_backend'] = cache_backend
+    logger.info("Cache backend: %s" % cache_backend)
+
+    wallet['utxo_selector'] = utxo_selector
+    logger.info("UTXO selector: %s" % utxo_selector)
+
+    if signing_processes:
+        # Fork the signing processes now, before any of the daemon's
+        # threads have been started.
+        wallet['signing_executor'] = ProcessPoolExecutor(
+            max_workers=signing_processes,
+            mp_context=multiprocessing.get_context('fork'))
+        list(wallet['signing_executor'].map(abs, range(signing_processes)))
+        logger.info("Signing processes: %d" % signing_processes)
+
     # Check whether the wallet is locked
     if Two1Wallet.is_locked(wallet_path):
         wallet['locked'] = True
@@ -672,7 +780,7 @@ def main(ctx, wallet_path, blockchain_data_provider,
         logger.info("Wallet unlocked. Loading ...")
         try:
             load_wallet(wallet_path=wallet_path,
-                        data_provider=ctx.obj['data_provider'],
+                        data_provider=wallet['data_provider'],
                         passphrase="")
             logger.info("... loading complete.")
         except WalletNotLoadedError as e:
@@ -700,6 +808,12 @@ def main(ctx, wallet_path, blockchain_data_provider,
     except:
         pass
 
+    if isinstance(wallet['data_provider'], CachingProvider):
+        try:
+            wallet['data_provider'].save()
+        except Exception as e:
+            logger.error("Couldn't save the provider cache: %s" % e)
+
     sys.exit(0)
 
 
@@ -707,7 +821,8 @@ try:
     rpc_server = UnixSocketJSONRPCServer(dispatcher_methods=methods,
                                          client_lock=client_lock,
                                          request_cb=track_connections_cb,
-                                         logger=logger)
+                                         logger=logger,
+                                         read_only_methods=read_only_methods)
 except DaemonRunningError as e:
     click.echo(str(e))
     sys.exit(-1)
@@ -1,4 +1,7 @@
 import time
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from two1.lib.bitcoin.crypto import HDKey, HDPrivateKey, HDPublicKey
 from two1.lib.wallet.cache_manager import CacheManager
 from two1.lib.wallet.wallet_txn import WalletTransaction
@@ -37,6 +40,7 @@ class HDAccount(object):
     GAP_LIMIT = 20
     DISCOVERY_INCREMENT = GAP_LIMIT
     MAX_UPDATE_THRESHOLD = 30  # seconds
+    MAX_DISCOVERY_WORKERS = 8
 
     def __init__(self, hd_key, name, index, data_provider, cache_manager,
                  testnet=False, last_state=None, skip_discovery=False):
@@ -85,75 +89,224 @@ class HDAccount(object):
             self._update_balance()
 
     def _sync_txns(self, max_index=0, check_all=False):
-        now = time.time()
-        if now - self._last_full_update > 20 * 60:
-            check_all = True
+        sync_accounts([self], check_all)
 
-        for change in [0, 1]:
-            found_last = False
-            current_last = self.last_indices[change]
-
-            addr_range = 0
-            while not found_last:
-                # Try a 2 * GAP_LIMIT at a go
-                end = addr_range + self.DISCOVERY_INCREMENT
-                addresses = {i:self.get_address(change, i)
-                             for i in range(addr_range, end)}
-
-                if self.data_provider.can_limit_by_height:
-                    min_block = None if check_all else self._cache_manager.last_block
-                    txns = self.data_provider.get_transactions(
-                        list(addresses.values()),
-                        limit=10000,
-                        min_block=min_block)
-                else:
-                    txns = self.data_provider.get_transactions(
-                        list(addresses.values()),
-                        limit=10000)
-
-                inserted_txns = set()
-                for i in sorted(addresses.keys()):
-                    addr = addresses[i]
-
-                    self._cache_manager.insert_address(self.index, change, i, addr)
-
-                    addr_has_txns = self._cache_manager.address_has_txns(addr)
-
-                    if not addr_has_txns or addr not in txns or \
-                       not bool(txns[addr]):
-                        if i - current_last >= self.GAP_LIMIT:
-                            found_last = True
-                            break
-
-                    if txns[addr]:
-                        current_last = i
-                        for t in txns[addr]:
-                            txid = str(t['transaction'].hash)
-                            if txid not in inserted_txns:
-                                wt = WalletTransaction.from_transaction(
-                                    t['transaction'])
-                                wt.block = t['metadata']['block']
-                                wt.block_hash = t['metadata']['block_hash']
-                                wt.confirmations = t['metadata']['confirmations']
-                                if 'network_time' in t['metadata']:
-                                    wt.network_time = t['metadata']['network_time']
-                                self._cache_manager.insert_txn(wt)
-                                inserted_txns.add(txid)
-
-                    if addr_has_txns:
-                        current_last = i
-
-                addr_range += self.DISCOVERY_INCREMENT
-
-            self.last_indices[change] = current_last
+    def _start_sync(self, check_all):
+        """ Returns whether this sync should check all transactions
+            rather than just those since the last known block.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        return check_all or time.time() - self._last_full_update > 20 * 60
+
+    def _finish_sync(self, check_all):
+        """ Records the time of a completed sync.
 
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
         self._last_update = time.time()
         if check_all:
             self._last_full_update = self._last_update
 
+    def _get_window(self, change, start):
+        """ Returns a dict of the DISCOVERY_INCREMENT addresses of a
+            chain starting at start, keyed by index.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        end = start + self.DISCOVERY_INCREMENT
+        addresses = {i: self._cache_manager.get_address(self.index, change, i)
+                     for i in range(start, end)}
+
+        missing = [i for i, addr in addresses.items() if addr is None]
+        if missing:
+            keys = HDKey.derive_range(self._chain_pub_keys[change],
+                                      missing[0], end - missing[0])
+            for i in missing:
+                # Always do compressed keys
+                addresses[i] = keys[i - missing[0]].address(True, self.testnet)
+
+        return addresses
+
+    def _fetch_window(self, addresses, min_block):
+        """ Gets the transactions for a window of addresses from the
+            data provider. This is run on the discovery worker
+            threads, so it must not touch the cache manager.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        if self.data_provider.can_limit_by_height:
+            return self.data_provider.get_transactions(
+                list(addresses.values()),
+                limit=10000,
+                min_block=min_block)
+        else:
+            return self.data_provider.get_transactions(
+                list(addresses.values()),
+                limit=10000)
+
+    def _discover_chain(self, change, check_all, executor):
+        """ Discovers the used addresses (and their transactions) of a
+            chain, one window of addresses at a time.
+
+            This is a generator: it yields the future of the data
+            provider request for the current window and must be sent
+            its result. While the request is in flight, the next
+            window of addresses is derived. sync_accounts() drives a
+            number of these at once.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+
+        Args:
+            change (int): The chain to discover.
+            check_all (bool): Whether to get all transactions rather
+                than just those since the last known block.
+            executor (concurrent.futures.Executor): Executor to run
+                the data provider requests on.
+        """
+        min_block = None if check_all else self._cache_manager.last_block
+        current_last = self.last_indices[change]
+
+        addr_range = 0
+        addresses = self._get_window(change, addr_range)
+        request = executor.submit(self._fetch_window, addresses, min_block)
+        while True:
+            addr_range += self.DISCOVERY_INCREMENT
+            next_addresses = self._get_window(change, addr_range)
+
+            txns = yield request
+            current_last, found_last = self._insert_window(
+                change, addresses, txns, current_last)
+            if found_last:
+                break
+
+            addresses = next_addresses
+            request = executor.submit(self._fetch_window, addresses, min_block)
+
+        self.last_indices[change] = current_last
+
+    def _insert_window(self, change, addresses, txns, current_last):
+        """ Inserts a window of addresses and the transactions found
+            for them into the cache.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+
+        Returns:
+            tuple: The index of the last used address in the chain
+                and whether the end of the chain (GAP_LIMIT unused
+                addresses past it) was found.
+        """
+        inserted_txns = set()
+        for i in sorted(addresses.keys()):
+            addr = addresses[i]
+
+            self._cache_manager.insert_address(self.index, change, i, addr)
+
+            addr_has_txns = self._cache_manager.address_has_txns(addr)
+
+            if not addr_has_txns or addr not in txns or \
+               not bool(txns[addr]):
+                if i - current_last >= self.GAP_LIMIT:
+                    return current_last, True
+
+            if txns[addr]:
+                current_last = i
+                self._insert_txns(txns[addr], inserted_txns)
+
+            if addr_has_txns:
+                current_last = i
+
+        return current_last, False
+
+    def _insert_txns(self, txns, inserted_txns):
+        """ Inserts transactions returned by the data provider into the
+            cache.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+
+        Args:
+            txns (list(dict)): Transactions as returned by the data
+                provider's get_transactions().
+            inserted_txns (set(str)): txids already inserted, which
+                are skipped. Updated with the txids inserted.
+        """
+        for t in txns:
+            txid = str(t['transaction'].hash)
+            if txid not in inserted_txns:
+                wt = WalletTransaction.from_transaction(
+                    t['transaction'])
+                wt.block = t['metadata']['block']
+                wt.block_hash = t['metadata']['block_hash']
+                wt.confirmations = t['metadata']['confirmations']
+                if 'network_time' in t['metadata']:
+                    wt.network_time = t['metadata']['network_time']
+                self._cache_manager.insert_txn(wt)
+                inserted_txns.add(txid)
+
+    def sync_addresses(self, addresses, min_block=None):
+        """ Gets the transactions of some addresses of this account
+            from the data provider, rather than scanning both chains.
+
+            If any of the addresses are past the last used address of
+            their chain, the chain's last used index is moved up to
+            them.
+
+        Args:
+            addresses (dict): A dict keyed by address, with each value
+                being a (chain, index) tuple.
+            min_block (int): Block height from which to get
+                transactions. If None, gets all transactions.
+        """
+        addresses = list(addresses.items())
+        inserted_txns = set()
+        for start in range(0, len(addresses), self.DISCOVERY_INCREMENT):
+            window = addresses[start:start + self.DISCOVERY_INCREMENT]
+            txns = self._fetch_window({i: addr for i, (addr, _) in
+                                       enumerate(window)},
+                                      min_block)
+            for addr, (change, i) in window:
+                if txns.get(addr, None):
+                    self._insert_txns(txns[addr], inserted_txns)
+                    if i > self.last_indices[change]:
+                        self._cache_addresses(change,
+                                              self.last_indices[change] + 1,
+                                              i + 1)
+                        self.last_indices[change] = i
+
+        self._update_balance()
+
+    def _cache_addresses(self, change, start, end):
+        """ Makes sure the addresses of a chain from start up to (but
+            not including) end are in the address cache.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        cached = set(self._cache_manager.get_chain_indices(self.index, change))
+        missing = [i for i in range(start, end) if i not in cached]
+        if not missing:
+            return
+
+        keys = HDKey.derive_range(self._chain_pub_keys[change],
+                                  missing[0], end - missing[0])
+        for i in missing:
+            # Always do compressed keys
+            self._cache_manager.insert_address(
+                self.index, change, i,
+                keys[i - missing[0]].address(True, self.testnet))
+
     def _update_balance(self):
+        # The balances are built before being stored, as the daemon
+        # can read them from other threads while they are updated.
         balance = {'confirmed': 0, 'total': 0}
-        self._address_balances = {}
+        address_balances = {}
         for unconfirmed in [True, False]:
             addr_balances = self._cache_manager.get_balances(
                 addresses=self.all_used_addresses,
@@ -161,13 +314,16 @@ class HDAccount(object):
 
             key = 'total' if unconfirmed else 'confirmed'
             for k, v in addr_balances.items():
-                if k not in self._address_balances:
-                    self._address_balances[k] = {'confirmed': 0, 'total': 0}
-                self._address_balances[k][key] = v
+                if k not in address_balances:
+                    address_balances[k] = {'confirmed': 0, 'total': 0}
+                address_balances[k][key] = v
                 balance[key] += v
 
+        self._address_balances = address_balances
         self._balance_cache = balance
 
+        return balance
+
     def has_txns(self):
         """ Returns whether or not there are any discovered transactions
             associated with any address in the account.
@@ -190,11 +346,29 @@ class HDAccount(object):
                Only found addresses are included in the dict.
         """
         found = {}
-        for change in [0, 1]:
-            for i in range(self.last_indices[change] + self.GAP_LIMIT + 1):
-                addr = self.get_address(change, i)
+        for addr, path in self._cache_manager.lookup_paths(addresses).items():
+            acct_index, change, i = path
+            if acct_index == self.index and \
+               i <= self.last_indices[change] + self.GAP_LIMIT:
+                found[addr] = path
+
+        remaining = set(addresses) - set(found.keys())
+        if not remaining:
+            return found
 
-                if addr in addresses:
+        # Derive whatever isn't in the address cache.
+        for change in [0, 1]:
+            end = self.last_indices[change] + self.GAP_LIMIT + 1
+            cached = set(self._cache_manager.get_chain_indices(self.index, change))
+            missing = [i for i in range(end) if i not in cached]
+            if not missing:
+                continue
+
+            keys = HDKey.derive_range(self._chain_pub_keys[change],
+                                      missing[0], end - missing[0])
+            for i in missing:
+                addr = keys[i - missing[0]].address(True, self.testnet)
+                if addr in remaining:
                     found[addr] = (self.index, change, i)
 
         return found
@@ -357,8 +531,7 @@ class HDAccount(object):
                 satoshis for each. The total balance includes
                 unconfirmed transactions.
         """
-        self._update_balance()
-        return self._balance_cache
+        return self._update_balance()
 
     @property
     def all_used_addresses(self):
@@ -374,3 +547,48 @@ class HDAccount(object):
                               for i in range(last + 1)]
 
         return all_addresses
+
+
+def sync_accounts(accounts, check_all=False, executor=None):
+    """ Discovers addresses and transactions for a number of accounts
+        at once.
+
+        Both chains of every account are scanned concurrently: the
+        data provider requests run on a pool of worker threads while
+        the calling thread derives the next window of addresses for
+        each chain and inserts the results into the cache. Each chain
+        still stops at HDAccount.GAP_LIMIT unused addresses, exactly
+        as if it had been scanned on its own.
+
+    Args:
+        accounts (list(HDAccount)): The accounts to sync.
+        check_all (bool): Whether to get all transactions rather than
+            just those since the last known block.
+        executor (concurrent.futures.Executor): Executor to run the
+            data provider requests on. If None, a thread pool of up
+            to HDAccount.MAX_DISCOVERY_WORKERS threads is used.
+    """
+    if executor is None:
+        num_workers = min(HDAccount.MAX_DISCOVERY_WORKERS, 2 * len(accounts))
+        with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as e:
+            return sync_accounts(accounts, check_all, e)
+
+    full_syncs = [acct._start_sync(check_all) for acct in accounts]
+
+    scans = {}
+    for acct, full in zip(accounts, full_syncs):
+        for change in [HDAccount.PAYOUT_CHAIN, HDAccount.CHANGE_CHAIN]:
+            scan = acct._discover_chain(change, full, executor)
+            scans[next(scan)] = scan
+
+    while scans:
+        done, _ = wait(scans, return_when=FIRST_COMPLETED)
+        for request in done:
+            scan = scans.pop(request)
+            try:
+                scans[scan.send(request.result())] = scan
+            except StopIteration:
+                pass
+
+    for acct, full in zip(accounts, full_syncs):
+        acct._finish_sync(full)
@@ -1,91 +1,138 @@
+import asyncio
 import getpass
 import json
-import select
 import socket
-import socketserver
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import tempfile
 from jsonrpcserver import dispatcher
-from jsonrpcserver.request import Request
 from jsonrpcserver.response import ErrorResponse
+from jsonrpcserver.response import NotificationResponse
 from jsonrpcserver.status import HTTP_STATUS_CODES
+from jsonrpcclient.exceptions import ParseResponseError
+from jsonrpcclient.exceptions import ReceivedErrorResponse
+from jsonrpcclient.exceptions import ReceivedNoResponse
+from jsonrpcclient.rpc import id_generator
 from jsonrpcclient.server import Server
 from path import Path
 from two1.lib.wallet.exceptions import DaemonRunningError
 from two1.lib.wallet.exceptions import DaemonNotRunningError
 
 
-class UnixSocketJSONRPCServer(socketserver.ThreadingMixIn,
-                              socketserver.UnixStreamServer):
-    TEMP_DIR = Path(tempfile.gettempdir())
-    SOCKET_FILE_NAME = TEMP_DIR.joinpath("walletd.%s.sock" % getpass.getuser())
-    STOP_EVENT = threading.Event()
+class ReadWriteLock(object):
+    """ A lock that can be held by any number of readers or by a
+        single writer.
+
+        Writers waiting for the lock keep new readers from acquiring
+        it so that a steady stream of readers can't starve them.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    def acquire_read(self, timeout=-1):
+        """ Acquires the lock for reading.
 
-    class JSONRPCHandler(socketserver.BaseRequestHandler):
-        """ The RequestHandler class for our server.
+        Args:
+            timeout (float): Seconds to wait for the lock. Waits forever
+                if negative.
 
-            It is instantiated once per connection to the server, and
-            must override the handle() method to implement
-            communication to the client.
+        Returns:
+            bool: True if the lock was acquired, False if timed out.
         """
+        with self._cond:
+            if not self._cond.wait_for(
+                    lambda: not (self._writer or self._writers_waiting),
+                    None if timeout < 0 else timeout):
+                return False
+            self._readers += 1
+            return True
 
-        def handle(self):
-            logger = self.server.logger
-            poller = select.poll()
-            poller.register(self.request.fileno(), select.POLLIN | select.POLLPRI | select.POLLERR)
-            while True:
-                if poller.poll(500):
-                    self.data = self.request.recv(1024).strip().decode()
-
-                    if not self.data:
-                        break
-                else:
-                    if self.server.STOP_EVENT.is_set():
-                        break
-                    else:
-                        continue
-
-                lock_acquired = False
-                try:
-                    if self.server._request_cb is not None:
-                        self.server._request_cb(self.data)
-                    if self.server._client_lock.acquire(True, 10):
-                        lock_acquired = True
-                        logger.debug("Dispatching %s" % (self.data))
-                        response = dispatcher.dispatch(self.server._methods,
-                                                       self.data)
-                        logger.debug("Responding with: %s" % response.json_debug)
-                    else:
-                        # Send a time out response
-                        r = Request(self.data)
-                        logger.debug("Timed out waiting for lock with request = %s" %
-                                     (self.data))
-                        request_id = r.request_id if hasattr(r, 'request_id') else None
-                        response = ErrorResponse(http_status=HTTP_STATUS_CODES[408],
-                                                 request_id=request_id,
-                                                 code=-32000,  # Server error
-                                                 message="Timed out waiting for lock")
-                except Exception as e:
-                    if logger is not None:
-                        logger.exception(e)
-                finally:
-                    if lock_acquired:
-                        self.server._client_lock.release()
+    def release_read(self):
+        """ Releases the lock after acquire_read().
+        """
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
 
-                try:
-                    json_str = json.dumps(response.json_debug) + "\n"
-                    msg = json_str.encode()
-                    logger.debug("Message length = %d" % len(msg))
-                    self.request.sendall(msg)
-                except BrokenPipeError:
-                    break
-                except Exception as e:
-                    if logger is not None:
-                        logger.exception(e)
+    def acquire_write(self, timeout=-1):
+        """ Acquires the lock for writing.
+
+        Args:
+            timeout (float): Seconds to wait for the lock. Waits forever
+                if negative.
+
+        Returns:
+            bool: True if the lock was acquired, False if timed out.
+        """
+        with self._cond:
+            self._writers_waiting += 1
+            try:
+                if not self._cond.wait_for(
+                        lambda: not (self._writer or self._readers),
+                        None if timeout < 0 else timeout):
+                    return False
+                self._writer = True
+                return True
+            finally:
+                self._writers_waiting -= 1
+                if not self._writer:
+                    # Readers held off by this writer can go ahead.
+                    self._cond.notify_all()
+
+    def release_write(self):
+        """ Releases the lock after acquire_write().
+        """
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+
+class UnixSocketJSONRPCServer(object):
+    """ An asyncio JSON-RPC server listening on a unix socket.
+
+        Requests and responses are newline-delimited JSON, so each one
+        can be up to MAX_MESSAGE_SIZE bytes long. A message may also be
+        a JSON-RPC batch (a list of requests), which gets a list of
+        responses back. The requests of a batch are run in order, except
+        that consecutive read-only requests run concurrently.
+
+        Methods are run on a pool of worker threads while holding
+        client_lock, a ReadWriteLock: methods named in
+        read_only_methods share it, any others hold it exclusively.
+        A method that can't get the lock within LOCK_TIMEOUT seconds
+        gets a "Timed out waiting for lock" error.
+
+        The listening socket is created when the server is, so it can
+        tell whether another daemon is already running. The server has
+        the serve_forever()/shutdown()/server_close() interface of
+        socketserver servers.
+
+    Args:
+        dispatcher_methods (jsonrpcserver.Methods): The RPC methods.
+        client_lock (ReadWriteLock): Lock held while running a method.
+        request_cb (function): Called with every message received, from
+            a worker thread.
+        logger (logging.Logger): Logger to use.
+        read_only_methods (set(str)): Names of the methods that don't
+            modify the wallet.
+        max_workers (int): Number of worker threads.
+    """
+    TEMP_DIR = Path(tempfile.gettempdir())
+    SOCKET_FILE_NAME = TEMP_DIR.joinpath("walletd.%s.sock" % getpass.getuser())
+    STOP_EVENT = threading.Event()
+    MAX_MESSAGE_SIZE = 16 * 1024 * 1024  # bytes
+    LOCK_TIMEOUT = 10  # seconds
+    MAX_WORKERS = 16
 
     def __init__(self, dispatcher_methods, client_lock,
-                 request_cb=None, logger=None):
+                 request_cb=None, logger=None, read_only_methods=None,
+                 max_workers=MAX_WORKERS):
         if self.SOCKET_FILE_NAME.exists():
             # Try connecting to it
             try:
@@ -98,27 +145,287 @@ class UnixSocketJSONRPCServer(socketserver.ThreadingMixIn,
         self._methods = dispatcher_methods
         self._client_lock = client_lock
         self._request_cb = request_cb
+        self._read_only_methods = frozenset(read_only_methods or [])
+        self._max_workers = max_workers
         self.logger = logger
 
-        super().__init__(self.SOCKET_FILE_NAME,
-                         UnixSocketJSONRPCServer.JSONRPCHandler)
+        self.socket = socket.socket(family=socket.AF_UNIX)
+        self.socket.bind(self.SOCKET_FILE_NAME)
+        self.socket.listen(128)
+
+        self._loop = None
+        self._stopped = None
+        self._shutdown_request = False
+        self._connections = set()
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+
+    def serve_forever(self):
+        """ Handles requests until shutdown() is called.
+        """
+        self._is_shut_down.clear()
+        self._shutdown_request = False
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._loop.run_until_complete(self._serve())
+        finally:
+            self._loop.close()
+            self._loop = None
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        """ Stops serve_forever() and waits for it to return.
+
+            Must be called from a different thread than serve_forever().
+        """
+        self.STOP_EVENT.set()
+        self._shutdown_request = True
+        loop = self._loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._stop)
+            except RuntimeError:
+                # The loop has already been closed.
+                pass
+        self._is_shut_down.wait()
+
+    def server_close(self):
+        """ Closes the listening socket.
+        """
+        self.socket.close()
+        if self.SOCKET_FILE_NAME.exists():
+            self.SOCKET_FILE_NAME.unlink()
+
+    def _stop(self):
+        if self._stopped is not None:
+            self._stopped.set()
+
+    async def _serve(self):
+        self._stopped = asyncio.Event()
+        executor = ThreadPoolExecutor(max_workers=self._max_workers)
+        self._loop.set_default_executor(executor)
+        server = await asyncio.start_unix_server(self._handle_connection,
+                                                 sock=self.socket,
+                                                 limit=self.MAX_MESSAGE_SIZE)
+        try:
+            if self._shutdown_request:
+                return
+            await self._stopped.wait()
+        finally:
+            server.close()
+            for task in list(self._connections):
+                task.cancel()
+            if self._connections:
+                await asyncio.wait(list(self._connections))
+            executor.shutdown(wait=False)
+
+    async def _handle_connection(self, reader, writer):
+        """ Handles the messages sent over a connection, one at a time.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # The message is longer than the stream limit
+                    if self.logger is not None:
+                        self.logger.error(
+                            "Message exceeds %d bytes, closing connection." %
+                            self.MAX_MESSAGE_SIZE)
+                    break
+
+                if not line:
+                    break
+
+                data = line.strip().decode()
+                if not data:
+                    continue
+
+                response = await self._handle_message(data)
+                if response is None:
+                    continue
+
+                msg = (json.dumps(response) + "\n").encode()
+                if self.logger is not None:
+                    self.logger.debug("Message length = %d" % len(msg))
+                writer.write(msg)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.exception(e)
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _handle_message(self, data):
+        """ Dispatches a single request or a batch of requests.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+
+        Args:
+            data (str): The message received.
+
+        Returns:
+            dict or list: The JSON-serializable response(s) or None if
+                no response should be sent.
+        """
+        loop = asyncio.get_running_loop()
+        if self._request_cb is not None:
+            await loop.run_in_executor(None, self._request_cb, data)
+
+        try:
+            request = json.loads(data)
+        except ValueError:
+            # Let the dispatcher come up with the parse error.
+            request = data
+
+        if not isinstance(request, list) or not request:
+            response = await loop.run_in_executor(None, self._dispatch,
+                                                  request)
+            if isinstance(response, NotificationResponse):
+                return None
+            return response.json_debug
+
+        # Batch: the requests in it are run in order, as a later one
+        # may depend on what an earlier one changed. Consecutive
+        # read-only requests don't change anything, so they are run
+        # concurrently.
+        responses = []
+        reads = []
+        for r in request:
+            if self._is_read_only(r):
+                reads.append(r)
+                continue
+            if reads:
+                responses += await asyncio.gather(
+                    *[loop.run_in_executor(None, self._dispatch, rr)
+                      for rr in reads])
+                reads = []
+            responses.append(await loop.run_in_executor(None, self._dispatch,
+                                                        r))
+        if reads:
+            responses += await asyncio.gather(
+                *[loop.run_in_executor(None, self._dispatch, rr)
+                  for rr in reads])
+        rv = [r.json_debug for r in responses
+              if not isinstance(r, NotificationResponse)]
+
+        return rv or None
+
+    def _is_read_only(self, request):
+        """ Returns whether a request only reads the wallet.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        # Invalid requests don't call any method.
+        return not isinstance(request, dict) or \
+            request.get('method', None) in self._read_only_methods
+
+    def _dispatch(self, request):
+        """ Runs a request while holding the client lock.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+
+        Args:
+            request (dict or str): The request.
+
+        Returns:
+            jsonrpcserver.response._Response: The response.
+        """
+        logger = self.logger
+        if not isinstance(request, dict):
+            # Not a valid request, so no method will be called and the
+            # dispatcher only has to build the error response.
+            return dispatcher.dispatch(self._methods, request)
+
+        if self._is_read_only(request):
+            acquire = self._client_lock.acquire_read
+            release = self._client_lock.release_read
+        else:
+            acquire = self._client_lock.acquire_write
+            release = self._client_lock.release_write
+
+        if not acquire(self.LOCK_TIMEOUT):
+            # Send a time out response
+            if logger is not None:
+                logger.debug("Timed out waiting for lock with request = %s" %
+                             (request))
+            request_id = request.get('id', None)
+            return ErrorResponse(http_status=HTTP_STATUS_CODES[408],
+                                 request_id=request_id,
+                                 code=-32000,  # Server error
+                                 message="Timed out waiting for lock")
+
+        try:
+            if logger is not None:
+                logger.debug("Dispatching %s" % (request))
+            response = dispatcher.dispatch(self._methods, request)
+            if logger is not None:
+                logger.debug("Responding with: %s" % response.json_debug)
+        except Exception as e:
+            # Don't let one bad request take the connection (or the
+            # rest of its batch) down with it.
+            if logger is not None:
+                logger.exception(e)
+            response = ErrorResponse(http_status=HTTP_STATUS_CODES[500],
+                                     request_id=request.get('id', None),
+                                     code=-32000,  # Server error
+                                     message="Server error")
+        finally:
+            release()
+
+        return response
 
 
 class UnixSocketServerProxy(Server):
+    """ A client for UnixSocketJSONRPCServer.
+
+        The proxy keeps a single connection to the daemon open for all
+        its requests and can be shared between threads: requests are
+        sent one at a time. If the daemon has gone away (e.g. been
+        restarted) since the last request, the proxy reconnects.
+    """
     not_running_msg = "walletd is not running, or the socket is not readable."
-    
+
     def __init__(self):
-        # Try connecting to the socket
-        self.sock = socket.socket(family=socket.AF_UNIX)
+        self._lock = threading.Lock()
+        self.sock = None
+        self._rfile = None
+        self._connect()
+
+        super().__init__(UnixSocketJSONRPCServer.SOCKET_FILE_NAME)
+
+    def _connect(self):
+        sock = socket.socket(family=socket.AF_UNIX)
 
         try:
-            self.sock.connect(UnixSocketJSONRPCServer.SOCKET_FILE_NAME)
-        except FileNotFoundError:
-            raise DaemonNotRunningError(self.not_running_msg)
-        except ConnectionRefusedError:
+            sock.connect(UnixSocketJSONRPCServer.SOCKET_FILE_NAME)
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
             raise DaemonNotRunningError(self.not_running_msg)
 
-        super().__init__(UnixSocketJSONRPCServer.SOCKET_FILE_NAME)
+        self.sock = sock
+        self._rfile = sock.makefile('rb')
+
+    def close(self):
+        """ Closes the connection to the daemon.
+        """
+        with self._lock:
+            if self.sock is not None:
+                self._rfile.close()
+                self.sock.close()
+                self.sock = None
+                self._rfile = None
 
     def __getattr__(self, name):
         # Override the getattr to have 'response' default to True
@@ -135,21 +442,91 @@ class UnixSocketServerProxy(Server):
         if isinstance(message, str):
             message = message.encode()
 
-        try:
-            self.sock.sendall(message + b'\n')
-        except ConnectionError:
-            raise DaemonNotRunningError(self.not_running_msg)
+        with self._lock:
+            try:
+                if self.sock is None:
+                    self._connect()
+                self.sock.sendall(message + b'\n')
+            except ConnectionError:
+                # The daemon closed the connection since the last
+                # request. Nothing was sent, so it's safe to try again
+                # on a new one.
+                self._connect()
+                try:
+                    self.sock.sendall(message + b'\n')
+                except ConnectionError:
+                    raise DaemonNotRunningError(self.not_running_msg)
 
-        rv = ""
-        if expect_reply:
-            while True:
-                reply = self.sock.recv(8192)
-                if isinstance(reply, bytes):
-                    rv += reply.decode()
-                else:
-                    rv += reply
+            rv = ""
+            if expect_reply:
+                try:
+                    reply = self._rfile.readline()
+                except ConnectionError:
+                    reply = b''
 
-                if reply[-1] == 10:
-                    break
+                if not reply.endswith(b'\n'):
+                    # The request may or may not have been carried out,
+                    # so don't retry it.
+                    self.sock.close()
+                    self.sock = None
+                    raise DaemonNotRunningError(self.not_running_msg)
+
+                rv = reply.decode()
+
+        return rv
+
+    def request_batch(self, calls):
+        """ Makes several requests in one round trip.
+
+        Args:
+            calls (list(tuple)): (method name, args, kwargs) tuples.
+
+        Returns:
+            list: The result of each call, in the same order as calls.
+                A call that failed has a ReceivedErrorResponse in its
+                place instead.
+        """
+        if not calls:
+            return []
+
+        requests = []
+        for method_name, args, kwargs in calls:
+            requests.append(
+                dict(jsonrpc="2.0",
+                     method=method_name,
+                     params=[dict(args=args, kwargs=kwargs)],
+                     id=next(id_generator)))
+
+        message = json.dumps(requests)
+        self.log_request(message)
+        response = self.send_message(message)
+        self.log_response(response)
+
+        try:
+            responses = json.loads(response)
+        except ValueError:
+            raise ParseResponseError()
+        if not isinstance(responses, list):
+            responses = [responses]
+        by_id = {r.get('id', None): r for r in responses
+                 if isinstance(r, dict)}
+        # An error without an id (e.g. a parse error or a lock time
+        # out) is the server rejecting the whole batch, or requests it
+        # couldn't read the id of: it is the response to every call
+        # that didn't get one of its own.
+        rejected = by_id.get(None, None)
+
+        rv = []
+        for r in requests:
+            response_dict = by_id.get(r['id'], rejected)
+            if response_dict is None:
+                raise ReceivedNoResponse()
+            if 'error' in response_dict:
+                rv.append(ReceivedErrorResponse(
+                    response_dict['error'].get('code'),
+                    response_dict['error'].get('message'),
+                    response_dict['error'].get('data')))
+            else:
+                rv.append(response_dict['result'])
 
         return rv
@@ -0,0 +1,748 @@
+import os
+import sqlite3
+import time
+
+from two1.lib.bitcoin.hash import Hash
+from two1.lib.bitcoin.script import Script
+from two1.lib.bitcoin.txn import UnspentTransactionOutput
+from two1.lib.bitcoin.txn import TransactionOutput
+from two1.lib.bitcoin.utils import key_hash_to_address
+from two1.lib.wallet.cache_manager import CacheManager
+from two1.lib.wallet.wallet_txn import WalletTransaction
+
+
+class SQLiteCacheManager(CacheManager):
+    """ A CacheManager that keeps the cache in an SQLite database
+        rather than in memory.
+
+        Queries are answered directly from indexed tables and
+        WalletTransaction objects are only created when they are
+        asked for, so startup time and memory use do not grow with
+        the size of the wallet history.
+
+        The database lives next to the JSON cache file passed to
+        to_file()/load_from_file(), with a ".sqlite3" extension. When
+        there is no database yet, load_from_file() migrates the JSON
+        cache (and its journal) into a new one. Until then, the cache
+        is kept in an in-memory database.
+    """
+    DB_SUFFIX = ".sqlite3"
+    SCHEMA_VERSION = "1"
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS meta "
+        "(key text PRIMARY KEY, value text)",
+        "CREATE TABLE IF NOT EXISTS addresses "
+        "(account integer, chain integer, idx integer, address text, "
+        "PRIMARY KEY (account, chain, idx))",
+        "CREATE INDEX IF NOT EXISTS addresses_address ON addresses (address)",
+        "CREATE TABLE IF NOT EXISTS txns "
+        "(txid text PRIMARY KEY, txn text, block integer, block_hash text, "
+        "confirmations integer, network_time integer, value integer, "
+        "fees integer, provisional integer)",
+        "CREATE INDEX IF NOT EXISTS txns_network_time ON txns (network_time)",
+        "CREATE INDEX IF NOT EXISTS txns_provisional ON txns (provisional)",
+        "CREATE TABLE IF NOT EXISTS outputs "
+        "(txid text, idx integer, value integer, script blob, "
+        "status integer, spend_txid text, spend_index integer, "
+        "PRIMARY KEY (txid, idx))",
+        "CREATE TABLE IF NOT EXISTS deposits "
+        "(address text, txid text, idx integer, "
+        "PRIMARY KEY (address, txid, idx))",
+        "CREATE INDEX IF NOT EXISTS deposits_txid ON deposits (txid)",
+        "CREATE TABLE IF NOT EXISTS spends "
+        "(address text, txid text, idx integer, out_txid text, "
+        "out_index integer, PRIMARY KEY (address, txid, idx))",
+        "CREATE INDEX IF NOT EXISTS spends_txid ON spends (txid)",
+    ]
+
+    def __init__(self, testnet=False):
+        super().__init__(testnet)
+        self._db_path = None
+        self._connect(":memory:")
+
+    def _connect(self, path):
+        """ Opens (creating, if necessary) the database at path and
+            makes it the current store.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        for stmt in self.SCHEMA:
+            self._conn.execute(stmt)
+
+        version = self._get_meta("schema_version")
+        if version is None:
+            self._set_meta("schema_version", self.SCHEMA_VERSION)
+        elif version != self.SCHEMA_VERSION:
+            raise ValueError("Unsupported wallet cache schema version %s" %
+                             version)
+
+        last_block = self._get_meta("last_block")
+        self._last_block = None if last_block is None else int(last_block)
+        self._conn.commit()
+
+    def _get_meta(self, key):
+        row = self._conn.execute("SELECT value FROM meta WHERE key=?",
+                                 (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _set_meta(self, key, value):
+        self._conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                           (key, value))
+
+    @staticmethod
+    def _db_path_for(filename):
+        return os.path.splitext(os.path.abspath(filename))[0] + \
+            SQLiteCacheManager.DB_SUFFIX
+
+    @property
+    def last_block(self):
+        """ Returns the last block the cache knows about
+
+        Returns:
+            int: The block height of the last known block.
+        """
+        return self._last_block
+
+    @last_block.setter
+    def last_block(self, b):
+        if self._last_block is None or b > self._last_block:
+            self._last_block = b
+            self._set_meta("last_block", str(b))
+            self._dirty = True
+
+    def to_file(self, filename, force=False):
+        """ Commits the cache to the database belonging to filename.
+
+            If the cache is currently kept in memory or in the
+            database of another file, it is copied over first.
+
+        Args:
+            filename (str): The full path of the (JSON) cache file.
+            force (bool): Commits even if the cache is clean.
+        """
+        if not self._dirty and not force:
+            return
+
+        p = self._db_path_for(filename)
+        self._conn.commit()
+        if p != self._db_path:
+            conn = sqlite3.connect(p, check_same_thread=False)
+            self._conn.backup(conn)
+            self._conn.close()
+            conn.close()
+
+            self._connect(p)
+            self._db_path = p
+            os.chmod(p, 0o700)
+
+        self._dirty = False
+
+    def cache_exists(self, filename):
+        """ Returns whether there is a cache to load for filename.
+
+        Args:
+            filename (str): The full path of the (JSON) cache file.
+
+        Returns:
+            bool: True if there is either a database or a JSON cache
+                to migrate.
+        """
+        return os.path.exists(self._db_path_for(filename)) or \
+            os.path.exists(filename)
+
+    def load_from_file(self, filename):
+        """ Opens the database belonging to filename or, if there is
+            none, migrates the JSON cache in filename into a new one.
+
+        Args:
+            filename (str): The full path of the (JSON) cache file.
+        """
+        p = self._db_path_for(filename)
+        if os.path.exists(p):
+            self._conn.close()
+            self._connect(p)
+            self._db_path = p
+            for listener in self._utxo_listeners:
+                listener.load(self._all_utxos())
+            return
+
+        if os.path.exists(filename):
+            super().load_from_file(filename)
+            self.to_file(filename, force=True)
+
+    def load_from_dict(self, d, prune_provisional=True):
+        """ Loads the cache manager from a dict
+
+        Args:
+            d (dict): A dict of the type created by CacheManager.to_file.
+            prune_provisional (bool): If True, does not insert
+                provisionally-marked txns that are older than
+                self.PROVISIONAL_TXN_TIMEOUT.
+        """
+        if "version" not in d or d["version"] != self.CACHE_VERSION:
+            return
+
+        if "last_block" in d and d["last_block"] is not None:
+            self.last_block = d['last_block']
+
+        if "addresses" in d:
+            for acct_index, chains in d['addresses'].items():
+                for chain, addrs in chains.items():
+                    for index, address in addrs.items():
+                        self.insert_address(int(acct_index), int(chain),
+                                            int(index), address)
+
+        if "txns" in d:
+            for txid in d['txns']:
+                self._load_txn(d['txns'][txid], prune_provisional)
+
+        self._dirty = True
+
+    def insert_address(self, acct_index, chain, index, address):
+        """ Inserts an address into the cache
+
+        Args:
+            acct_index (int): Account index within wallet
+            chain (int): Either HDAccount.CHANGE_CHAIN or
+                HDAccount.PAYOUT_CHAIN
+            index (int): The index in the chain
+            address (str): The address to insert
+        """
+        if chain not in [0, 1]:
+            raise ValueError("chain must be either 0 or 1")
+
+        cur = self._conn.execute(
+            "INSERT OR IGNORE INTO addresses VALUES (?, ?, ?, ?)",
+            (acct_index, chain, index, address))
+        if cur.rowcount:
+            self._dirty = True
+
+            # UTXOs for the address may have been inserted before it
+            # was known to belong to an account.
+            if self._utxo_listeners:
+                for txid, i in self._conn.execute(
+                        "SELECT txid, idx FROM deposits WHERE address=?",
+                        (address,)).fetchall():
+                    self._notify_utxo_listeners(txid, i)
+
+    def get_address(self, acct_index, chain, index):
+        """ Returns the address for chain/index, if it exists in the cache
+
+        Args:
+            acct_index (int): Account index within wallet
+            chain (int): Either HDAccount.CHANGE_CHAIN or
+                HDAccount.PAYOUT_CHAIN
+            index (int): The index in the chain
+
+        Returns:
+            str or None: The address, or None if it's not in the cache
+        """
+        if chain not in [0, 1]:
+            raise ValueError("chain must be either 0 or 1")
+
+        row = self._conn.execute(
+            "SELECT address FROM addresses "
+            "WHERE account=? AND chain=? AND idx=?",
+            (acct_index, chain, index)).fetchone()
+
+        return None if row is None else row[0]
+
+    def lookup_paths(self, addresses):
+        """ Returns the derivation paths of addresses in the cache.
+
+        Args:
+            addresses (iterable(str)): The addresses to look up.
+
+        Returns:
+            dict: Keyed by address, with (account index, chain, index)
+                tuples as values. Only addresses in the cache are
+                included.
+        """
+        return {r[0]: tuple(r[1:]) for r in self._query_addresses(
+            "SELECT address, account, chain, idx FROM addresses "
+            "WHERE address IN ({addresses})", addresses)}
+
+    def get_addresses_for_chain(self, acct_index, chain):
+        """ Returns all addresses for a particular chain, in order by
+            their index in the chain.
+
+        Args:
+            acct_index (int): Account index within wallet
+            chain (int): Either HDAccount.CHANGE_CHAIN or
+                HDAccount.PAYOUT_CHAIN
+
+        Returns:
+            list: List of addresses
+        """
+        if chain not in [0, 1]:
+            raise ValueError("chain must be either 0 or 1")
+
+        return [r[0] for r in self._conn.execute(
+            "SELECT address FROM addresses WHERE account=? AND chain=? "
+            "ORDER BY idx", (acct_index, chain))]
+
+    def get_chain_indices(self, acct_index, chain):
+        """ Returns the address indices that are present in the cache
+            for the desired chain.
+
+        Args:
+            acct_index (int): Account index within wallet
+            chain (int): Either HDAccount.CHANGE_CHAIN or
+                HDAccount.PAYOUT_CHAIN
+
+        Returns:
+            list: List of addresses
+        """
+        if chain not in [0, 1]:
+            raise ValueError("chain must be either 0 or 1")
+
+        return [r[0] for r in self._conn.execute(
+            "SELECT idx FROM addresses WHERE account=? AND chain=? "
+            "ORDER BY idx", (acct_index, chain))]
+
+    def _get_txn_dict(self, txid):
+        """ Returns the serialized form (as created by
+            WalletTransaction._serialize()) of a cached transaction.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        row = self._conn.execute(
+            "SELECT txn, block, block_hash, confirmations, network_time, "
+            "value, fees, provisional FROM txns WHERE txid=?",
+            (txid,)).fetchone()
+        if row is None:
+            return None
+
+        return dict(transaction=row[0],
+                    block=row[1],
+                    block_hash=row[2],
+                    confirmations=row[3],
+                    network_time=row[4],
+                    value=row[5],
+                    fees=row[6],
+                    provisional=row[7] or False)
+
+    def insert_txn(self, wallet_txn, mark_provisional=False):
+        """ Inserts a transaction into the cache and updates the
+            relevant tables based on the addresses found in the
+            transaction.
+
+        Args:
+            wallet_txn (WalletTransaction): A wallet transaction object.
+            mark_provisional (bool): Marks the transaction as
+                provisional (i.e. the transaction may have been built
+                but not yet broadcast to the blockchain). Transactions
+                marked as provisional are automatically pruned if they
+                are not also seen by normal transaction
+                updates/insertions within a certain time period.
+        """
+        wallet_txn.freeze()
+        txid = str(wallet_txn.hash)
+
+        # Check if it's already in with no change in status
+        if wallet_txn._serialize() == self._get_txn_dict(txid):
+            return
+
+        if mark_provisional and not wallet_txn.provisional:
+            wallet_txn.provisional = int(time.time())
+
+        if not mark_provisional and wallet_txn.provisional:
+            wallet_txn.provisional = False
+
+        d = wallet_txn._serialize()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO txns VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (txid, d['transaction'], d['block'], d['block_hash'],
+             d['confirmations'], d['network_time'], d['value'], d['fees'],
+             d['provisional'] or 0))
+
+        conf = wallet_txn.confirmations > 0
+        status = self.SPENT
+        out_status = self.UNSPENT
+        if not conf:
+            status |= self.UNCONFIRMED
+            out_status |= self.UNCONFIRMED
+        if mark_provisional:
+            status |= self.PROVISIONAL
+            out_status |= self.PROVISIONAL
+
+        # Get all the addresses for the transaction
+        addrs = wallet_txn.get_addresses(self.testnet)
+
+        for i, inp in enumerate(wallet_txn.inputs):
+            if inp.script.is_multisig_sig():
+                # Only keep the P2SH address
+                sig_info = inp.script.extract_multisig_sig_info()
+                redeem_version = Script.P2SH_TESTNET_VERSION if self.testnet \
+                                 else Script.P2SH_MAINNET_VERSION
+                a = key_hash_to_address(
+                    sig_info['redeem_script'].hash160(), redeem_version)
+
+                addrs['inputs'][i] = [a]
+
+            # Update the status of any outputs
+            out_txid = str(inp.outpoint)
+            cur = self._conn.execute(
+                "UPDATE outputs SET status=?, spend_txid=?, spend_index=? "
+                "WHERE txid=? AND idx=?",
+                (status, txid, i, out_txid, inp.outpoint_index))
+            if not cur.rowcount:
+                self._conn.execute(
+                    "INSERT INTO outputs VALUES (?, ?, NULL, NULL, ?, ?, ?)",
+                    (out_txid, inp.outpoint_index, status, txid, i))
+
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO spends VALUES (?, ?, ?, ?, ?)",
+                [(a, txid, i, out_txid, inp.outpoint_index)
+                 for a in addrs['inputs'][i]])
+
+        for i, out in enumerate(wallet_txn.outputs):
+            # Only update the status if it is unconfirmed unspent going
+            # to confirmed unspent as it is possible that an input has
+            # already marked it as spent.
+            cur = self._conn.execute(
+                "UPDATE outputs SET value=?, script=?, "
+                "status=CASE WHEN status & ? THEN status ELSE ? END "
+                "WHERE txid=? AND idx=?",
+                (out.value, bytes(out.script), self.SPENT, out_status,
+                 txid, i))
+            if not cur.rowcount:
+                self._conn.execute(
+                    "INSERT INTO outputs VALUES (?, ?, ?, ?, ?, NULL, NULL)",
+                    (txid, i, out.value, bytes(out.script), out_status))
+
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO deposits VALUES (?, ?, ?)",
+                [(a, txid, i) for a in addrs['outputs'][i]])
+
+        if self._utxo_listeners:
+            for inp in wallet_txn.inputs:
+                self._notify_utxo_listeners(str(inp.outpoint),
+                                            inp.outpoint_index)
+            for i in range(len(wallet_txn.outputs)):
+                self._notify_utxo_listeners(txid, i)
+
+        self._dirty = True
+
+    def _delete_txn(self, txid):
+        """ Removes a transaction from the cache and updates any
+            ancestor/descendant transactions' statuses so that it was
+            like this transaction didn't exist.
+
+        Note:
+            THIS IS NOT A PUBLIC API. Use prune_provisional_txns() to
+            remove any transactions marked as provisional that may
+            have "expired".
+
+        Args:
+            txid (Hash or str): The ID of the transaction to remove.
+        """
+        _txid = str(txid)
+        txn = self.get_transaction(_txid)
+        if txn is None:
+            return
+
+        for inp in txn.inputs:
+            # Update the status of any outpoints
+            out_txid = str(inp.outpoint)
+            status = self.UNSPENT
+            out_txn = self._get_txn_dict(out_txid)
+            if out_txn is not None:
+                if out_txn['provisional']:
+                    status |= self.PROVISIONAL
+                if out_txn['confirmations'] == 0:
+                    status |= self.UNCONFIRMED
+
+            self._conn.execute(
+                "UPDATE outputs SET status=?, spend_txid=NULL, "
+                "spend_index=NULL WHERE txid=? AND idx=?",
+                (status, out_txid, inp.outpoint_index))
+
+        for table in ["spends", "deposits", "outputs", "txns"]:
+            self._conn.execute("DELETE FROM %s WHERE txid=?" % table,
+                               (_txid,))
+
+        if self._utxo_listeners:
+            for inp in txn.inputs:
+                self._notify_utxo_listeners(str(inp.outpoint),
+                                            inp.outpoint_index)
+            for i in range(len(txn.outputs)):
+                self._notify_utxo_listeners(_txid, i)
+
+        self._dirty = True
+
+    def prune_provisional_txns(self, age):
+        """ Removes transactions marked as provisional if they are older
+            than age.
+
+        Args:
+            age (int): Number of minutes old the transaction must be
+                to be pruned.
+        """
+        cutoff = time.time() - 60 * age
+        txids = [r[0] for r in self._conn.execute(
+            "SELECT txid FROM txns WHERE provisional != 0 AND provisional <= ?",
+            (cutoff,))]
+        for txid in txids:
+            self._delete_txn(txid)
+
+    def has_txns(self, account_index=None):
+        """ Returns whether or not there are any transactions in the cache.
+
+        Args:
+            account_index (int): The account to check. If None, returns
+                whether there are any transactions in the cache.
+
+        Returns:
+            bool: True if there are any transactions, False otherwise.
+        """
+        if account_index is None:
+            row = self._conn.execute("SELECT 1 FROM txns LIMIT 1").fetchone()
+        else:
+            row = self._conn.execute(
+                "SELECT 1 FROM addresses a WHERE a.account=? AND ("
+                "EXISTS (SELECT 1 FROM deposits d WHERE d.address=a.address) OR "
+                "EXISTS (SELECT 1 FROM spends s WHERE s.address=a.address)) "
+                "LIMIT 1", (account_index,)).fetchone()
+
+        return row is not None
+
+    def get_transaction(self, txid):
+        """ Returns the transaction object and metadata for txid
+
+        Args:
+            txid (Hash): The txid to retrieve.
+
+        Returns:
+            WalletTransaction: The transaction or None if it is not in
+                the cache.
+        """
+        d = self._get_txn_dict(str(txid))
+        return None if d is None else WalletTransaction._deserialize(d)
+
+    def have_transaction(self, txid):
+        """ Returns whether or not a txid (and associated transaction)
+            is in the cache.
+
+        Args:
+            txid (Hash): The txid to retrieve.
+
+        Returns:
+            bool: True if the transaction is in the cache.
+        """
+        row = self._conn.execute("SELECT 1 FROM txns WHERE txid=?",
+                                 (str(txid),)).fetchone()
+        return row is not None
+
+    def get_output(self, txid, index):
+        """ Returns an output of a transaction in the cache.
+
+        Args:
+            txid (Hash or str): The txid of the transaction.
+            index (int): The index of the output.
+
+        Returns:
+            TransactionOutput: The output or None if it is not in the
+                cache.
+        """
+        row = self._conn.execute(
+            "SELECT value, script FROM outputs WHERE txid=? AND idx=?",
+            (str(txid), index)).fetchone()
+        if row is None or row[0] is None:
+            return None
+
+        return TransactionOutput(row[0], Script(row[1]))
+
+    def get_txids_by_time(self):
+        """ Returns the txids of all transactions in the cache, ordered
+            from oldest to most recent.
+
+        Returns:
+            list(str): The txids.
+        """
+        return [r[0] for r in self._conn.execute(
+            "SELECT txid FROM txns ORDER BY network_time")]
+
+    def get_txns_for_address(self, address):
+        """ Returns a list of transactions for the address
+
+        Args:
+            address (str): The address to retrieve transactions for.
+
+        Returns:
+            list: A list of txids.
+        """
+        return [r[0] for r in self._conn.execute(
+            "SELECT txid FROM deposits WHERE address=? UNION "
+            "SELECT txid FROM spends WHERE address=?", (address, address))]
+
+    def address_has_txns(self, address):
+        """ Returns whether or not an address has any transactions
+            associated with it.
+
+        Args:
+            address (str): The address to check.
+
+        Returns:
+            bool: True if there are transactions for the address,
+                False otherwise.
+        """
+        row = self._conn.execute(
+            "SELECT 1 FROM deposits WHERE address=? UNION ALL "
+            "SELECT 1 FROM spends WHERE address=? LIMIT 1",
+            (address, address)).fetchone()
+        return row is not None
+
+    def _query_addresses(self, query, addresses, params=()):
+        """ Runs query once per chunk of addresses, substituting
+            "{addresses}" with the right number of placeholders.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        addresses = list(addresses)
+        # Stay below SQLITE_MAX_VARIABLE_NUMBER
+        chunk_size = 500
+        for i in range(0, len(addresses), chunk_size):
+            chunk = addresses[i:i + chunk_size]
+            q = query.format(addresses=",".join("?" * len(chunk)))
+            yield from self._conn.execute(q, tuple(params) + tuple(chunk))
+
+    UTXO_STATE_QUERY = (
+        "SELECT d.address, a.account, o.txid, o.idx, o.value, o.script, "
+        "o.status, t.confirmations FROM outputs o "
+        "JOIN txns t ON t.txid = o.txid "
+        "JOIN deposits d ON d.txid = o.txid AND d.idx = o.idx "
+        "LEFT JOIN addresses a ON a.address = d.address "
+        "WHERE o.value IS NOT NULL AND o.status & ?")
+
+    def _utxo_states(self, rows):
+        """ Turns rows returned by UTXO_STATE_QUERY into the
+            (address, account index, utxo, status) tuples passed to
+            UTXO listeners, one per output.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        rv = {}
+        for addr, account, txid, i, value, script, status, conf in rows:
+            if (txid, i) in rv and rv[(txid, i)][1] is not None:
+                continue
+            utxo = UnspentTransactionOutput(transaction_hash=Hash(txid),
+                                            outpoint_index=i,
+                                            value=value,
+                                            scr=Script(script),
+                                            confirmations=conf)
+            rv[(txid, i)] = (addr, account, utxo, status)
+
+        return list(rv.values())
+
+    def _all_utxos(self):
+        """ Returns all UTXOs in the cache for add_utxo_listener().
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        return self._utxo_states(self._conn.execute(self.UTXO_STATE_QUERY,
+                                                    (self.UNSPENT,)))
+
+    def _notify_utxo_listeners(self, txid, index):
+        """ Tells the UTXO listeners about the current state of the
+            output txid:index.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        states = self._utxo_states(self._conn.execute(
+            self.UTXO_STATE_QUERY + " AND o.txid = ? AND o.idx = ?",
+            (self.UNSPENT, txid, index)))
+        for listener in self._utxo_listeners:
+            if states:
+                listener.update_utxo(*states[0])
+            else:
+                listener.remove_utxo(txid, index)
+
+    def get_utxos(self, addresses, include_unconfirmed=False):
+        """ Returns a dict containing the UTXOs for the desired
+            addresses
+
+        Args:
+            addresses (list): List of addresses to get balances for
+            include_unconfirmed (bool): True if unconfirmed
+                transactions should be included in the balance.
+
+        Returns:
+            dict: Keys are addresses, values are lists of
+                UnspentTransactionOutput objects for the address.
+        """
+        if include_unconfirmed:
+            status_cond = "o.status & ?"
+        else:
+            status_cond = "o.status = ?"
+
+        rv = {}
+        for addr, txid, i, value, script, confirmations in self._query_addresses(
+                "SELECT d.address, o.txid, o.idx, o.value, o.script, "
+                "t.confirmations FROM deposits d "
+                "JOIN outputs o ON o.txid = d.txid AND o.idx = d.idx "
+                "JOIN txns t ON t.txid = o.txid "
+                "WHERE o.value IS NOT NULL AND " + status_cond +
+                " AND d.address IN ({addresses}) ORDER BY o.txid, o.idx",
+                addresses, (self.UNSPENT,)):
+            utxo = UnspentTransactionOutput(transaction_hash=Hash(txid),
+                                            outpoint_index=i,
+                                            value=value,
+                                            scr=Script(script),
+                                            confirmations=confirmations)
+            if addr not in rv:
+                rv[addr] = []
+            rv[addr].append(utxo)
+
+        return rv
+
+    def get_balances(self, addresses, include_unconfirmed=False):
+        """ Returns a dict containing the balances for the desired
+            addresses
+
+        Args:
+            addresses (list): List of addresses to get balances for
+            include_unconfirmed (bool): True if unconfirmed
+                transactions should be included in the balance.
+
+        Returns:
+            dict: Keys are addresses, values are balances for the address.
+        """
+        balances = {addr: 0 for addr in addresses}
+
+        if include_unconfirmed:
+            status_cond = "o.status & ?"
+        else:
+            status_cond = "o.status = ?"
+
+        for addr, value in self._query_addresses(
+                "SELECT d.address, SUM(o.value) FROM deposits d "
+                "JOIN outputs o ON o.txid = d.txid AND o.idx = d.idx "
+                "WHERE o.value IS NOT NULL AND " + status_cond +
+                " AND d.address IN ({addresses}) GROUP BY d.address",
+                addresses, (self.UNSPENT,)):
+            balances[addr] += value
+
+        if not include_unconfirmed:
+            # Confirmed Balance = sum(all confirmed utxos) + unconfirmed
+            # spends of confirmed outputs, so that we're not
+            # unnecessarily showing a lower confirmed balance
+            for addr, value in self._query_addresses(
+                    "SELECT s.address, SUM(o.value) FROM spends s "
+                    "JOIN outputs o ON o.txid = s.out_txid AND o.idx = s.out_index "
+                    "JOIN txns t ON t.txid = s.out_txid "
+                    "WHERE o.value IS NOT NULL AND t.confirmations > 0 "
+                    "AND o.status & ? AND o.status & ? "
+                    "AND s.address IN ({addresses}) GROUP BY s.address",
+                    addresses, (self.SPENT, self.UNCONFIRMED | self.PROVISIONAL)):
+                balances[addr] += value
+
+        return balances
@@ -0,0 +1,157 @@
+import threading
+import time
+
+
+class SyncScheduler(object):
+    """ Decides how much of a wallet needs to be synced with the
+        blockchain, rather than re-scanning every account on a timer.
+
+        Each sync first asks the data provider for the block height. A
+        full sync of all accounts (Two1Wallet._sync_accounts()) is
+        only done when a new block has been found, or at least every
+        FULL_SYNC_INTERVAL seconds. Otherwise only the addresses that
+        can have new (unconfirmed) activity without a block being
+        found are synced: the ones most recently handed out by each
+        chain and any requested with request_sync().
+
+        A watermark is kept for every address: the block height it was
+        last synced at. Targeted syncs only ask for transactions of an
+        address from its watermark on.
+
+        The scheduler is thread-safe: request_sync() and wake() can be
+        called from any thread, e.g. the RPC server's, while another
+        thread loops on wait() and sync().
+    """
+    FULL_SYNC_INTERVAL = 20 * 60  # seconds
+    # Number of addresses past the last used one in each chain
+    # that are synced between blocks.
+    FRESH_ADDRESSES = 2
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._woken = False
+        self._requested = set()
+        self._watermarks = {}
+        self._wallet = None
+        self.last_block = None
+        self.last_full_sync = 0
+
+    def request_sync(self, addresses=None):
+        """ Asks for a sync as soon as possible.
+
+        Args:
+            addresses (list(str)): Addresses that may have new
+                transactions. They are synced on the next sync even if
+                no new block has been found.
+        """
+        with self._cond:
+            if addresses:
+                self._requested.update(addresses)
+            self._woken = True
+            self._cond.notify_all()
+
+    def wake(self):
+        """ Wakes up any thread in wait().
+        """
+        self.request_sync()
+
+    def wait(self, timeout):
+        """ Waits for a request_sync() or for timeout seconds to go by.
+
+        Args:
+            timeout (float): Maximum number of seconds to wait.
+
+        Returns:
+            bool: True if woken up by request_sync(), False if timed out.
+        """
+        with self._cond:
+            woken = self._cond.wait_for(lambda: self._woken, timeout)
+            self._woken = False
+
+            return woken
+
+    def watermark(self, address):
+        """ Returns the block height an address was last synced at.
+
+        Args:
+            address (str): A Base58Check encoded address.
+
+        Returns:
+            int: The block height, or None if the address hasn't been
+                synced yet.
+        """
+        return self._watermarks.get(address, None)
+
+    def _fresh_addresses(self, wallet):
+        """ Returns the addresses of each chain that are most likely to
+            receive transactions: the last used one and the next
+            FRESH_ADDRESSES.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        addresses = set()
+        for acct in wallet._accounts:
+            for change in [acct.PAYOUT_CHAIN, acct.CHANGE_CHAIN]:
+                last = acct.last_indices[change]
+                for i in range(max(last, 0), last + self.FRESH_ADDRESSES + 1):
+                    addresses.add(acct.get_address(change, i))
+
+        return addresses
+
+    def sync(self, wallet):
+        """ Syncs as much of the wallet as needed.
+
+        Args:
+            wallet (Two1Wallet): The wallet to sync.
+
+        Returns:
+            str: "full" if all accounts were synced, "addresses" if
+                only some addresses were and None if nothing was.
+        """
+        with self._cond:
+            requested, self._requested = self._requested, set()
+
+        if wallet is not self._wallet:
+            # A different wallet (e.g. one that was just unlocked):
+            # nothing is known about it yet.
+            self._wallet = wallet
+            self._watermarks = {}
+            self.last_block = None
+
+        block = wallet.data_provider.get_block_height()
+        now = time.time()
+        if block != self.last_block or \
+           now - self.last_full_sync > self.FULL_SYNC_INTERVAL:
+            wallet._sync_accounts(block_height=block)
+            # The sync scanned every chain up to GAP_LIMIT addresses
+            # past its last used one.
+            for acct in wallet._accounts:
+                for change in [acct.PAYOUT_CHAIN, acct.CHANGE_CHAIN]:
+                    last = acct.last_indices[change]
+                    for i in range(last + acct.GAP_LIMIT + 1):
+                        self._watermarks[acct.get_address(change, i)] = block
+
+            self.last_block = block
+            self.last_full_sync = now
+
+            return "full"
+
+        addresses = requested | self._fresh_addresses(wallet)
+        if not addresses:
+            return None
+
+        # Only get the transactions of each address since its
+        # watermark.
+        by_watermark = {}
+        for addr in addresses:
+            watermark = self._watermarks.get(addr, None)
+            if watermark not in by_watermark:
+                by_watermark[watermark] = []
+            by_watermark[watermark].append(addr)
+
+        for watermark, addrs in by_watermark.items():
+            for addr in wallet.sync_addresses(addrs, watermark):
+                self._watermarks[addr] = block
+
+        return "addresses"
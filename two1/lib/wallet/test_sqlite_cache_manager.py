@@ -0,0 +1,161 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from two1.lib.bitcoin.crypto import PrivateKey
+from two1.lib.bitcoin.hash import Hash
+from two1.lib.bitcoin.script import Script
+from two1.lib.bitcoin.txn import TransactionInput
+from two1.lib.bitcoin.txn import TransactionOutput
+from two1.lib.bitcoin.utils import pack_var_str
+from two1.lib.wallet.cache_manager import CacheManager
+from two1.lib.wallet.sqlite_cache_manager import SQLiteCacheManager
+from two1.lib.wallet.wallet_txn import WalletTransaction
+
+# The wallet's keys, and one key (the last) that is not the wallet's.
+KEYS = [PrivateKey(i + 1) for i in range(5)]
+ADDRESSES = [k.public_key.address() for k in KEYS[:4]]
+EXTERNAL = len(KEYS) - 1
+
+
+def make_txn(spends, outputs, confirmations, network_time):
+    """ Builds a transaction.
+
+    Args:
+        spends (list(tuple)): (transaction, output index, key index)
+            tuples. A transaction of None spends an output of some
+            transaction that isn't in the cache.
+        outputs (list(tuple)): (key index, value) tuples.
+        confirmations (int): Number of confirmations.
+        network_time (int): Time the transaction was first seen.
+
+    Returns:
+        WalletTransaction: The transaction.
+    """
+    inputs = []
+    for n, (txn, index, key) in enumerate(spends):
+        outpoint = Hash(bytes([n + 1]) * 32) if txn is None else txn.hash
+        script = Script(pack_var_str(b'\x30' * 71) +
+                        pack_var_str(KEYS[key].public_key.compressed_bytes))
+        inputs.append(TransactionInput(outpoint, index, script, 0xffffffff))
+
+    return WalletTransaction(
+        1, inputs,
+        [TransactionOutput(value, Script.build_p2pkh(KEYS[key].public_key.hash160()))
+         for key, value in outputs],
+        0, confirmations=confirmations, network_time=network_time)
+
+
+class SQLiteCacheManagerTestCase(unittest.TestCase):
+
+    """ Checks that SQLiteCacheManager answers like CacheManager."""
+
+    def setUp(self):
+        f1 = make_txn([(None, 0, EXTERNAL)], [(0, 50000), (1, 30000)], 3, 100)
+        f2 = make_txn([(None, 1, EXTERNAL)], [(2, 20000)], 0, 200)
+        # Provisional spends: s2 spends the change of s1.
+        s1 = make_txn([(f1, 0, 0)], [(EXTERNAL, 40000), (3, 9000)], 0, 300)
+        s2 = make_txn([(s1, 1, 3)], [(1, 8000)], 0, 400)
+        s3 = make_txn([(f2, 0, 2)], [(EXTERNAL, 19000)], 0, 500)
+        self.confirmed_s3 = make_txn([(f2, 0, 2)], [(EXTERNAL, 19000)], 1, 500)
+
+        self.inserts = [(f1, False), (f2, False), (s1, True), (s2, True), (s3, True)]
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.tmpdir, "wallet_cache.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @staticmethod
+    def insert(cm, txn, provisional=False):
+        # insert_txn() marks the transaction it is given, so each cache
+        # manager gets a copy of its own.
+        cm.insert_txn(WalletTransaction._deserialize(txn._serialize()), provisional)
+
+    def populate(self, cm):
+        for i, address in enumerate(ADDRESSES):
+            cm.insert_address(0, i % 2, i // 2, address)
+        for txn, provisional in self.inserts:
+            self.insert(cm, txn, provisional)
+
+    @staticmethod
+    def state(cm):
+        """ Returns the answers of cm to the queries the wallet makes."""
+        rv = dict(txids=cm.get_txids_by_time())
+        for unconfirmed in [False, True]:
+            rv[('balances', unconfirmed)] = cm.get_balances(ADDRESSES, unconfirmed)
+            rv[('utxos', unconfirmed)] = {
+                addr: sorted((str(u.transaction_hash), u.outpoint_index, u.value,
+                              u.num_confirmations) for u in utxos)
+                for addr, utxos in cm.get_utxos(ADDRESSES, unconfirmed).items()}
+
+        return rv
+
+    def assertSameState(self, expected, actual):
+        self.assertEqual(self.state(expected), self.state(actual))
+
+    def test_same_answers(self):
+        """ The same inserts, confirmations and prunes give the same answers."""
+        ref, sq = CacheManager(), SQLiteCacheManager()
+        self.populate(ref)
+        self.populate(sq)
+        self.assertSameState(ref, sq)
+        self.assertEqual(sq.get_balances(ADDRESSES, True)[ADDRESSES[1]], 38000)
+
+        for cm in [ref, sq]:
+            self.insert(cm, self.confirmed_s3)
+        self.assertSameState(ref, sq)
+
+        # Removes s1 and s2, but not s3 which is now confirmed.
+        for cm in [ref, sq]:
+            cm.prune_provisional_txns(0)
+        self.assertSameState(ref, sq)
+        self.assertEqual(len(sq.get_txids_by_time()), 3)
+        self.assertEqual(sq.get_balances(ADDRESSES, True)[ADDRESSES[0]], 50000)
+
+    def test_migration(self):
+        """ An existing JSON cache and its journal are migrated."""
+        ref = CacheManager()
+        self.populate(ref)
+        ref.to_file(self.cache_file, force=True)
+        # Journaled after the snapshot
+        self.insert(ref, self.confirmed_s3)
+        ref.to_file(self.cache_file)
+        self.assertTrue(os.path.exists(self.cache_file + CacheManager.JOURNAL_SUFFIX))
+
+        sq = SQLiteCacheManager()
+        self.assertTrue(sq.cache_exists(self.cache_file))
+        sq.load_from_file(self.cache_file)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tmpdir, "wallet_cache" + SQLiteCacheManager.DB_SUFFIX)))
+        self.assertSameState(ref, sq)
+        self.assertEqual(sq.get_chain_indices(0, 1), ref.get_chain_indices(0, 1))
+
+    def test_reopen(self):
+        """ The database is used as is when the cache is loaded again."""
+        ref, sq = CacheManager(), SQLiteCacheManager()
+        self.populate(ref)
+        self.populate(sq)
+        sq.last_block = 1234
+        sq.to_file(self.cache_file)
+        self.assertFalse(os.path.exists(self.cache_file))
+
+        reopened = SQLiteCacheManager()
+        reopened.load_from_file(self.cache_file)
+        self.assertSameState(ref, reopened)
+        self.assertEqual(reopened.last_block, 1234)
+
+        # Later changes are committed to the same database.
+        for cm in [ref, reopened]:
+            self.insert(cm, self.confirmed_s3)
+            cm.prune_provisional_txns(0)
+        reopened.to_file(self.cache_file)
+
+        again = SQLiteCacheManager()
+        again.load_from_file(self.cache_file)
+        self.assertSameState(ref, again)
+
+
+if __name__ == "__main__":
+    unittest.main()
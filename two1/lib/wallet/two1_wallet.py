@@ -1,4 +1,5 @@
 import builtins
+import functools
 import getpass
 import inspect
 import json
@@ -25,14 +26,18 @@ from two1.lib.blockchain.twentyone_provider import TwentyOneProvider
 from two1.lib.wallet import exceptions
 from two1.lib.wallet.account_types import account_types
 from two1.lib.wallet.hd_account import HDAccount
+from two1.lib.wallet.hd_account import sync_accounts
 from two1.lib.wallet.base_wallet import BaseWallet
 from two1.lib.wallet.cache_manager import CacheManager
+from two1.lib.wallet.sqlite_cache_manager import SQLiteCacheManager
 from two1.lib.wallet import exceptions
 from two1.lib.wallet.wallet_txn import WalletTransaction
 from two1.lib.wallet.utxo_selectors import DEFAULT_INPUT_FEE
 from two1.lib.wallet.utxo_selectors import DEFAULT_OUTPUT_FEE
 from two1.lib.wallet.socket_rpc_server import UnixSocketServerProxy
 from two1.lib.wallet.utxo_selectors import utxo_selector_smallest_first
+from two1.lib.wallet.utxo_selectors import utxo_selectors
+from two1.lib.wallet.utxo_pool import UTXOPool
 
 
 class Two1Wallet(BaseWallet):
@@ -78,10 +83,14 @@ class Two1Wallet(BaseWallet):
         data_provider (BaseProvider): An instance of a derived
            two1.blockchain.BaseProvider class as described above.
         passphrase (str): Passphrase to unlock wallet key if it is locked.
-        utxo_selector (function): A filtering function with the
-           prototype documented above.
+        utxo_selector (function or str): A filtering function with the
+           prototype documented above, or the name of one of the
+           selectors in utxo_selectors.utxo_selectors.
         skip_discovery (bool): If True, skips account and address discovery.
            This should only be set to True on account creation!
+        cache_backend (str): One of the keys of CACHE_BACKENDS. "json"
+           keeps the cache in memory and writes it to a JSON file;
+           "sqlite" keeps it in an SQLite database next to that file.
 
     Returns:
         Two1Wallet: The wallet instance.
@@ -95,6 +104,10 @@ class Two1Wallet(BaseWallet):
                                        "default_wallet.json")
     WALLET_FILE_VERSION = "0.1.0"
     WALLET_CACHE_VERSION = "0.1.0"
+    MIN_PARALLEL_SIGNING_INPUTS = 8
+    ACCOUNT_DISCOVERY_WINDOW = 4
+    CACHE_BACKENDS = {"json": CacheManager,
+                      "sqlite": SQLiteCacheManager}
 
     """ The configuration options available for creating the wallet.
 
@@ -389,12 +402,24 @@ class Two1Wallet(BaseWallet):
     def __init__(self, params_or_file, data_provider,
                  passphrase='',
                  utxo_selector=utxo_selector_smallest_first,
-                 skip_discovery=False):
+                 skip_discovery=False,
+                 cache_backend="json"):
+        if cache_backend not in self.CACHE_BACKENDS:
+            raise ValueError("cache_backend must be one of %r" %
+                             list(self.CACHE_BACKENDS.keys()))
+
+        if isinstance(utxo_selector, str):
+            if utxo_selector not in utxo_selectors:
+                raise ValueError("utxo_selector must be one of %r" %
+                                 list(utxo_selectors.keys()))
+            utxo_selector = utxo_selectors[utxo_selector]
+
         self.data_provider = data_provider
         self.utxo_selector = utxo_selector
+        self.signing_executor = None
         self._testnet = False
         self._filename = ""
-        self._cache_manager = CacheManager(self._testnet)
+        self._cache_manager = self.CACHE_BACKENDS[cache_backend](self._testnet)
 
         params = {}
         if isinstance(params_or_file, dict):
@@ -456,6 +481,10 @@ class Two1Wallet(BaseWallet):
             self._account_map = params.get("account_map", {})
             self._load_accounts(account_params, cache_file)
 
+        # Keep the UTXOs sorted for selection from here on.
+        self._utxo_pool = UTXOPool()
+        self._cache_manager.add_utxo_listener(self._utxo_pool)
+
         if self.logger.level == logging.DEBUG:
             for a in self._accounts:
                 kser = ""
@@ -489,9 +518,23 @@ class Two1Wallet(BaseWallet):
         i = 0
         while has_txns:
             if i >= len(self._accounts):
-                self._init_account(index=i)
-            has_txns = self._accounts[i].has_txns()
-            i += 1
+                # Scan the next few accounts concurrently rather than
+                # one at a time. Those past the first unused account
+                # are thrown away.
+                batch = [self._create_account(index=j, skip_discovery=True)
+                         for j in range(i, i + self.ACCOUNT_DISCOVERY_WINDOW)]
+                sync_accounts(batch, check_all=True)
+
+                for acct in batch:
+                    acct._update_balance()
+                    self._accounts.append(acct)
+                    self._account_map[acct.name] = len(self._accounts) - 1
+                    if not acct.has_txns():
+                        break
+
+            while has_txns and i < len(self._accounts):
+                has_txns = self._accounts[i].has_txns()
+                i += 1
 
         # The last one will not have txns, so remove it unless it's the
         # default one.
@@ -537,6 +580,13 @@ class Two1Wallet(BaseWallet):
 
     def _init_account(self, index,
                       name="", account_state=None, skip_discovery=False):
+        acct = self._create_account(index, name, account_state,
+                                    skip_discovery)
+        self._accounts.insert(index, acct)
+        self._account_map[name] = index
+
+    def _create_account(self, index,
+                        name="", account_state=None, skip_discovery=False):
         # Account keys use hardened deriviation, so make sure the MSB is set
         acct_index = index | 0x80000000
 
@@ -550,17 +600,12 @@ class Two1Wallet(BaseWallet):
                          testnet=self._testnet,
                          last_state=account_state,
                          skip_discovery=skip_discovery)
-        self._accounts.insert(index, acct)
-        self._account_map[name] = index
+        return acct
 
     def _load_accounts(self, account_params, cache_file=None):
-        cache = {}
-        if cache_file is not None and os.path.exists(cache_file):
-            with open(cache_file) as cf:
-                cache = json.load(cf)
-
-        if cache:
-            self._cache_manager.load_from_dict(cache)
+        if cache_file is not None and \
+           self._cache_manager.cache_exists(cache_file):
+            self._cache_manager.load_from_file(cache_file)
 
         for i, a in enumerate(account_params):
             # Determine account name
@@ -602,17 +647,57 @@ class Two1Wallet(BaseWallet):
         return accts
 
     def _sync_accounts(self,
-                       provisional_txn_timeout=CacheManager.PROVISIONAL_TXN_TIMEOUT):
+                       provisional_txn_timeout=CacheManager.PROVISIONAL_TXN_TIMEOUT,
+                       block_height=None):
+        sync_accounts(self._accounts)
         for a in self._accounts:
-            a._sync_txns()
             a._update_balance()
 
         self._cache_manager.prune_provisional_txns(
             age=provisional_txn_timeout)
 
-        self._cache_manager.last_block = self.data_provider.get_block_height()
+        if block_height is None:
+            block_height = self.data_provider.get_block_height()
+        self._cache_manager.last_block = block_height
         self.sync_wallet_file()
 
+    def sync_addresses(self, addresses, min_block=None):
+        """ Gets new transactions for specific addresses of the wallet
+            rather than re-scanning all accounts.
+
+            Addresses that don't belong to any discovered account are
+            ignored.
+
+        Args:
+            addresses (list(str)): List of Base58Check encoded addresses.
+            min_block (int): Block height from which to get
+                transactions. If None, gets all transactions.
+
+        Returns:
+            list(str): The addresses that were synced.
+        """
+        # Don't let a caching data provider answer with what it got
+        # before the new transactions.
+        self.data_provider.invalidate(addresses)
+
+        accts = {a.index: a for a in self._accounts}
+        by_acct = {}
+        for addr, path in self.find_addresses(addresses).items():
+            acct_index, change, i = path
+            if acct_index not in by_acct:
+                by_acct[acct_index] = {}
+            by_acct[acct_index][addr] = (change, i)
+
+        synced = []
+        for acct_index, acct_addrs in by_acct.items():
+            accts[acct_index].sync_addresses(acct_addrs, min_block)
+            synced += list(acct_addrs.keys())
+
+        if synced:
+            self.sync_wallet_file()
+
+        return synced
+
     def get_private_keys(self, addresses):
         """ Returns private keys for a list of addresses, if they
             are a part of this wallet.
@@ -668,15 +753,16 @@ class Two1Wallet(BaseWallet):
             dict: Dict keyed by address with the path (account index first)
                corresponding to the derivation path for that key.
         """
-        addrs = addresses
+        addrs = set(addresses)
         found = {}
         for acct in self._accounts:
+            if not addrs:
+                break
+
             acct_found = acct.find_addresses(addrs)
             found.update(acct_found)
             # Remove any found addresses so we don't keep searching for them
-            remove_indices = sorted(list(acct_found.keys()), reverse=True)
-            for r in remove_indices:
-                addrs.remove(r)
+            addrs.difference_update(acct_found.keys())
 
         # Do we also check 1 account up, just in case this was
         # imported somewhere else and that created the next account?
@@ -1023,15 +1109,7 @@ class Two1Wallet(BaseWallet):
             str: The name of the transaction that was broadcasted.
         """
         res = ""
-        _txn = None
-        if isinstance(tx, str):
-            _txn = WalletTransaction.from_hex(tx)
-        elif isinstance(tx, bytes):
-            _txn, _ = WalletTransaction.from_bytes(tx)
-        elif isinstance(tx, Transaction):
-            _txn = WalletTransaction.from_transaction(tx)
-        else:
-            raise TypeError("tx must be one of: bytes, str, Transaction.")
+        _txn = self._to_wallet_transaction(tx)
 
         try:
             txid = self.data_provider.broadcast_transaction(tx)
@@ -1041,9 +1119,51 @@ class Two1Wallet(BaseWallet):
         except exceptions.WalletError as e:
             self.logger.critical(
                 "Problem sending transaction to network: %s" % e)
+            self._release_inputs(_txn)
 
         return res
 
+    def release_transaction(self, tx):
+        """ Releases the UTXOs spent by a transaction built with
+            build_signed_transaction() that will not be broadcast.
+
+            The UTXOs selected for a transaction are reserved so that
+            other transactions can't spend them, until the transaction
+            is seen in the cache or the reservation expires. If the
+            transaction is discarded, releasing it makes its UTXOs
+            available again right away.
+
+        Args:
+            tx (str or bytes or Transaction): The discarded transaction.
+        """
+        self._release_inputs(self._to_wallet_transaction(tx))
+
+    def _release_inputs(self, txn):
+        """ Releases the reservations of the UTXOs spent by txn.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        self._utxo_pool.unreserve([(str(i.outpoint), i.outpoint_index)
+                                   for i in txn.inputs])
+
+    @staticmethod
+    def _to_wallet_transaction(tx):
+        """ Converts a hex string, bytes or Transaction into a
+            WalletTransaction.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        if isinstance(tx, str):
+            return WalletTransaction.from_hex(tx)
+        elif isinstance(tx, bytes):
+            return WalletTransaction.from_bytes(tx)[0]
+        elif isinstance(tx, Transaction):
+            return WalletTransaction.from_transaction(tx)
+        else:
+            raise TypeError("tx must be one of: bytes, str, Transaction.")
+
     def build_signed_transaction(self, addresses_and_amounts,
                                  use_unconfirmed=False,
                                  insert_into_cache=False,
@@ -1054,6 +1174,10 @@ class Two1Wallet(BaseWallet):
             In the future, this function may create multiple transactions
             if a single one would be too big.
 
+            The UTXOs spent are reserved until the transaction is seen
+            in the cache. Transactions that are not broadcast should be
+            passed to release_transaction().
+
         Args:
             addresses_and_amounts (dict): A dict keyed by recipient address
                and corresponding values being the amount - *in satoshis* - to
@@ -1098,15 +1222,35 @@ class Two1Wallet(BaseWallet):
             balance = min(c_balance, u_balance)
 
         # Now get the unspents from all accounts and select which we
-        # want to use
-        utxos_by_addr = self.get_utxos(include_unconfirmed=use_unconfirmed,
-                                       accounts=accts)
+        # want to use. The selected ones are reserved so that other
+        # transactions being built at the same time can't use them.
+        with self._utxo_pool.lock:
+            utxos_by_addr = self._utxo_pool.view(
+                include_unconfirmed=use_unconfirmed,
+                accounts=set(a.index for a in accts))
+
+            selected_utxos, fees = self.utxo_selector(data_provider=self.data_provider,
+                                                      utxos_by_addr=utxos_by_addr,
+                                                      amount=total_amount,
+                                                      num_outputs=len(addresses_and_amounts),
+                                                      fees=fees)
+            reserved = [(str(utxo.transaction_hash), utxo.outpoint_index)
+                        for utxo_list in selected_utxos.values()
+                        for utxo in utxo_list]
+            self._utxo_pool.reserve(reserved)
+
+        try:
+            return self._build_signed_transaction(
+                addresses_and_amounts, selected_utxos, total_amount, fees,
+                balance, c_balance, use_unconfirmed, insert_into_cache, accts)
+        except:
+            self._utxo_pool.unreserve(reserved)
+            raise
 
-        selected_utxos, fees = self.utxo_selector(data_provider=self.data_provider,
-                                                  utxos_by_addr=utxos_by_addr,
-                                                  amount=total_amount,
-                                                  num_outputs=len(addresses_and_amounts),
-                                                  fees=fees)
+    def _build_signed_transaction(self, addresses_and_amounts,
+                                  selected_utxos, total_amount, fees,
+                                  balance, c_balance, use_unconfirmed,
+                                  insert_into_cache, accts):
 
         # Verify we have enough money
         total_with_fees = total_amount + fees
@@ -1165,8 +1309,12 @@ class Two1Wallet(BaseWallet):
                                 value=total_amount,
                                 fees=fees)
 
+        # Freezing the transaction lets all the sign_input() calls
+        # below share the serialized parts of the signature hashes.
+        txn.freeze()
+
         # Now sign all the inputs
-        i = 0
+        signing_requests = []
         for addr, utxo_list in selected_utxos.items():
             # Need to get the private key
             private_key = private_keys.get(addr, None)
@@ -1175,16 +1323,20 @@ class Two1Wallet(BaseWallet):
                     "Couldn't find address %s or unable to generate private key for it." % addr)
 
             for utxo in utxo_list:
-                signed = txn.sign_input(input_index=i,
-                                        hash_type=Transaction.SIG_HASH_ALL,
-                                        private_key=private_key,
-                                        sub_script=utxo.script)
+                signing_requests.append((len(signing_requests),
+                                         Transaction.SIG_HASH_ALL,
+                                         private_key,
+                                         utxo.script))
 
-                if not signed:
-                    raise exceptions.WalletSigningError(
-                        "Unable to sign input %d." % i)
+        # Only farm signing out to the executor when there are enough
+        # inputs to make up for the cost of shipping them to it.
+        executor = None
+        if len(signing_requests) >= self.MIN_PARALLEL_SIGNING_INPUTS:
+            executor = self.signing_executor
 
-                i += 1
+        signed = txn.sign_inputs_batch(signing_requests, executor)
+        if not signed:
+            raise exceptions.WalletSigningError("Unable to sign inputs.")
 
         if insert_into_cache:
             self._cache_manager.insert_txn(txn, mark_provisional=True)
@@ -1379,9 +1531,8 @@ class Two1Wallet(BaseWallet):
 
         # Force address discovery
         now = time.time()
-        for a in accts:
-            if now - a._last_update > 10:
-                a._sync_txns(check_all=True)
+        sync_accounts([a for a in accts if now - a._last_update > 10],
+                      check_all=True)
 
         utxos_by_addr = self.get_utxos(include_unconfirmed=True,
                                        accounts=accts)
@@ -1554,12 +1705,21 @@ class Two1Wallet(BaseWallet):
 
         return rv
 
-    def _create_txn_history_record(self, txid, acct_addrs):
-        txc = self._cache_manager._txn_cache
+    def _create_txn_history_record(self, txid, accts):
         include = False
-        wt = txc[txid]
+        wt = self._cache_manager.get_transaction(txid)
         wt_addrs = wt.get_addresses(self._testnet)
 
+        # Map the addresses in the transaction that belong to accts
+        # to (account, chain)
+        acct_addrs = {}
+        paths = self._cache_manager.lookup_paths(
+            set(a for addrs in wt_addrs['inputs'] + wt_addrs['outputs']
+                for a in addrs))
+        for addr, (acct_index, chain, i) in paths.items():
+            if acct_index in accts:
+                acct_addrs[addr] = (accts[acct_index], chain)
+
         values = dict(inputs=0, outputs=0,
                       internal_inputs=0, internal_outputs=0)
         txid_dict = dict(txid=txid,
@@ -1576,7 +1736,7 @@ class Two1Wallet(BaseWallet):
                     # Lookup the value for the corresponding output
                     o = wt.inputs[i].outpoint
                     o_index = wt.inputs[i].outpoint_index
-                    value = self._cache_manager._outputs_cache[str(o)][o_index]['output'].value
+                    value = self._cache_manager.get_output(o, o_index).value
                     values["inputs"] += value
 
                     txid_dict['spends'].append(
@@ -1636,23 +1796,11 @@ class Two1Wallet(BaseWallet):
             this wallet. Transactions are ordered from oldest to most
             recent.
         """
-        # First get address to account/chain mapping
-        accts = self._check_and_get_accounts(accounts)
-
-        acct_addrs = {}
-        for a in accts:
-            for i in [0, 1]:
-                ia = self._cache_manager.get_addresses_for_chain(
-                    acct_index=a.index, chain=i)
-                for addr in ia:
-                    acct_addrs[addr] = (a, i)
+        accts = {a.index: a for a in self._check_and_get_accounts(accounts)}
 
         history = []
-        txc = self._cache_manager._txn_cache
-        ordered_txids = sorted(list(txc.keys()),
-                               key=lambda txid: txc[txid].network_time)
-        for txid in ordered_txids:
-            record = self._create_txn_history_record(txid, acct_addrs)
+        for txid in self._cache_manager.get_txids_by_time():
+            record = self._create_txn_history_record(txid, accts)
             if record is not None:
                 history.append(record)
         return history
@@ -1690,6 +1838,12 @@ def _public_key_serializer(public_key):
         else public_key.to_base64().decode()
 
 
+def _transaction_serializer(tx):
+    if isinstance(tx, Transaction):
+        return tx.to_hex()
+    return utils.bytes_to_str(tx) if isinstance(tx, bytes) else tx
+
+
 class Wallet(object):
     """ Abstraction layer between wallet object and wallet daemon proxy.
 
@@ -1735,7 +1889,10 @@ class Wallet(object):
 
             # Check the path to make sure it's the same
             wp = w.wallet_path()
-            rv = w if wp == wallet_path else None
+            if wp == wallet_path:
+                rv = w
+            else:
+                w.close()
 
         except (exceptions.DaemonNotRunningError, ReceivedErrorResponse) as e:
             rv = None
@@ -1795,10 +1952,22 @@ class Wallet(object):
             return_value=txn_list_deser),
         build_signed_transaction=dict(
             args=dict(),
-            return_value=lambda rv: [WalletTransaction._deserialize(t) for t in rv]))
+            return_value=lambda rv: [WalletTransaction._deserialize(t) for t in rv]),
+        release_transaction=dict(
+            args=dict(tx=_transaction_serializer),
+            return_value=None))
+
+    # Methods and properties whose results only depend on their
+    # arguments. The daemon is only asked for these once.
+    pure_methods = set(['testnet',
+                        'get_message_signing_public_key'])
+
+    # method name -> parameter names, for argument serialization
+    _param_names = {}
 
     def __init__(self, wallet_path=Two1Wallet.DEFAULT_WALLET_PATH,
                  data_provider=None, passphrase=''):
+        self._results_cache = {}
         w = self.check_daemon_running(wallet_path)
         if w is not None:
             self.w = w
@@ -1823,30 +1992,26 @@ class Wallet(object):
             raise getattr(builtins, data['type'])(data['message'])
 
     def _do_args_serialize(self, method_name, *args, **kwargs):
-        new_args = []
-        new_kwargs = {}
+        if method_name not in self.serializers:
+            return (args, kwargs)
 
-        if isinstance(self.w, Two1Wallet):
-            attr = getattr(self.w, method_name)
-        else:
-            attr = getattr(Two1Wallet, method_name)
-        sig = inspect.signature(attr)
-        param_names = list(sig.parameters)
-        if not isinstance(self.w, Two1Wallet):
-            param_names = param_names[1:]
+        param_names = self._param_names.get(method_name, None)
+        if param_names is None:
+            sig = inspect.signature(getattr(Two1Wallet, method_name))
+            # Skip self
+            param_names = list(sig.parameters)[1:]
+            self._param_names[method_name] = param_names
 
-        if method_name in self.serializers:
-            ms = self.serializers[method_name]['args']
+        new_args = []
+        new_kwargs = {}
+        ms = self.serializers[method_name]['args']
 
-            for i, a in enumerate(args):
-                pname = param_names[i]
-                new_args.append(ms[pname](a) if pname in ms else a)
+        for i, a in enumerate(args):
+            pname = param_names[i]
+            new_args.append(ms[pname](a) if pname in ms else a)
 
-            for pname, val in kwargs.items():
-                new_kwargs[pname] = ms[pname](val) if pname in ms else val
-        else:
-            new_args = args
-            new_kwargs = kwargs
+        for pname, val in kwargs.items():
+            new_kwargs[pname] = ms[pname](val) if pname in ms else val
 
         return (new_args, new_kwargs)
 
@@ -1857,22 +2022,131 @@ class Wallet(object):
 
         return rv
 
+    def _cache_key(self, method_name, args, kwargs):
+        """ Returns the key to cache the result of a call under, or
+            None if it shouldn't be cached.
+        """
+        if method_name not in self.pure_methods:
+            return None
+
+        key = (method_name, tuple(args), tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+
+        return key
+
+    def _call(self, method_name, *args, **kwargs):
+        """ Calls a method of the wallet daemon.
+
+        Note:
+            THIS IS NOT A PUBLIC API.
+        """
+        key = self._cache_key(method_name, args, kwargs)
+        if key is not None and key in self._results_cache:
+            return self._results_cache[key]
+
+        new_args, new_kwargs = self._do_args_serialize(method_name,
+                                                       *args,
+                                                       **kwargs)
+        try:
+            rv = self._do_return_deserialize(
+                method_name,
+                getattr(self.w, method_name)(*new_args, **new_kwargs))
+        except ReceivedErrorResponse as e:
+            self._handle_server_error(e)
+
+        if key is not None:
+            self._results_cache[key] = rv
+
+        return rv
+
+    def _call_batch(self, calls):
+        """ Makes several calls, in a single round trip if using the
+            wallet daemon.
+
+        Note:
+            THIS IS NOT A PUBLIC API. Use batch() instead.
+
+        Args:
+            calls (list(tuple)): (method name, args, kwargs) tuples.
+
+        Returns:
+            list(tuple): A (return value, exception) tuple for each
+                call. exception is None if the call succeeded.
+        """
+        rv = [None] * len(calls)
+        if isinstance(self.w, Two1Wallet):
+            for i, (method_name, args, kwargs) in enumerate(calls):
+                try:
+                    attr = getattr(self.w, method_name)
+                    if not isinstance(getattr(Two1Wallet, method_name),
+                                      property):
+                        attr = attr(*args, **kwargs)
+                    rv[i] = (attr, None)
+                except Exception as e:
+                    rv[i] = (None, e)
+
+            return rv
+
+        keys = []
+        requests = []
+        for i, (method_name, args, kwargs) in enumerate(calls):
+            key = self._cache_key(method_name, args, kwargs)
+            if key is not None and key in self._results_cache:
+                rv[i] = (self._results_cache[key], None)
+                continue
+
+            try:
+                new_args, new_kwargs = self._do_args_serialize(method_name,
+                                                               *args,
+                                                               **kwargs)
+            except Exception as e:
+                rv[i] = (None, e)
+                continue
+
+            keys.append((i, key))
+            requests.append((method_name, new_args, new_kwargs))
+
+        results = self.w.request_batch(requests)
+        for (i, key), (method_name, _, _), result in zip(keys, requests,
+                                                         results):
+            try:
+                if isinstance(result, ReceivedErrorResponse):
+                    self._handle_server_error(result)
+                result = self._do_return_deserialize(method_name, result)
+            except Exception as e:
+                rv[i] = (None, e)
+                continue
+
+            if key is not None:
+                self._results_cache[key] = result
+            rv[i] = (result, None)
+
+        return rv
+
+    def batch(self):
+        """ Returns a context manager that collects wallet calls and
+            makes them all at once when it exits, in a single round
+            trip if using the wallet daemon:
+
+                with wallet.batch() as b:
+                    balance = b.confirmed_balance()
+                    address = b.current_address
+
+                print(balance.result(), address.result())
+
+        Returns:
+            WalletBatch: The batch.
+        """
+        return WalletBatch(self)
+
     def __getattr__(self, method_name):
         rv = None
         if hasattr(self.w, method_name):
             attr = getattr(self.w, method_name)
 
-            def wrapper(*args, **kwargs):
-                try:
-                    new_args, new_kwargs = self._do_args_serialize(method_name,
-                                                                   *args,
-                                                                   **kwargs)
-                    return self._do_return_deserialize(
-                        method_name,
-                        attr(*new_args, **new_kwargs))
-                except ReceivedErrorResponse as e:
-                    self._handle_server_error(e)
-
             if isinstance(self.w, Two1Wallet):
                 # If it's the actual wallet object, just return the
                 # attribute
@@ -1882,14 +2156,107 @@ class Wallet(object):
                 # creative: we should look up whether this is a
                 # property and if it is actually call the function.
                 if isinstance(getattr(Two1Wallet, method_name), property):
-                    try:
-                        rv = attr()
-                    except ReceivedErrorResponse as e:
-                        self._handle_server_error(e)
+                    rv = self._call(method_name)
                 else:
-                    rv = wrapper
+                    rv = functools.partial(self._call, method_name)
         else:
             raise exceptions.UndefinedMethodError(
                 "wallet has no method or property: %s" % (method_name))
 
         return rv
+
+
+class WalletBatchResult(object):
+    """ The result of a call made through a WalletBatch.
+
+        The result is only available once the batch has been executed.
+    """
+
+    def __init__(self, method_name):
+        self.method_name = method_name
+        self._done = False
+        self._value = None
+        self._exception = None
+
+    def _set(self, value, exception):
+        self._done = True
+        self._value = value
+        self._exception = exception
+
+    def done(self):
+        """ Returns whether the call has been made.
+
+        Returns:
+            bool: True if the batch has been executed.
+        """
+        return self._done
+
+    def result(self):
+        """ Returns the result of the call, raising whatever it raised
+            if it failed.
+
+        Returns:
+            The return value of the call.
+        """
+        if not self._done:
+            raise RuntimeError(
+                "%s() hasn't been called yet: the batch must be executed first." %
+                self.method_name)
+        if self._exception is not None:
+            raise self._exception
+
+        return self._value
+
+
+class WalletBatch(object):
+    """ Collects calls to a Wallet and makes them all at once.
+
+        Methods called (or properties read) on the batch return a
+        WalletBatchResult rather than the result itself. The calls are
+        made, in order, by execute(), which is called when the batch
+        is used as a context manager and exits without an exception.
+        When the Wallet is using the wallet daemon, all calls are sent
+        in a single JSON-RPC batch request. The daemon also makes them
+        in order, though consecutive read-only calls may overlap, and
+        other clients' calls may run between them.
+
+    Args:
+        wallet (Wallet): The wallet to make the calls on.
+    """
+
+    def __init__(self, wallet):
+        self._wallet = wallet
+        self._calls = []
+
+    def _add(self, method_name, args, kwargs):
+        result = WalletBatchResult(method_name)
+        self._calls.append((method_name, args, kwargs, result))
+        return result
+
+    def __getattr__(self, method_name):
+        if not hasattr(Two1Wallet, method_name):
+            raise exceptions.UndefinedMethodError(
+                "wallet has no method or property: %s" % (method_name))
+
+        if isinstance(getattr(Two1Wallet, method_name), property):
+            return self._add(method_name, (), {})
+
+        def wrapper(*args, **kwargs):
+            return self._add(method_name, args, kwargs)
+
+        return wrapper
+
+    def execute(self):
+        """ Makes all the calls collected so far.
+        """
+        calls, self._calls = self._calls, []
+        results = self._wallet._call_batch([c[:3] for c in calls])
+        for c, (value, exception) in zip(calls, results):
+            c[3]._set(value, exception)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
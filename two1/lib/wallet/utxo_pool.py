@@ -0,0 +1,244 @@
+import bisect
+import threading
+import time
+from collections.abc import Mapping
+
+from two1.lib.wallet.cache_manager import CacheManager
+
+
+class UTXOPool(object):
+    """ The wallet's UTXOs, kept in order of value.
+
+        The pool is a UTXO listener of the wallet's cache manager (see
+        CacheManager.add_utxo_listener()), so it is updated
+        incrementally as transactions are inserted into the cache,
+        including provisional ones spending outputs, rather than being
+        rebuilt for every transaction.
+
+        UTXOs can be reserved while a transaction spending them is
+        being built so that concurrent builds never select the same
+        outpoint. Reservations are dropped when the UTXO is spent in
+        the cache or the transaction is discarded (see unreserve()),
+        and expire after RESERVATION_TIMEOUT seconds in case the
+        transaction is never broadcast nor discarded.
+
+        Selection and reservation should be done while holding lock.
+    """
+    RESERVATION_TIMEOUT = 10 * 60  # seconds
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # Sorted list of (value, -confirmations, txid, index)
+        self._keys = []
+        # (txid, index) -> (sort key, address, account index, utxo,
+        # confirmed)
+        self._entries = {}
+        # (txid, index) -> expiry time
+        self._reserved = {}
+
+    @staticmethod
+    def _sort_key(utxo):
+        return (utxo.value, -utxo.num_confirmations,
+                str(utxo.transaction_hash), utxo.outpoint_index)
+
+    def load(self, utxos):
+        """ Replaces the contents of the pool.
+
+        Args:
+            utxos (list(tuple)): (address, account index, utxo, status)
+                tuples as passed by CacheManager.add_utxo_listener().
+        """
+        with self.lock:
+            self._entries = {}
+            for addr, account_index, utxo, status in utxos:
+                key = (str(utxo.transaction_hash), utxo.outpoint_index)
+                self._entries[key] = (self._sort_key(utxo), addr,
+                                      account_index, utxo,
+                                      status == CacheManager.UNSPENT)
+            self._keys = sorted(e[0] for e in self._entries.values())
+            self._reserved = {k: v for k, v in self._reserved.items()
+                              if k in self._entries}
+
+    def update_utxo(self, address, account_index, utxo, status):
+        """ Adds a UTXO to the pool or updates it.
+
+        Args:
+            address (str): The address the UTXO belongs to.
+            account_index (int): The account the address belongs to or
+                None.
+            utxo (UnspentTransactionOutput): The UTXO.
+            status (int): The status of the UTXO in the cache.
+        """
+        key = (str(utxo.transaction_hash), utxo.outpoint_index)
+        sort_key = self._sort_key(utxo)
+        with self.lock:
+            self._remove(key)
+            self._entries[key] = (sort_key, address, account_index, utxo,
+                                  status == CacheManager.UNSPENT)
+            bisect.insort(self._keys, sort_key)
+
+    def remove_utxo(self, txid, index):
+        """ Removes a UTXO from the pool, if it is in it.
+
+        Args:
+            txid (str): The txid of the UTXO.
+            index (int): The output index of the UTXO.
+        """
+        key = (str(txid), index)
+        with self.lock:
+            self._remove(key)
+            self._reserved.pop(key, None)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            i = bisect.bisect_left(self._keys, entry[0])
+            del self._keys[i]
+
+    def reserve(self, outpoints, timeout=None):
+        """ Reserves UTXOs so that views of the pool no longer include
+            them.
+
+        Args:
+            outpoints (list(tuple)): (txid, index) tuples.
+            timeout (float): Seconds after which the reservation
+                expires. Defaults to RESERVATION_TIMEOUT.
+        """
+        if timeout is None:
+            timeout = self.RESERVATION_TIMEOUT
+
+        expiry = time.time() + timeout
+        with self.lock:
+            for txid, index in outpoints:
+                self._reserved[(str(txid), index)] = expiry
+
+    def unreserve(self, outpoints):
+        """ Releases reservations made with reserve().
+
+        Args:
+            outpoints (list(tuple)): (txid, index) tuples.
+        """
+        with self.lock:
+            for txid, index in outpoints:
+                self._reserved.pop((str(txid), index), None)
+
+    def is_reserved(self, txid, index):
+        """ Returns whether a UTXO is reserved.
+
+        Args:
+            txid (str): The txid of the UTXO.
+            index (int): The output index of the UTXO.
+
+        Returns:
+            bool: True if the UTXO is reserved.
+        """
+        key = (str(txid), index)
+        with self.lock:
+            expiry = self._reserved.get(key, None)
+            if expiry is None:
+                return False
+            if expiry < time.time():
+                del self._reserved[key]
+                return False
+
+            return True
+
+    def view(self, include_unconfirmed=False, accounts=None):
+        """ Returns the unreserved UTXOs in the pool matching some
+            criteria.
+
+        Args:
+            include_unconfirmed (bool): Whether to include unconfirmed
+                UTXOs.
+            accounts (set(int)): The indices of the accounts the UTXOs
+                must belong to. If None, UTXOs belonging to any
+                account are included.
+
+        Returns:
+            UTXOPoolView: The UTXOs.
+        """
+        with self.lock:
+            return UTXOPoolView(self, list(self._keys),
+                                include_unconfirmed, accounts)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class UTXOPoolView(Mapping):
+    """ A read-only view of some of the UTXOs in a UTXOPool.
+
+        It can be passed to UTXO selectors in place of a utxos_by_addr
+        dict: it is a mapping of address to the list of UTXOs for that
+        address, and selectors that want the UTXOs by value use
+        sorted_utxos(), which doesn't have to sort them. The mapping
+        is only built if it is used.
+
+        The view is of the pool as it was when the view was created,
+        less any UTXOs removed from the pool or reserved since.
+
+    Args:
+        pool (UTXOPool): The pool.
+        keys (list): A snapshot of the pool's sorted keys.
+        include_unconfirmed (bool): Whether to include unconfirmed
+            UTXOs.
+        accounts (set(int)): The accounts the UTXOs must belong to, or
+            None for all accounts.
+    """
+
+    def __init__(self, pool, keys, include_unconfirmed, accounts):
+        self._pool = pool
+        self._keys = keys
+        self._include_unconfirmed = include_unconfirmed
+        self._accounts = accounts
+        self._utxos_by_addr = None
+
+    def sorted_utxos(self, reverse=False):
+        """ Yields the UTXOs in the view ordered by value.
+
+        Args:
+            reverse (bool): Largest value first if True, smallest
+                first otherwise.
+
+        Returns:
+            generator: (address, UnspentTransactionOutput) tuples.
+        """
+        entries = self._pool._entries
+        keys = reversed(self._keys) if reverse else self._keys
+        for sort_key in keys:
+            key = sort_key[2:]
+            entry = entries.get(key, None)
+            if entry is None or entry[0] != sort_key:
+                # Removed or changed since the view was created
+                continue
+
+            _, addr, account_index, utxo, confirmed = entry
+            if account_index is None or \
+               (self._accounts is not None and
+                    account_index not in self._accounts):
+                continue
+            if not (confirmed or self._include_unconfirmed):
+                continue
+            if self._pool._reserved and self._pool.is_reserved(*key):
+                continue
+
+            yield addr, utxo
+
+    def _get_utxos_by_addr(self):
+        if self._utxos_by_addr is None:
+            self._utxos_by_addr = {}
+            for addr, utxo in self.sorted_utxos():
+                if addr not in self._utxos_by_addr:
+                    self._utxos_by_addr[addr] = []
+                self._utxos_by_addr[addr].append(utxo)
+
+        return self._utxos_by_addr
+
+    def __getitem__(self, addr):
+        return self._get_utxos_by_addr()[addr]
+
+    def __iter__(self):
+        return iter(self._get_utxos_by_addr())
+
+    def __len__(self):
+        return len(self._get_utxos_by_addr())
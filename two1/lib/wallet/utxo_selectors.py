@@ -1,7 +1,11 @@
 
+import random
+import time
+
 from two1.lib.wallet.exceptions import WalletBalanceError
 
 FEE_PER_KB = 10000  # Satoshis
+DEFAULT_FEE_RATE = FEE_PER_KB // 1000  # Satoshis/byte
 
 # Each txn input is ~150 bytes:
 # outpoint: 32 bytes
@@ -14,6 +18,29 @@ DEFAULT_INPUT_FEE = int(0.15 * FEE_PER_KB)
 # Each txn output is ~40 bytes, thus 0.04
 DEFAULT_OUTPUT_FEE = int(0.04 * FEE_PER_KB)
 
+# Outputs at or below this are non-standard, so a selection leaving
+# less change than this doesn't get a change output (same as
+# Two1Wallet.DUST_LIMIT).
+DUST_LIMIT = 546  # Satoshis
+
+# Transaction size model (bytes)
+# version (4) + lock time (4), not including the input/output counts
+TXN_OVERHEAD_SIZE = 8
+# value (8) + script length (1) + P2PKH script (25)
+P2PKH_OUTPUT_SIZE = 34
+# outpoint (36) + script length (1) + signature push (1 + 72) +
+# compressed public key push (1 + 33) + sequence num (4)
+P2PKH_INPUT_SIZE = 148
+# P2SH inputs are assumed to be m-of-n multisig with these m, n unless
+# the selector is told otherwise.
+DEFAULT_MULTISIG_M = 2
+DEFAULT_MULTISIG_N = 3
+
+# Selection time limit (seconds) for the searching selectors
+DEFAULT_TIME_BUDGET = 0.25
+BNB_MAX_TRIES = 100000
+KNAPSACK_ITERATIONS = 1000
+
 
 def _get_utxos_addr_tuple_list(utxos_by_addr):
     utxo_tuple_list = []
@@ -24,12 +51,25 @@ def _get_utxos_addr_tuple_list(utxos_by_addr):
     return utxo_tuple_list
 
 
+def _sorted_utxos(utxos_by_addr, reverse=False):
+    """ Returns (address, utxo) tuples ordered by value.
+
+        utxos_by_addr may be a dict or a utxo_pool.UTXOPoolView, which
+        is already ordered and only has to be walked as far as the
+        selector needs.
+    """
+    if hasattr(utxos_by_addr, "sorted_utxos"):
+        return utxos_by_addr.sorted_utxos(reverse)
+
+    return sorted(_get_utxos_addr_tuple_list(utxos_by_addr),
+                  key=lambda utxo_addr_tuple: utxo_addr_tuple[1].value,
+                  reverse=reverse)
+
+
 def utxo_selector_smallest_first(data_provider, utxos_by_addr, amount,
                                  num_outputs, fees=None):
     # Order the utxos by amount
-    utxo_tuple_list = _get_utxos_addr_tuple_list(utxos_by_addr)
-    ordered_utxos = sorted(utxo_tuple_list,
-                           key=lambda utxo_addr_tuple: utxo_addr_tuple[1].value)
+    ordered_utxos = _sorted_utxos(utxos_by_addr)
 
     calc_fees = num_outputs * DEFAULT_OUTPUT_FEE
     utxos_to_use = {}
@@ -55,3 +95,367 @@ def utxo_selector_smallest_first(data_provider, utxos_by_addr, amount,
         rv = {}, f
 
     return rv
+
+
+def _var_int_size(n):
+    if n < 0xfd:
+        return 1
+    elif n <= 0xffff:
+        return 3
+    elif n <= 0xffffffff:
+        return 5
+    else:
+        return 9
+
+
+def p2sh_multisig_input_size(m, n):
+    """ Returns the size of an input spending an m-of-n P2SH multisig
+        output.
+
+    Args:
+        m (int): Number of signatures required.
+        n (int): Number of public keys in the redeem script.
+
+    Returns:
+        int: The size of the input in bytes.
+    """
+    # OP_m + n compressed public key pushes + OP_n + OP_CHECKMULTISIG
+    redeem_script_size = 1 + n * 34 + 1 + 1
+    redeem_push_size = 1 if redeem_script_size <= 75 else 2
+    # OP_0 + m signature pushes + redeem script push
+    script_size = 1 + m * 73 + redeem_push_size + redeem_script_size
+
+    return 36 + _var_int_size(script_size) + script_size + 4
+
+
+def input_size(script, multisig_m=DEFAULT_MULTISIG_M,
+               multisig_n=DEFAULT_MULTISIG_N):
+    """ Returns the (worst case) size of an input spending an output.
+
+    Args:
+        script (Script): The script of the output being spent.
+        multisig_m (int): Signatures required if script is P2SH.
+        multisig_n (int): Public keys in the redeem script if script
+            is P2SH.
+
+    Returns:
+        int: The size of the input in bytes.
+    """
+    if script.is_p2sh():
+        return p2sh_multisig_input_size(multisig_m, multisig_n)
+    return P2PKH_INPUT_SIZE
+
+
+def txn_size(input_sizes, num_outputs):
+    """ Returns the size of a transaction.
+
+    Args:
+        input_sizes (list(int)): The size of each input.
+        num_outputs (int): The number of (P2PKH) outputs.
+
+    Returns:
+        int: The size of the transaction in bytes.
+    """
+    return TXN_OVERHEAD_SIZE + \
+        _var_int_size(len(input_sizes)) + sum(input_sizes) + \
+        _var_int_size(num_outputs) + num_outputs * P2PKH_OUTPUT_SIZE
+
+
+class _Selection(object):
+    """ Fee accounting shared by the selectors below.
+
+        If fees are given, they are used as is and UTXOs are
+        counted at face value. Otherwise every UTXO is counted at its
+        effective value, i.e. its value less the fee for the input
+        spending it, and the fixed part of the transaction (overhead
+        and outputs) is added to the target.
+
+    Note:
+        THIS IS NOT A PUBLIC API.
+    """
+
+    def __init__(self, utxos_by_addr, amount, num_outputs, fees, fee_rate):
+        self.amount = amount
+        self.num_outputs = num_outputs
+        self.fees = fees
+        self.fee_rate = 0 if fees is not None else fee_rate
+        self._utxos_by_addr = utxos_by_addr
+        self._candidates = None
+
+        if fees is not None:
+            self.target = amount + fees
+        else:
+            self.target = amount + self.fee_rate * txn_size([], num_outputs)
+        self.change_cost = self.fee_rate * P2PKH_OUTPUT_SIZE
+
+    def iter_candidates(self):
+        """ Yields (effective value, input size, address, utxo) tuples,
+            largest value first.
+        """
+        for addr, utxo in _sorted_utxos(self._utxos_by_addr, reverse=True):
+            size = input_size(utxo.script)
+            eff_value = utxo.value - self.fee_rate * size
+            # UTXOs that cost more to spend than they are worth are
+            # never worth selecting.
+            if eff_value > 0:
+                yield (eff_value, size, addr, utxo)
+
+    @property
+    def candidates(self):
+        """ A list of all the candidates from iter_candidates().
+        """
+        if self._candidates is None:
+            self._candidates = list(self.iter_candidates())
+
+        return self._candidates
+
+    def finish(self, selected):
+        """ Returns the utxos_by_addr dict and fees for selected, a
+            list of candidates.
+        """
+        if not selected:
+            if self.fees is not None:
+                return {}, self.fees
+            return {}, self.fee_rate * txn_size([], self.num_outputs)
+
+        utxos_to_use = {}
+        for _, _, addr, utxo in selected:
+            if addr not in utxos_to_use:
+                utxos_to_use[addr] = []
+            utxos_to_use[addr].append(utxo)
+
+        if self.fees is not None:
+            return utxos_to_use, self.fees
+
+        total = sum(c[3].value for c in selected)
+        input_sizes = [c[1] for c in selected]
+        fees = self.fee_rate * txn_size(input_sizes, self.num_outputs + 1)
+        if total - self.amount - fees <= DUST_LIMIT:
+            # No change output: whatever is left over goes to the miners.
+            fees = max(total - self.amount,
+                       self.fee_rate * txn_size(input_sizes, self.num_outputs))
+
+        return utxos_to_use, fees
+
+
+def _select_largest_first(selection, target):
+    selected = []
+    total = 0
+    for c in selection.iter_candidates():
+        if total >= target:
+            break
+        selected.append(c)
+        total += c[0]
+
+    return selected if total >= target else None
+
+
+def _select_branch_and_bound(selection, deadline):
+    """ Depth-first search for a set of candidates whose effective
+        values add up to the target plus at most the dust limit, so
+        the transaction needs no change output. The candidates are
+        tried largest first, including each before excluding it.
+        Returns the match with the least excess found within the tries
+        and time limits, or None.
+    """
+    candidates = sorted(selection.candidates, key=lambda c: c[0], reverse=True)
+    values = [c[0] for c in candidates]
+    target = selection.target
+    upper = target + DUST_LIMIT
+
+    # Sum of the values of the candidates not yet decided on
+    lookahead = sum(values)
+    if lookahead < target:
+        return None
+
+    best = None
+    best_excess = None
+    selected = []
+    current = 0
+    i = 0
+    n = len(values)
+    for tries in range(BNB_MAX_TRIES):
+        if tries % 1000 == 0 and time.time() > deadline:
+            break
+
+        backtrack = False
+        if current + lookahead < target or current > upper:
+            backtrack = True
+        elif current >= target:
+            if best_excess is None or current - target < best_excess:
+                best = list(selected)
+                best_excess = current - target
+                if best_excess == 0:
+                    break
+            backtrack = True
+        elif i >= n:
+            backtrack = True
+
+        if backtrack:
+            if not selected:
+                # Searched everything
+                break
+
+            # Switch the last included candidate to being excluded
+            last = selected.pop()
+            lookahead += sum(values[last + 1:i])
+            current -= values[last]
+            i = last + 1
+        elif i > 0 and values[i] == values[i - 1] and \
+                (not selected or selected[-1] != i - 1):
+            # Including this one would only repeat the subtree where
+            # the previous, equal, candidate was included.
+            lookahead -= values[i]
+            i += 1
+        else:
+            current += values[i]
+            lookahead -= values[i]
+            selected.append(i)
+            i += 1
+
+    return None if best is None else [candidates[k] for k in best]
+
+
+def _select_knapsack(selection, target, deadline):
+    """ Stochastic approximation of the smallest subset of the
+        candidates whose effective values add up to at least target,
+        as done by bitcoind. Candidates at least as large as target
+        are only ever used alone.
+    """
+    smaller = []
+    lowest_larger = None
+    for c in selection.candidates:
+        if c[0] == target:
+            return [c]
+        elif c[0] < target:
+            smaller.append(c)
+        elif lowest_larger is None or c[0] < lowest_larger[0]:
+            lowest_larger = c
+
+    total_smaller = sum(c[0] for c in smaller)
+    if total_smaller == target:
+        return smaller
+    if total_smaller < target:
+        return None if lowest_larger is None else [lowest_larger]
+
+    smaller.sort(key=lambda c: c[0], reverse=True)
+    values = [c[0] for c in smaller]
+    n = len(values)
+
+    best = [True] * n
+    best_total = total_smaller
+    rand = random.Random()
+    out_of_time = False
+    for _ in range(KNAPSACK_ITERATIONS):
+        if best_total == target or out_of_time:
+            break
+
+        included = [False] * n
+        total = 0
+        reached_target = False
+        for pass_num in range(2):
+            if reached_target or out_of_time:
+                break
+            for k in range(n):
+                if k % 1024 == 1023 and time.time() > deadline:
+                    out_of_time = True
+                    break
+
+                # The first pass picks randomly, the second adds
+                # whatever wasn't picked.
+                if (rand.getrandbits(1) if pass_num == 0 else not included[k]):
+                    total += values[k]
+                    included[k] = True
+                    if total >= target:
+                        reached_target = True
+                        if total < best_total:
+                            best_total = total
+                            best = list(included)
+                        total -= values[k]
+                        included[k] = False
+
+    if lowest_larger is not None and \
+       (best_total != target and lowest_larger[0] <= best_total):
+        return [lowest_larger]
+
+    return [c for c, inc in zip(smaller, best) if inc]
+
+
+def utxo_selector_largest_first(data_provider, utxos_by_addr, amount,
+                                num_outputs, fees=None,
+                                fee_rate=DEFAULT_FEE_RATE,
+                                time_budget=DEFAULT_TIME_BUDGET):
+    """ Selects the largest UTXOs first, which minimizes the number of
+        inputs (and thus the size of the transaction).
+
+        Args and return value are as for utxo_selector_smallest_first,
+        plus:
+
+    Args:
+        fee_rate (int): Fee rate in satoshis/byte used to compute
+            fees when fees is None.
+        time_budget (float): Unused. Sorting is always fast enough.
+    """
+    selection = _Selection(utxos_by_addr, amount, num_outputs, fees, fee_rate)
+    selected = _select_largest_first(selection,
+                                     selection.target + selection.change_cost)
+    return selection.finish(selected)
+
+
+def utxo_selector_branch_and_bound(data_provider, utxos_by_addr, amount,
+                                   num_outputs, fees=None,
+                                   fee_rate=DEFAULT_FEE_RATE,
+                                   time_budget=DEFAULT_TIME_BUDGET):
+    """ Searches for a set of UTXOs that pays the amount and fees
+        with no change output (i.e. leaving at most the dust limit for
+        the miners). If there is none, or the search runs out of
+        time, falls back to utxo_selector_knapsack.
+
+        Args and return value are as for utxo_selector_smallest_first,
+        plus:
+
+    Args:
+        fee_rate (int): Fee rate in satoshis/byte used to compute
+            fees when fees is None.
+        time_budget (float): Maximum number of seconds to spend on
+            the search.
+    """
+    deadline = time.time() + time_budget
+    selection = _Selection(utxos_by_addr, amount, num_outputs, fees, fee_rate)
+    selected = _select_branch_and_bound(selection, deadline)
+    if selected is None:
+        selected = _select_knapsack(selection,
+                                    selection.target + selection.change_cost,
+                                    deadline)
+    return selection.finish(selected)
+
+
+def utxo_selector_knapsack(data_provider, utxos_by_addr, amount,
+                           num_outputs, fees=None,
+                           fee_rate=DEFAULT_FEE_RATE,
+                           time_budget=DEFAULT_TIME_BUDGET):
+    """ Selects the UTXOs with the smallest total that pays the amount,
+        fees and a change output, by randomly trying subsets of the
+        UTXOs for as long as the time budget allows.
+
+        Args and return value are as for utxo_selector_smallest_first,
+        plus:
+
+    Args:
+        fee_rate (int): Fee rate in satoshis/byte used to compute
+            fees when fees is None.
+        time_budget (float): Maximum number of seconds to spend on
+            the search.
+    """
+    deadline = time.time() + time_budget
+    selection = _Selection(utxos_by_addr, amount, num_outputs, fees, fee_rate)
+    selected = _select_knapsack(selection,
+                                selection.target + selection.change_cost,
+                                deadline)
+    return selection.finish(selected)
+
+
+utxo_selectors = {"smallest_first": utxo_selector_smallest_first,
+                  "largest_first": utxo_selector_largest_first,
+                  "branch_and_bound": utxo_selector_branch_and_bound,
+                  "knapsack": utxo_selector_knapsack}
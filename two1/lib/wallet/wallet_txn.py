@@ -19,7 +19,7 @@ class WalletTransaction(Transaction):
             tuple: First element of the tuple is the WalletTransaction,
                    second is the remainder of the byte stream.
         """
-        t, b1 = Transaction.from_bytes()
+        t, b1 = Transaction.from_bytes(b)
         return WalletTransaction.from_transaction(t), b1
 
     @staticmethod